@@ -1,29 +1,39 @@
 import os
 import sys
 import json
+import copy
+import functools
 import shutil
 import time
-import subprocess
+import logging
+import threading
+
+from contextlib import contextmanager
 
 from datetime import datetime, timedelta
 
-from dwarf_session import start_dwarf_session
+from dwarf_session import start_dwarf_session, run_dwarf_session_async, wait_cancellable
+from session_watcher import create_watcher
+from session_queue import SessionQueue, QUEUE_POLICIES, POLICY_EDF
+from session_cache import SessionCache
+from session_store import get_session_store
+from session_journal import atomic_write_json, get_journal, recover_sessions
+from session_policy import SESSION_POLICY, SessionFatalError, SessionCancelledError, get_session_policies
+from scheduler_metrics import metrics, start_metrics_server
+from session_control import start_control_server
+from session_events import emit_event, event_context
+
+import scheduler_config
 
 from dwarf_python_api.lib.dwarf_utils import perform_time
 from dwarf_python_api.lib.dwarf_utils import perform_timezone
 from dwarf_python_api.lib.dwarf_utils import perform_disconnect
 
-from dwarf_python_api.lib.dwarf_utils import save_bluetooth_config_from_ini_file
-from dwarf_python_api.get_live_data_dwarf import fn_wait_for_user_input
-
-from dwarf_ble_connect.connect_bluetooth import connect_bluetooth
-from dwarf_ble_connect.lib.connect_direct_bluetooth import connect_ble_dwarf_win
-from dwarf_python_api.lib.dwarf_utils import read_bluetooth_ble_psd
-from dwarf_python_api.lib.dwarf_utils import read_bluetooth_ble_STA_ssid
-from dwarf_python_api.lib.dwarf_utils import read_bluetooth_ble_STA_pwd
+# the bluetooth stack, the HTTP client and the user prompts are imported when first used,
+# a headless scheduler with a known dwarf ip starts without them (see benchmarks/bench_startup.py)
 
-# import data for config.py
-import dwarf_python_api.get_config_data
+# import data for config.py, the parsed config is cached by config_snapshot
+import config_snapshot
 # The config value for dwarf_id is offset by -1 (stored as one less than the actual ID).
 # the value return by get_config_data must be used with these functions
 from dwarf_python_api.get_config_data import config_to_dwarf_id_str, config_to_dwarf_id_int
@@ -34,6 +44,7 @@ import dwarf_python_api.lib.my_logger as log
 CONFIG_DEFAULT = "Default"
 BASE_DIR = os.path.abspath(".")
 DEVICES_DIR = os.path.join(BASE_DIR, "Devices_Sessions")
+DEVICES_FILE = os.path.join(DEVICES_DIR, 'list_devices.txt')
 SESSIONS_DIR =  os.path.join(BASE_DIR, 'Astro_Sessions')
 
 LIST_ASTRO_DIR_DEFAULT = {
@@ -54,81 +65,102 @@ LIST_ASTRO_DIR = {
     "ERROR_DIR": os.path.join(SESSIONS_DIR, 'Error'),
 }
 
-import requests
-
-def setup_new_config(config_name):
-    global LIST_ASTRO_DIR
+# Longest sleep (s) of the scheduler without any change in the ToDo directory
+# keeps the periodic "not yet ready" logs alive
+MAX_SCHEDULER_SLEEP = 60
 
+# Get the directories of the sessions of a configuration
+def get_list_astro_dir(config_name):
     if config_name == CONFIG_DEFAULT:
-        dwarf_python_api.get_config_data.set_config_data(
+        sessions_dir = os.path.join(BASE_DIR, 'Astro_Sessions')
+    else:
+        sessions_dir = os.path.join(DEVICES_DIR, config_name, 'Astro_Sessions')
+    return get_sessions_dirs(sessions_dir)
+
+# Get the directories of a sessions directory
+def get_sessions_dirs(sessions_dir):
+    return {
+        "SESSIONS_DIR": sessions_dir,
+        "RESULTS_DIR": os.path.join(sessions_dir, 'Results'),
+        "TODO_DIR": os.path.join(sessions_dir, 'ToDo'),
+        "CURRENT_DIR": os.path.join(sessions_dir, 'Current'),
+        "DONE_DIR": os.path.join(sessions_dir, 'Done'),
+        "ERROR_DIR": os.path.join(sessions_dir, 'Error'),
+    }
+
+# Config file of dwarf_python_api of a configuration
+def get_config_file(config_name):
+    return 'config.py' if config_name == CONFIG_DEFAULT else f"config_{config_name}.py"
+
+# Make the config file of a configuration the active one of dwarf_python_api
+def activate_config(config_name, print_log=True):
+    if config_name == CONFIG_DEFAULT:
+        config_snapshot.set_config_data(
             config_file='config.py',
             config_file_tmp='config.tmp',
             lock_file='config.lock',
-            print_log=True
+            print_log=print_log
         )
+        return
 
-        SESSIONS_DIR =  os.path.join(BASE_DIR, 'Astro_Sessions')
-        LIST_ASTRO_DIR = {
-            "SESSIONS_DIR": SESSIONS_DIR,
-            "RESULTS_DIR": os.path.join(SESSIONS_DIR, 'Results'),
-            "TODO_DIR": os.path.join(SESSIONS_DIR, 'ToDo'),
-            "CURRENT_DIR": os.path.join(SESSIONS_DIR, 'Current'),
-            "DONE_DIR": os.path.join(SESSIONS_DIR, 'Done'),
-            "ERROR_DIR": os.path.join(SESSIONS_DIR, 'Error'),
-        }
+    new_config_file = get_config_file(config_name)
+    new_config_file_tmp = f"config_{config_name}.tmp"
+    new_lock_file = f"config_{config_name}.lock"
 
-    else:
-        new_config_file = f"config_{config_name}.py"
-        new_config_file_tmp = f"config_{config_name}.tmp"
-        new_lock_file = f"config_{config_name}.lock"
-
-        # Update CONFIG variables using the set_config_data function
-        dwarf_python_api.get_config_data.set_config_data(
-            config_file=new_config_file,
-            config_file_tmp=new_config_file_tmp,
-            lock_file=new_lock_file,
-            print_log=True
-        )
+    # Update CONFIG variables using the set_config_data function
+    config_snapshot.set_config_data(
+        config_file=new_config_file,
+        config_file_tmp=new_config_file_tmp,
+        lock_file=new_lock_file,
+        print_log=print_log
+    )
 
-        config_filemname = os.path.join(BASE_DIR, new_config_file)
-        if not os.path.exists(config_filemname):
-
-            try:
-                # Copy the original config file if not exist
-                shutil.copy('config.py', new_config_file)
-                print(f"'{'config.py'}' successfully copied to '{new_config_file}'.")
-            except FileNotFoundError:
-                print(f"Error: '{'config.py'}' not found.")
-            except Exception as e:
-                print(f"An error occurred: {e}")
-
-            # get Original log_file
-            data_config = dwarf_python_api.get_config_data.get_config_data("config.py")
-            if data_config['log_file'] == "False":
-                log_file = None
-            else: 
-                log_file = "app.log" if data_config['log_file'] == "" else data_config['log_file']
-
-            if log_file is not None:
-                name, ext = log_file.rsplit(".", 1)
-                new_log_file = f"{name}_{config_name}.{ext}"
-                dwarf_python_api.get_config_data.update_config_data( "log_file", new_log_file, True)
-
-        config_dir = os.path.join(DEVICES_DIR, config_name)
-        SESSIONS_DIR = os.path.join(config_dir, 'Astro_Sessions')
-        # Define the list of directories
-        LIST_ASTRO_DIR = {
-            "SESSIONS_DIR": SESSIONS_DIR,
-            "RESULTS_DIR": os.path.join(SESSIONS_DIR, 'Results'),
-            "TODO_DIR": os.path.join(SESSIONS_DIR, 'ToDo'),
-            "CURRENT_DIR": os.path.join(SESSIONS_DIR, 'Current'),
-            "DONE_DIR": os.path.join(SESSIONS_DIR, 'Done'),
-            "ERROR_DIR": os.path.join(SESSIONS_DIR, 'Error'),
-        }
+    config_filemname = os.path.join(BASE_DIR, new_config_file)
+    if not os.path.exists(config_filemname):
+
+        try:
+            # Copy the original config file if not exist
+            shutil.copy('config.py', new_config_file)
+            print(f"'{'config.py'}' successfully copied to '{new_config_file}'.")
+        except FileNotFoundError:
+            print(f"Error: '{'config.py'}' not found.")
+        except Exception as e:
+            print(f"An error occurred: {e}")
+
+        # get Original log_file
+        data_config = config_snapshot.get_config_data("config.py")
+        if data_config['log_file'] == "False":
+            log_file = None
+        else: 
+            log_file = "app.log" if data_config['log_file'] == "" else data_config['log_file']
+
+        if log_file is not None:
+            name, ext = log_file.rsplit(".", 1)
+            new_log_file = f"{name}_{config_name}.{ext}"
+            config_snapshot.update_config_data( "log_file", new_log_file, True)
+
+def setup_new_config(config_name):
+    global LIST_ASTRO_DIR
+
+    activate_config(config_name)
+    LIST_ASTRO_DIR = get_list_astro_dir(config_name)
 
     # update log
     log.update_log_file()
 
+# Read the configurations of the devices file, the default one first
+def read_device_configs():
+    config_names = [CONFIG_DEFAULT]
+    try:
+        with open(DEVICES_FILE, 'r') as file:
+            for line in file:
+                config_name = line.strip()
+                if config_name and config_name not in config_names:
+                    config_names.append(config_name)
+    except FileNotFoundError:
+        pass
+    return config_names
+
 # Load the JSON file
 def load_json(filepath):
     try:
@@ -141,8 +173,7 @@ def load_json(filepath):
 # Save the JSON file
 def save_json(filepath, data):
     try:
-        with open(filepath, 'w') as file:
-            json.dump(data, file, indent=4)
+        atomic_write_json(filepath, data)
     except Exception as e:
         log.error(f"error saving file: {filepath} - {e}")
         return False
@@ -155,6 +186,17 @@ def move_file(source, destination):
         log.error(f"error moving file: {source} to {destination} - {e}")
         return False
 
+# Move the JSON file to a new folder, with its updated content if program is given
+# the transition is journaled so it can be completed after a crash
+def transition_file(source, destination, program=None):
+    try:
+        sessions_dir = get_scheduler_context().list_astro_dir["SESSIONS_DIR"]
+        get_journal(sessions_dir).transition(source, destination, program)
+        return True
+    except Exception as e:
+        log.error(f"error moving file: {source} to {destination} - {e}")
+        return False
+
 # Check if the execution time of the command has been reached
 def is_time_to_execute(command):
     # Get current date and time
@@ -177,6 +219,41 @@ def get_time_to_execute(current_datetime, command):
 
     return command_datetime
 
+# Get the priority (higher first, default 0) and the deadline of a session command, raise ValueError
+# the deadline is a date and time, a time (the first one after the execution time) or a number of seconds after the execution time
+def get_queue_fields(command, command_datetime):
+    priority = command.get('priority') or 0
+    if isinstance(priority, bool) or not isinstance(priority, (int, str)):
+        raise ValueError(f"priority must be an integer, not {priority!r}")
+    priority = int(priority)
+
+    deadline = command.get('deadline')
+    if deadline is None or deadline == "":
+        return priority, None
+    if isinstance(deadline, (int, float)) and not isinstance(deadline, bool):
+        deadline = command_datetime + timedelta(seconds=deadline)
+    elif isinstance(deadline, str) and len(deadline.strip()) == 8:
+        deadline = datetime.combine(command_datetime.date(), datetime.strptime(deadline.strip(), "%H:%M:%S").time())
+        if deadline <= command_datetime:
+            deadline += timedelta(days=1)
+    elif isinstance(deadline, str):
+        deadline = datetime.strptime(deadline.strip(), "%Y-%m-%d %H:%M:%S")
+    else:
+        raise ValueError(f"invalid deadline {deadline!r}")
+    if deadline <= command_datetime:
+        raise ValueError(f"the deadline {deadline} is not after the execution time {command_datetime}")
+    return priority, deadline
+
+# Runner of the session steps, session_runner in the [SCHEDULER] section of config.ini:
+# thread (blocking calls in the scheduler thread) or async (event loop, the calls to the dwarf run in an executor)
+def get_session_runner():
+    return scheduler_config.get_option("session_runner", "thread").lower()
+
+# Order of the due sessions, queue_policy in the [SCHEDULER] section of config.ini
+def get_queue_policy():
+    policy = scheduler_config.get_option("queue_policy", POLICY_EDF).lower()
+    return policy if policy in QUEUE_POLICIES else POLICY_EDF
+
 # Update the process status in the JSON file
 def update_process_status(program, status, result=None, message=None, nb_try=None, dwarf_id=None):
     command = program['command']['id_command']
@@ -195,13 +272,22 @@ def update_process_status(program, status, result=None, message=None, nb_try=Non
     command['processed_date'] = current_datetime
     return program  # Return the updated entire program object
 
-def retry_procedure(program, max_retries =3):
+# on_checkpoint() saves the session after each completed step, a retry resumes after the completed steps
+# on_progress and cancel_event are given to the session, see start_dwarf_session
+def retry_procedure(program, max_retries =3, on_checkpoint = None, on_progress = None, cancel_event = None, call_wrapper = None):
+    session_policy = get_session_policies(program['command']).get(SESSION_POLICY)
+    max_retries = max(1, int(max_retries))
     attempt = 0
     while attempt < max_retries:
         try:
             # Execute the session
-            start_dwarf_session(program['command'])
+            run_session = run_dwarf_session_async if get_session_runner() == "async" else start_dwarf_session
+            run_session(program['command'], on_checkpoint=on_checkpoint, on_progress=on_progress, cancel_event=cancel_event, call_wrapper=call_wrapper)
             return attempt + 1
+        except SessionFatalError as e:
+            log.notice("----------------------")
+            log.error(f"Session failed with a permanent error, not retried: {e}")
+            raise
         except Exception as e:
             attempt += 1
             log.notice("----------------------")
@@ -209,131 +295,610 @@ def retry_procedure(program, max_retries =3):
             if attempt == max_retries:
                 log.error("Max retries reached. Raising the exception.")
                 raise  # Re-raise the exception after max attempts
+            elif cancel_event is not None and cancel_event.is_set():
+                raise SessionCancelledError("Session cancelled before its retry") from e
             else:
-                log.notice("Retrying...")
+                metrics.inc("dwarf_session_retries_total", device=get_device_label())
+                delay = session_policy.get_delay(attempt)
+                emit_event("retry", step=SESSION_POLICY, attempt=attempt, delay=round(delay, 1), error=str(e))
+                log.notice(f"Retrying in {delay:.0f}s...")
                 log.notice("----------------------")
+                if wait_cancellable(delay, cancel_event):
+                    raise SessionCancelledError("Session cancelled before its retry") from e
+
+class SchedulerContext:
+    """State of the scheduler of one device configuration.
+
+    The default context follows the global LIST_ASTRO_DIR set by setup_new_config,
+    a device worker has its own directories and activates its config file before
+    calling the dwarf.
+    """
+    def __init__(self, config_name=None, list_astro_dir=None):
+        self.config_name = config_name
+        self.dirs = list_astro_dir
+        self.session_queue = SessionQueue()  # Waiting sessions of the ToDo directory ordered by execution time
+        self.last_logged = {}  # Dictionary to track when each file was last logged
+        self.last_hourly_log = {}  # Dictionary to track the last hourly log time for each filename
+        self.watcher = None  # ToDo watcher of the running scheduler loop
+        self.lock = threading.RLock()  # protects the queue against the control API
+        self.current = None  # session being executed, see execute_command_file
+        self.deferred = {}  # filename -> (execution time of the file, next visibility window), see check_session_visibility
+        self.targets = {}  # filename -> (RA, Dec) of the goto target of the queued sessions, None if no goto
+
+    @property
+    def list_astro_dir(self):
+        return self.dirs if self.dirs is not None else LIST_ASTRO_DIR
+
+default_context = SchedulerContext()
+scheduler_local = threading.local()  # context of the scheduler loop running in the thread
+running_contexts = set()
+
+session_cache = SessionCache()  # Parsed ToDo files, reloaded only when modified, shared by all devices
+
+def get_scheduler_context():
+    return getattr(scheduler_local, "context", default_context)
+
+# Name of the device of a scheduler context in the metrics
+def get_device_label(context=None):
+    context = context or get_scheduler_context()
+    return context.config_name or CONFIG_DEFAULT
+
+# Count the sessions of the folders once, the metrics are then updated on each transition
+def init_session_metrics(context):
+    device = get_device_label(context)
+    for state, key in (("current", "CURRENT_DIR"), ("done", "DONE_DIR"), ("error", "ERROR_DIR")):
+        try:
+            count = sum(1 for filename in os.listdir(context.list_astro_dir[key]) if filename.endswith('.json'))
+        except OSError:
+            count = 0
+        metrics.set("dwarf_sessions", count, device=device, state=state)
+
+def count_session_transition(from_state, to_state):
+    device = get_device_label()
+    if from_state:
+        metrics.inc("dwarf_sessions", -1, device=device, state=from_state)
+    metrics.inc("dwarf_sessions", 1, device=device, state=to_state)
+
+# dwarf_python_api keeps one active config file for the whole process:
+# each call to a dwarf is serialized and made with the config of its device activated,
+# the lock is released between the calls (waits, backoff, idle scheduler) so the devices run side by side
+device_api_lock = threading.RLock()
+
+@contextmanager
+def device_connection(context):
+    with device_api_lock:
+        if context.config_name is not None:
+            activate_config(context.config_name, print_log=False)
+        yield
+
+# Run one call to dwarf_python_api for the device of the context, used as call_wrapper of the sessions
+def call_device(context, function, *args):
+    with device_connection(context):
+        return function(*args)
+
+# Record the new state of a session in the session store, if enabled
+def record_session_state(filename, state, program=None):
+    try:
+        store = get_session_store(get_scheduler_context().list_astro_dir["SESSIONS_DIR"])
+        if store is None:
+            return
+        if state is None:
+            store.remove(filename)
+        else:
+            store.record(filename, state, program)
+    except Exception as e:
+        log.error(f"error updating session store for {filename} - {e}")
+
+# Move an invalid file from the ToDo folder to the Error folder
+def reject_command_file(filename):
+    astro_dir = get_scheduler_context().list_astro_dir
+    current_filepath = os.path.join(astro_dir["TODO_DIR"], filename)
+    transition_file(current_filepath, os.path.join(astro_dir["ERROR_DIR"], filename))
+    count_session_transition(None, "error")
+    log.notice("----------------------")
+    log.notice("----------------------")
+
+# Load and validate a ToDo file
+# return (program, command, command_datetime, error), error is None for a valid waiting file
+def parse_command_file(filepath):
+    program = load_json(filepath)
+    if program is False:
+        return None, None, None, "load"
+
+    # Extract command info
+    command = program.get('command', {}).get('id_command')
+    if not command:
+        return program, None, None, "no_command"
+    if command.get('process', 'wait') != 'wait':
+        return program, command, None, "not_wait"
+
+    try:
+        command_datetime = get_time_to_execute(datetime.now(), command)
+    except ValueError as e:
+        return program, command, None, f"invalid date or time - {e}"
+    try:
+        get_queue_fields(command, command_datetime)
+    except ValueError as e:
+        return program, command, None, f"invalid priority or deadline - {e}"
+    return program, command, command_datetime, None
+
+# Add, update or remove a ToDo file in the sessions queue
+def update_queued_file(filename):
+    context = get_scheduler_context()
+    session_queue = context.session_queue
+    filepath = os.path.join(context.list_astro_dir["TODO_DIR"], filename)
+    if not filepath.endswith('.json') or not os.path.isfile(filepath):
+        if session_queue.remove(filename):
+            # waiting file removed from the ToDo folder
+            record_session_state(filename, None)
+        context.deferred.pop(filename, None)
+        context.targets.pop(filename, None)
+        session_cache.evict(filepath)
+        return
+
+    program, command, command_datetime, error = session_cache.get(filepath, parse_command_file)
+    if error is None:
+        record_session_state(filename, "todo", program)
+        priority, deadline = get_queue_fields(command, command_datetime)
+        deferred = context.deferred.get(filename)
+        if deferred is not None:
+            if deferred[0] == command_datetime:
+                # waiting for the visibility window of its target
+                command_datetime = deferred[1]
+            else:
+                del context.deferred[filename]
+        entry = session_queue.get_entry(filename)
+        if entry is None or (entry[0], entry[2], entry[3]) != (command_datetime, priority, deadline):
+            emit_event("session_queued", uuid=command.get('uuid'), device=get_device_label(context), file=filename, due=command_datetime.isoformat(),
+                       priority=priority, deadline=deadline.isoformat() if deadline else None)
+        session_queue.push(filename, command_datetime, priority, deadline)
+        visibility = get_visibility()
+        context.targets[filename] = visibility.get_target_coordinates(program) if visibility else None
+        return
+
+    session_queue.remove(filename)
+    context.targets.pop(filename, None)
+    if error == "load":
+        # File probably still being written, it will be notified again
+        return
+
+    if error == "no_command":
+        # ignore file if command or id_command doesn't exist
+        log.error(f"Mandatory commands not found in file, the file {filename} is ignored")
+    elif error == "not_wait":
+        # Ignore file if process exists and is different from 'wait'
+        log.warning(f"Process value is not 'wait', the file {filename} is ignored")
+    else:
+        log.error(f"The file {filename} is ignored: {error}")
+    session_cache.evict(filepath)
+    reject_command_file(filename)
+    record_session_state(filename, "error", program)
+
+# Synchronize the sessions queue with the ToDo folder
+# changes is the set of the modified filenames, None to rescan the whole folder
+def sync_session_queue(changes=None):
+    context = get_scheduler_context()
+    session_queue = context.session_queue
+    todo_dir = context.list_astro_dir["TODO_DIR"]
+    if session_queue.directory != todo_dir:
+        # configuration changed, restart from an empty queue
+        session_queue.clear(todo_dir)
+        changes = None
+
+    full_scan = changes is None
+    if full_scan:
+        try:
+            filenames = set(os.listdir(todo_dir))
+        except FileNotFoundError:
+            log.error(f"The ToDo directory {todo_dir} does not exist")
+            filenames = set()
+        changes = filenames | set(session_queue.entries)
+        session_cache.prune(todo_dir, {os.path.join(todo_dir, filename) for filename in filenames})
+
+    for filename in sorted(changes):
+        update_queued_file(filename)
+    metrics.set("dwarf_sessions", len(session_queue), device=get_device_label(context), state="todo")
 
-last_logged = {}  # Dictionary to track when each file was last logged
-last_hourly_log = {}  # Dictionary to track the last hourly log time for each filename
+    if full_scan:
+        stats = session_cache.stats()
+        log.debug(f"Session cache: {stats['size']} files, {stats['hits']} hits, {stats['misses']} misses")
 
 # Main function to check and execute the commands
-def check_and_execute_commands(askBluetooth = False):
-    global LIST_ASTRO_DIR
-    for filename in os.listdir(LIST_ASTRO_DIR["TODO_DIR"]):
-        filepath = os.path.join(LIST_ASTRO_DIR["TODO_DIR"], filename)
-        if filepath.endswith('.json'):
-            program = load_json(filepath)
-            if program is False:
-                return
+# changes is the set of ToDo files modified since the last call, None to rescan the ToDo folder
+# return the next execution time of the waiting files, None if nothing is waiting
+def check_and_execute_commands(askBluetooth = False, changes = None):
+    context = get_scheduler_context()
+    with context.lock:
+        sync_session_queue(changes)
+
+        session_queue = context.session_queue
+        session_queue.set_policy(get_queue_policy())
+        current_datetime = datetime.now()
+        filename = pick_ready_session(session_queue, current_datetime)
+        if filename is not None:
+            session_queue.pop(filename)
+            context.deferred.pop(filename, None)
+            context.targets.pop(filename, None)
+        else:
+            head = session_queue.peek()
+            if head is None:
+                return None
+            waiting_filename, command_datetime = head
 
-            # Extract command info
-            command = program.get('command', {}).get('id_command')
+    if filename is not None:
+        execute_command_file(filename, askBluetooth)
+        # check again at once, the ToDo folder may have changed during the session
+        return datetime.now()
 
-            # ignore file if command or id_command doesn't exist
-            if not command:
-                log.error(f"Mandatory commands not found in file, the file {filename} is ignored")
-                # Move file to "Error" folder
-                current_filepath = os.path.join(LIST_ASTRO_DIR["TODO_DIR"], filename)
-                move_file(current_filepath, os.path.join(LIST_ASTRO_DIR["ERROR_DIR"], filename))
-                log.notice("----------------------")
-                log.notice("----------------------")
+    # Log Ignore time for the next session to execute
+    log_waiting_command(waiting_filename, command_datetime, current_datetime)
+    return command_datetime
 
-            # Ignore file if process exists and is different from 'wait' 
-            elif command.get('process') is not None and command.get('process') != 'wait':
-                log.warning(f"Process value is not 'wait', the file {filename} is ignored")
-                # Move file to "Error" folder
-                current_filepath = os.path.join(LIST_ASTRO_DIR["TODO_DIR"], filename)
-                move_file(current_filepath, os.path.join(LIST_ASTRO_DIR["ERROR_DIR"], filename))
-                log.notice("----------------------")
-                log.notice("----------------------")
-            # Check if the execution time has been reached
-            elif is_time_to_execute(command) and command.get('process', 'wait') == 'wait':
-                log.notice("######################")
-                log.notice(f"Find File  {filename}, that is ready to execute")
-                log.debug(f"Executing command {command.get('uuid')}")
-
-                # Move to "Current" folder and update status
-                current_filepath = os.path.join(LIST_ASTRO_DIR["CURRENT_DIR"], filename)
-                program = update_process_status(program, 'pending')
-                save_json(filepath, program)
-                move_file(filepath, current_filepath)
-
-                # Remove from the logging dictionary as it's been executed
-                if filename in last_logged:
-                    del last_logged[filename]
-                if filename in last_hourly_log:
-                    del last_hourly_log[filename]
-
-                try:
-                    # Get The Dwarf Type
-                    data_config = dwarf_python_api.get_config_data.get_config_data()
-                    dwarf_id = "2"
-                    if data_config["dwarf_id"]:
-                        dwarf_id = data_config['dwarf_id']
-                    # Execute the session
-                    max_retries = int(program['command']['id_command'].get('max_retries', 3))
-                    nb_try = retry_procedure(program)
-
-                    # If successful, update process and result
-                    program = update_process_status(program, 'ended', True, "Action completed successfully.", nb_try, dwarf_id)
-                    save_json(current_filepath, program)
-
-                    # Move file to "Done" folder
-                    move_file(current_filepath, os.path.join(LIST_ASTRO_DIR["DONE_DIR"], filename))
-
-                except Exception as e:
-                    # Handle errors and update process and result
-                    error_message = f"Error during execution: {e}"
-                    log.error(error_message)
-
-                    program = update_process_status(program, 'ended', False, error_message, max_retries, dwarf_id)
-                    save_json(current_filepath, program)
-
-                    # Move file to "Error" folder
-                    move_file(current_filepath, os.path.join(LIST_ASTRO_DIR["ERROR_DIR"], filename))
-                    log.notice("----------------------")
-                    log.notice("----------------------")
-                    if (askBluetooth and fn_wait_for_user_input(60, "An error occuring during last Action, do you want to reconnect to bluetooth or continue ?\nThe program will contine if you don't press CTRL-C within 60 seconds:" ))  == 1:
-                        log.notice('continuing ....')
-                    elif askBluetooth:
-                        start_connection(True)
-                    else:
-                        log.notice('continuing ....')
-                    pass
-
-            # Log Ignore time
-            elif command.get('process', 'wait') == 'wait':
-                # Get current date and time
-                current_datetime = datetime.now()
-                command_datetime = get_time_to_execute(current_datetime, command)
-
-                # If the file isn't ready, log it based on the time since the last log
-                if filename not in last_logged:
-                    # Log the first time
-                    log_command_status(filename, command_datetime, first_time=True)
-                    last_logged[filename] = current_datetime
-                    last_hourly_log[filename] = current_datetime  # Initialize hourly log
-                else:
-                    # Check for hourly log
-                    if current_datetime - last_hourly_log[filename] >= timedelta(hours=1):
-                        log_command_status(filename, command_datetime, interval="Hourly")
-                        last_hourly_log[filename] = current_datetime  # Update last hourly log
-
-                    # Check for 30 minutes, 15 minutes, and 5 minutes before execution
-                    time_intervals = {
-                        '5 minutes': timedelta(minutes=5),
-                        '15 minutes': timedelta(minutes=15),
-                        '30 minutes': timedelta(minutes=30)
-                    }
-                    
-                    for interval, delta in time_intervals.items():
-                        # Check if the time until the command execution exceeds the interval
-                        if command_datetime - current_datetime <= delta:
-                            # Only log if we haven't logged this interval yet
-                            if filename not in last_logged or last_logged[filename] != interval:
-                                log_command_status(filename, command_datetime, interval)
-                                last_logged[filename] = interval  # Update last logged interval
-                            break  # Break to avoid logging multiple times for the same interval
+def describe_queue_entry(filename, entry):
+    due, _, priority, deadline = entry
+    return {"file": filename, "due": due.isoformat(), "priority": priority, "deadline": deadline.isoformat() if deadline else None}
+
+# Choose the due session to execute with the queue policy, the ones past their deadline are moved to Error
+# and the ones whose target is not visible are handled with the visibility policy
+# when several sessions are due, the decision is logged and written in the event log
+def pick_ready_session(session_queue, current_datetime):
+    while True:
+        filename = session_queue.peek_ready(current_datetime)
+        if filename is None:
+            return None
+        deadline = session_queue.get_entry(filename)[3]
+        if deadline is not None and deadline <= current_datetime:
+            entry = session_queue.pop(filename)
+            skip_session(filename, entry, "deadline", f"Deadline {deadline.strftime('%Y-%m-%d %H:%M:%S')} missed, the session has not been executed.")
+            continue
+        if check_session_visibility(session_queue, filename, current_datetime):
+            break
+
+    candidates = session_queue.get_ready(current_datetime)
+    if len(candidates) > 1:
+        picked = describe_queue_entry(filename, session_queue.get_entry(filename))
+        deferred = [describe_queue_entry(other, session_queue.get_entry(other)) for other in candidates if other != filename]
+        log.notice(f"Queue policy {session_queue.policy}: {filename} (priority {picked['priority']}, deadline {picked['deadline'] or 'none'}) "
+                   f"runs before {', '.join(entry['file'] for entry in deferred[:5])}{' ...' if len(deferred) > 5 else ''}")
+        emit_event("session_picked", device=get_device_label(), policy=session_queue.policy, picked=picked, deferred=deferred)
+    return filename
+
+# Visibility module when the visibility check is enabled (visibility_policy not off and site set), None otherwise
+# numpy is only loaded then, not at startup
+def get_visibility():
+    if scheduler_config.get_option("visibility_policy", "flag").lower() == "off" or scheduler_config.get_site() is None:
+        return None
+    import visibility
+    return visibility
+
+# Check that the target of a due session is above the horizon mask, visibility_policy in the [SCHEDULER] section of config.ini
+# return True if the session can be executed, False if it has been deferred or skipped
+def check_session_visibility(session_queue, filename, current_datetime):
+    visibility = get_visibility()
+    if visibility is None:
+        return True
+
+    context = get_scheduler_context()
+    todo_dir = context.list_astro_dir["TODO_DIR"]
+    if filename not in context.targets:
+        # queued while the check was disabled
+        cached = session_cache.peek(os.path.join(todo_dir, filename))
+        context.targets[filename] = visibility.get_target_coordinates(cached[0]) if cached else None
+    target = context.targets[filename]
+    if target is None:
+        return True
+    # the first check of the night computes the targets of all the queued sessions in one pass
+    state = visibility.visibility_engine.check(target, current_datetime, context.targets.values())
+    if state is None or state["visible"]:
+        return True
+
+    policy = visibility.get_visibility_policy()
+    entry = session_queue.get_entry(filename)
+    cached = session_cache.peek(os.path.join(todo_dir, filename))
+    uuid = cached[1].get('uuid') if cached and cached[1] else None
+    position = f"altitude {state['altitude']}° at azimuth {state['azimuth']}°, minimum {state['min_altitude']}°"
+    if policy == visibility.VISIBILITY_FLAG:
+        log.warning(f"The target of {filename} is below the horizon ({position}), the session is executed")
+        emit_event("session_flagged", uuid=uuid, device=get_device_label(context), reason="visibility", **state, **describe_queue_entry(filename, entry))
+        return True
+
+    session_queue.pop(filename)
+    if policy == visibility.VISIBILITY_DEFER:
+        window = visibility.visibility_engine.next_window(target, current_datetime, entry[3])
+        if window is not None:
+            log.notice(f"The target of {filename} is below the horizon ({position}), the session is deferred to {window.strftime('%Y-%m-%d %H:%M:%S')}")
+            # keep the execution time of the file to recognize it at the next scan
+            context.deferred[filename] = (context.deferred.get(filename, (entry[0],))[0], window)
+            session_queue.push(filename, window, entry[2], entry[3])
+            emit_event("session_deferred", uuid=uuid, device=get_device_label(context), reason="visibility", until=window.isoformat(),
+                       **state, **describe_queue_entry(filename, entry))
+            return False
+    skip_session(filename, entry, "visibility", f"Target below the horizon ({position}), the session has not been executed.")
+    return False
+
+# Move a due session to Error without executing it
+def skip_session(filename, entry, reason, message):
+    context = get_scheduler_context()
+    astro_dir = context.list_astro_dir
+    filepath = os.path.join(astro_dir["TODO_DIR"], filename)
+    log.warning(f"The file {filename} is skipped: {message}")
+
+    program, command, _, error = session_cache.get(filepath, parse_command_file)
+    session_cache.evict(filepath)
+    context.deferred.pop(filename, None)
+    context.targets.pop(filename, None)
+    if error is None:
+        program = update_process_status(copy.deepcopy(program), 'ended', False, message)
+    else:
+        program = None
+    transition_file(filepath, os.path.join(astro_dir["ERROR_DIR"], filename), program)
+    record_session_state(filename, "error", program)
+    count_session_transition(None, "error")
+    emit_event("session_skipped", uuid=command.get('uuid') if command else None, device=get_device_label(context),
+               reason=reason, **describe_queue_entry(filename, entry))
+
+# Log the waiting time of a file based on the time since the last log
+def log_waiting_command(filename, command_datetime, current_datetime):
+    context = get_scheduler_context()
+    last_logged = context.last_logged
+    last_hourly_log = context.last_hourly_log
+    if filename not in last_logged:
+        # Log the first time
+        log_command_status(filename, command_datetime, first_time=True)
+        last_logged[filename] = current_datetime
+        last_hourly_log[filename] = current_datetime  # Initialize hourly log
+    else:
+        # Check for hourly log
+        if current_datetime - last_hourly_log[filename] >= timedelta(hours=1):
+            log_command_status(filename, command_datetime, interval="Hourly")
+            last_hourly_log[filename] = current_datetime  # Update last hourly log
+
+        # Check for 30 minutes, 15 minutes, and 5 minutes before execution
+        time_intervals = {
+            '5 minutes': timedelta(minutes=5),
+            '15 minutes': timedelta(minutes=15),
+            '30 minutes': timedelta(minutes=30)
+        }
+
+        for interval, delta in time_intervals.items():
+            # Check if the time until the command execution exceeds the interval
+            if command_datetime - current_datetime <= delta:
+                # Only log if we haven't logged this interval yet
+                if filename not in last_logged or last_logged[filename] != interval:
+                    log_command_status(filename, command_datetime, interval)
+                    last_logged[filename] = interval  # Update last logged interval
+                break  # Break to avoid logging multiple times for the same interval
+
+# Execute the session of a ToDo file and move it to the Done or Error folder
+def execute_command_file(filename, askBluetooth = False):
+    context = get_scheduler_context()
+    astro_dir = context.list_astro_dir
+    filepath = os.path.join(astro_dir["TODO_DIR"], filename)
+    program, command, _, error = session_cache.get(filepath, parse_command_file)
+    if error is not None:
+        # the file changed since it has been queued
+        with context.lock:
+            update_queued_file(filename)
+        return
+    session_cache.evict(filepath)
+    # the cached program must not be modified
+    program = copy.deepcopy(program)
+    command = program['command']['id_command']
+    # the step timings of a previous run are kept only if the session resumes it
+    if not command.get('checkpoint'):
+        command.pop('timings', None)
+
+    log.notice("######################")
+    log.notice(f"Find File  {filename}, that is ready to execute")
+    log.debug(f"Executing command {command.get('uuid')}")
+
+    # Move to "Current" folder and update status
+    current_filepath = os.path.join(astro_dir["CURRENT_DIR"], filename)
+    program = update_process_status(program, 'pending')
+    if not transition_file(filepath, current_filepath, program):
+        return
+    record_session_state(filename, "current", program)
+    count_session_transition(None, "current")
+
+    # Remove from the logging dictionary as it's been executed
+    context.last_logged.pop(filename, None)
+    context.last_hourly_log.pop(filename, None)
+
+    dwarf_id = "2"
+    max_retries = int(program['command']['id_command'].get('max_retries', 3))
+    event_fields = {"uuid": command.get('uuid'), "device": get_device_label(context)}
+    emit_event("session_started", file=filename, description=command.get('description'), **event_fields)
+    start = time.monotonic()
+    # live state of the session, read and cancelled by the control API
+    current = {"filename": filename, "uuid": command.get('uuid'), "description": command.get('description'),
+               "program": program, "started": datetime.now(), "step": None, "step_description": None,
+               "step_started": None, "cancel": threading.Event()}
+
+    def on_progress(step, description):
+        current.update(step=step, step_description=description, step_started=datetime.now())
+
+    context.current = current
+    try:
+        with event_context(**event_fields):
+            # Get The Dwarf Type, from the config file of the device in a device worker
+            data_config = config_snapshot.get_config_data()
+            if data_config["dwarf_id"]:
+                dwarf_id = data_config['dwarf_id']
+            # Execute the session, the device lock is only held during each call to the dwarf
+            nb_try = retry_procedure(program, max_retries, lambda: save_json(current_filepath, program), on_progress, current["cancel"],
+                                     functools.partial(call_device, context))
+
+        # If successful, update process and result, a new run of this file starts from the beginning
+        program['command']['id_command'].pop('checkpoint', None)
+        program = update_process_status(program, 'ended', True, "Action completed successfully.", nb_try, dwarf_id)
+
+        # Move file to "Done" folder
+        transition_file(current_filepath, os.path.join(astro_dir["DONE_DIR"], filename), program)
+        record_session_state(filename, "done", program)
+        count_session_transition("current", "done")
+        emit_event("session_ended", result=True, nb_try=nb_try, duration=round(time.monotonic() - start, 1), **event_fields)
+
+    except Exception as e:
+        # Handle errors and update process and result
+        error_message = f"Error during execution: {e}"
+        log.error(error_message)
+
+        program = update_process_status(program, 'ended', False, error_message, max_retries, dwarf_id)
+
+        # Move file to "Error" folder
+        transition_file(current_filepath, os.path.join(astro_dir["ERROR_DIR"], filename), program)
+        record_session_state(filename, "error", program)
+        count_session_transition("current", "error")
+        emit_event("session_ended", result=False, message=error_message, duration=round(time.monotonic() - start, 1), **event_fields)
+        log.notice("----------------------")
+        log.notice("----------------------")
+        if isinstance(e, SessionCancelledError):
+            # cancelled by the user, the connection is fine
+            log.notice('continuing ....')
+        elif (askBluetooth and wait_for_user_input(60, "An error occuring during last Action, do you want to reconnect to bluetooth or continue ?\nThe program will contine if you don't press CTRL-C within 60 seconds:" ))  == 1:
+            log.notice('continuing ....')
+        elif askBluetooth:
+            start_connection(True)
+        else:
+            log.notice('continuing ....')
+        pass
+    finally:
+        context.current = None
+
+# Get the time to sleep before the next check
+def get_sleep_delay(next_due):
+    if next_due is None:
+        return MAX_SCHEDULER_SLEEP
+    delay = (next_due - datetime.now()).total_seconds()
+    return min(max(delay, 0), MAX_SCHEDULER_SLEEP)
+
+# Reconcile the interrupted transitions and the sessions stranded in the Current folder
+def recover_current_sessions():
+    policy = scheduler_config.get_option("recovery_policy", "requeue").lower()
+    max_age = scheduler_config.get_int_option("recovery_max_age", 120)
+    max_attempts = scheduler_config.get_int_option("recovery_max_attempts", 3)
+    try:
+        for filename, state, program in recover_sessions(get_scheduler_context().list_astro_dir, policy, max_age, max_attempts):
+            record_session_state(filename, state, program)
+    except Exception as e:
+        log.error(f"error during the recovery of the sessions - {e}")
+
+# Scheduler loop: wake up as soon as the ToDo directory changes or the next session is due
+# context is the state of the device scheduled by the loop, the default one if None
+def run_scheduler_loop(askBluetooth = False, is_running = lambda: True, context = None):
+    if context is not None:
+        scheduler_local.context = context
+    context = get_scheduler_context()
+    recover_current_sessions()
+    init_session_metrics(context)
+    device = get_device_label(context)
+    context.watcher = create_watcher(context.list_astro_dir["TODO_DIR"])
+    running_contexts.add(context)
+    try:
+        changes = None  # first check scans the whole ToDo folder
+        while is_running():
+            cycle_start = time.monotonic()
+            next_due = check_and_execute_commands(askBluetooth, changes)
+            metrics.observe("dwarf_scheduler_cycle_seconds", time.monotonic() - cycle_start, device=device)
+            metrics.set("dwarf_scheduler_next_due_timestamp_seconds", next_due.timestamp() if next_due else 0, device=device)
+            if not is_running():
+                break
+            changes = context.watcher.wait(get_sleep_delay(next_due))
+            if changes:
+                log.debug(f"Changes detected in ToDo directory: {', '.join(sorted(changes))}")
+    finally:
+        running_contexts.discard(context)
+        context.watcher.close()
+        context.watcher = None
+
+# Interrupt the wait of the scheduler loops, used to stop them quickly
+def wake_scheduler():
+    for context in list(running_contexts):
+        if context.watcher is not None:
+            context.watcher.wake()
+
+class DeviceWorker(threading.Thread):
+    """Scheduler loop of one configuration of the devices file."""
+    def __init__(self, config_name, stop_event):
+        super().__init__(name=f"scheduler-{config_name}", daemon=True)
+        self.context = SchedulerContext(config_name, get_list_astro_dir(config_name))
+        self.stop_event = stop_event
+
+    def run(self):
+        config_name = self.context.config_name
+        for dir_path in self.context.list_astro_dir.values():
+            os.makedirs(dir_path, exist_ok=True)
+        # the config reads of this thread use the config file of the device, not the active one
+        config_snapshot.use_config_file(get_config_file(config_name))
+
+        result = False
+        attempt = 0
+        while not result and attempt < 3 and not self.stop_event.is_set():
+            log.notice(f"{config_name}: try to connect to the dwarf")
+            with device_connection(self.context):
+                result = start_STA_connection()
+            attempt += 1
+        if not result:
+            log.error(f"{config_name}: can't connect to the Dwarf, the sessions of this device are not processed")
+            return
+
+        log.notice(f"{config_name}: waiting for Action files in {self.context.list_astro_dir['TODO_DIR']}")
+        log_handler = add_device_log_handler(config_name, self.name)
+        try:
+            run_scheduler_loop(False, lambda: not self.stop_event.is_set(), self.context)
+        except Exception as e:
+            log.error(f"{config_name}: scheduler stopped on error - {e}")
+        finally:
+            with device_connection(self.context):
+                perform_disconnect()
+            if log_handler is not None:
+                logging.getLogger().removeHandler(log_handler)
+                log_handler.close()
+
+class DeviceLogFilter(logging.Filter):
+    """Messages of the thread of a device worker and of the threads of its calls to the dwarf."""
+    def __init__(self, thread_name):
+        super().__init__()
+        self.thread_name = thread_name
+
+    def filter(self, record):
+        return record.threadName == self.thread_name or record.threadName.startswith(self.thread_name + "_")
+
+# The log file of dwarf_python_api is shared by the process (it keeps the messages of all the devices),
+# the messages of a device worker are also written in the log_file of its config, app_<config>.log by default
+def add_device_log_handler(config_name, thread_name):
+    if config_name == CONFIG_DEFAULT:
+        return None
+    try:
+        log_file = config_snapshot.get_config_data(get_config_file(config_name)).get('log_file')
+    except Exception as e:
+        log.debug(f"{config_name}: no log file - {e}")
+        return None
+    if not log_file or log_file == "False":
+        return None
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%y-%m-%d %H:%M:%S'))
+    handler.addFilter(DeviceLogFilter(thread_name))
+    logging.getLogger().addHandler(handler)
+    log.notice(f"{config_name}: messages of the device also written in {log_file}")
+    return handler
+
+# Run one scheduler worker per configuration in this process until CTRL+C
+def run_multi_device_scheduler(config_names):
+    stop_event = threading.Event()
+    workers = [DeviceWorker(config_name, stop_event) for config_name in config_names]
+    for worker in workers:
+        worker.start()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(1)
+    finally:
+        stop_event.set()
+        wake_scheduler()
+        for worker in workers:
+            # a running session is recovered at the next start
+            worker.join(5)
 
 
 def log_command_status(filename, command_datetime, interval=None, first_time=False):
@@ -344,7 +909,13 @@ def log_command_status(filename, command_datetime, interval=None, first_time=Fal
         log.notice("######################")
         log.notice(f"{interval} log:  {filename}, not yet ready, will execute not earlier than {command_datetime}")
 
+# Ask the user, the answer is awaited timeout seconds at most
+def wait_for_user_input(timeout, message):
+    from dwarf_python_api.get_live_data_dwarf import fn_wait_for_user_input
+    return fn_wait_for_user_input(timeout, message)
+
 def start_connection(startSTA = False, use_web_page = False):
+    from dwarf_python_api.lib.dwarf_utils import save_bluetooth_config_from_ini_file
 
     result = False
     if not save_bluetooth_config_from_ini_file():
@@ -356,9 +927,12 @@ def start_connection(startSTA = False, use_web_page = False):
         # python script running
         log.info("local bluetooth connection")
         if use_web_page:
+            from dwarf_ble_connect.connect_bluetooth import connect_bluetooth
             result = connect_bluetooth()
 
         else:
+            from dwarf_ble_connect.lib.connect_direct_bluetooth import connect_ble_dwarf_win
+            from dwarf_python_api.lib.dwarf_utils import read_bluetooth_ble_psd, read_bluetooth_ble_STA_ssid, read_bluetooth_ble_STA_pwd
             ble_psd = read_bluetooth_ble_psd() or "DWARF_12345678"
             ble_STA_ssid = read_bluetooth_ble_STA_ssid() or ""
             ble_STA_pwd = read_bluetooth_ble_STA_pwd() or ""
@@ -368,14 +942,15 @@ def start_connection(startSTA = False, use_web_page = False):
         # use external exe for bluetooth direct connection
         # code is no working in python 3.12 with CX_Freeze
         # need to use python 3.11 to build this as subprocess
+        import subprocess
         if use_web_page:
             subprocess.run(["extern\\connect_bluetooth.exe", "--web"])
         else:
-            dwarf_python_api.get_config_data.update_config_data( "ip", "", True)
+            config_snapshot.update_config_data( "ip", "", True)
             subprocess.run(["extern\\connect_bluetooth.exe"])
       
         # Parse the returned value
-        data_config = dwarf_python_api.get_config_data.get_config_data()
+        data_config = config_snapshot.get_config_data()
         dwarf_ip = data_config["ip"]
         result = True if dwarf_ip else False
 
@@ -387,12 +962,13 @@ def start_connection(startSTA = False, use_web_page = False):
         if result:
            perform_timezone()
     
+    metrics.inc("dwarf_connections_total", device=get_device_label(), method="bluetooth", result="ok" if result else "failed")
     return result
 
 def start_STA_connection(CheckDwarfId = False):
 
     result = False
-    data_config = dwarf_python_api.get_config_data.get_config_data()
+    data_config = config_snapshot.get_config_data()
     dwarf_ip = data_config["ip"]
     dwarf_id = data_config["dwarf_id"]
 
@@ -409,32 +985,43 @@ def start_STA_connection(CheckDwarfId = False):
         if result and CheckDwarfId:
             update_dwarf_data = update_get_config_data(dwarf_ip)
 
-            if update_dwarf_data['id'] != dwarf_id:
+            if update_dwarf_data is None:
+                # no answer within the HTTP timeouts, the dwarf type is unknown
+                log.error(f"Can't read the dwarf type on {dwarf_ip}, connection failed")
+                result = False
+            elif update_dwarf_data['id'] != dwarf_id:
                 log.success(f'Updated Dwarf Type to dwarf {update_dwarf_data["id"]}')
+    metrics.inc("dwarf_connections_total", device=get_device_label(), method="wifi", result="ok" if result else "failed")
     return result
 
+# Lifetime (s) of the cached answers of the dwarf and Stellarium, 0 to disable the cache
+def get_http_cache_ttl():
+    return scheduler_config.get_float_option("http_cache_ttl", 5)
+
 def get_default_params_config(IP):
     return f"http://{IP}:8082/getDefaultParamsConfig"
 
 def update_get_config_data(IPDwarf=None):
+    import requests
+    from http_client import get_http_client
     try:
         # Determine the request address
         request_addr = get_default_params_config(IPDwarf) if IPDwarf else None
         
         if request_addr:
-            # Make the HTTP GET request to the specified URL
-            response = requests.get(request_addr)
+            # Make the HTTP GET request to the specified URL, the answer is kept a few seconds
+            status_code, response_data = get_http_client("dwarf").get_json(request_addr, ttl=get_http_cache_ttl())
             
             # Check if the response has data
-            if response.status_code == 200 and 'data' in response.json():
-                data = response.json().get('data')
+            if status_code == 200 and isinstance(response_data, dict) and response_data.get('data'):
+                data = response_data.get('data')
                 new_id = data.get('id') 
                 name = data.get('name')
                 
                 print(f"ID: {new_id}")
                 print(f"Name: {name}")
 
-                dwarf_python_api.get_config_data.update_config_data( 'dwarf_id', new_id)
+                config_snapshot.update_config_data( 'dwarf_id', new_id)
 
                 return {'id': new_id, 'name': name}
             else:
@@ -451,6 +1038,9 @@ def update_get_config_data(IPDwarf=None):
 def main():
     try:
         start_bluetooth = False
+        multi_devices = False
+        simulation = False
+        simulation_dir = None
         dwarf_ip = None
         dwarf_id = None
 
@@ -470,6 +1060,16 @@ def main():
                     else:
                         log.error("Error: --id parameter requires an argument.")
                         sys.exit(1)
+                elif sys.argv[i] == "--multi":
+                    multi_devices = True
+                    log.notice("Read: --multi parameter")
+                elif sys.argv[i] == "--simulate":
+                    simulation = True
+                    # optional sessions directory of the simulation
+                    if i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith("--"):
+                        simulation_dir = sys.argv[i + 1]
+                        i += 1
+                    log.notice("Read: --simulate parameter")
                 elif sys.argv[i] == "--ip":
                     if i + 1 < len(sys.argv):
                         dwarf_ip = sys.argv[i + 1]
@@ -479,13 +1079,37 @@ def main():
                         log.error("Error: --ip parameter requires an argument.")
                         sys.exit(1)
                 i += 1
+
+            if simulation:
+                # simulated dwarf and virtual clock, the config of the dwarf is not modified
+                from session_simulator import run_simulation
+                run_simulation(simulation_dir, SESSIONS_DIR, config_to_dwarf_id_int(dwarf_id) if dwarf_id is not None else 2)
+                return
+
+            # the values given on the command line are written together
+            new_values = {}
             if dwarf_id:
-                dwarf_python_api.get_config_data.update_config_data( 'dwarf_id', dwarf_id)
+                new_values['dwarf_id'] = dwarf_id
             if dwarf_ip:
-                dwarf_python_api.get_config_data.update_config_data( 'ip', dwarf_ip)
+                new_values['ip'] = dwarf_ip
+            if new_values:
+                config_snapshot.update_config_values(new_values)
+
+        start_metrics_server()
+        # this module may run as __main__, the control API works on the running one
+        start_control_server(sys.modules[__name__])
+
+        if multi_devices:
+            # one worker per configuration, they must already be connected once with bluetooth
+            config_names = read_device_configs()
+            log.notice ("##--------------------------------------##")
+            log.notice (f"## Astro_Dwarf_Scheduler is starting for {', '.join(config_names)}")
+            log.notice ("##--------------------------------------##")
+            run_multi_device_scheduler(config_names)
+            return
 
         # test if Ip and Id is set
-        data_config = dwarf_python_api.get_config_data.get_config_data()
+        data_config = config_snapshot.get_config_data()
         if data_config["dwarf_id"]:
             dwarf_id = data_config['dwarf_id']
         if data_config["ip"]:
@@ -509,7 +1133,7 @@ def main():
             if start_bluetooth:
                 log.notice('starting bluetooth....')
                 result = start_connection(True)
-            elif (fn_wait_for_user_input(30, "Can't connect to the dwarf, do you want to reconnect to bluetooth or continue ?\nThe program will continue if you don't press CTRL-C within 30 seconds:" ))  == 1:
+            elif (wait_for_user_input(30, "Can't connect to the dwarf, do you want to reconnect to bluetooth or continue ?\nThe program will continue if you don't press CTRL-C within 30 seconds:" ))  == 1:
                 log.notice('continue ....')
                 result = True
             else:
@@ -521,16 +1145,15 @@ def main():
             log.notice ("## Astro_Dwarf_Scheduler is starting... ##")
             log.notice ("##--------------------------------------##")
             log.notice ("   Waiting for Action files...")
-            while True:
-                check_and_execute_commands(True)
-                time.sleep(10)
+            run_scheduler_loop(True)
         else:
              log.error("Can't connect to the Dwarf, process stop!")
     except KeyboardInterrupt:
         log.notice("Operation interrupted by the user (CTRL+C).")
         pass
     finally:
-        perform_disconnect()
+        if not simulation:
+            perform_disconnect()
 
 if __name__ == '__main__':
     main()
@@ -5,11 +5,11 @@ import threading
 from datetime import datetime
 import tkinter as tk
 from tkinter import messagebox, ttk
-from astro_dwarf_scheduler import check_and_execute_commands, start_connection, start_STA_connection, setup_new_config
+from astro_dwarf_scheduler import run_scheduler_loop, wake_scheduler, start_connection, start_STA_connection, setup_new_config
 from dwarf_python_api.lib.dwarf_utils import perform_disconnect, unset_HostMaster, set_HostMaster, start_polar_align, motor_action
 
-# import data for config.py
-import dwarf_python_api.get_config_data
+# import data for config.py, the parsed config is cached by config_snapshot
+import config_snapshot
 # The config value for dwarf_id is offset by -1 (stored as one less than the actual ID).
 # the value return by get_config_data must be used with these functions
 from dwarf_python_api.get_config_data import config_to_dwarf_id_int
@@ -25,6 +25,9 @@ from tabs import result_session
 
 # import directories
 from astro_dwarf_scheduler import CONFIG_DEFAULT, BASE_DIR, DEVICES_DIR, LIST_ASTRO_DIR_DEFAULT
+from scheduler_metrics import start_metrics_server
+from session_control import start_control_server
+import astro_dwarf_scheduler
 
 # Devices list file
 DEVICES_FILE = os.path.join(DEVICES_DIR, 'list_devices.txt')
@@ -232,7 +235,7 @@ class AstroDwarfSchedulerApp(tk.Tk):
 
     def force_stop_connect_bluetooth(self):
         # Read the config file and update the UI to Close
-        dwarf_python_api.get_config_data.update_config_data( "ui", "Close", True)
+        config_snapshot.update_config_data( "ui", "Close", True)
 
     def countdown(self, wait):
         '''
@@ -458,6 +461,7 @@ class AstroDwarfSchedulerApp(tk.Tk):
         self.stop_logHandler()
         if self.scheduler_running:
             self.scheduler_running = False
+            wake_scheduler()
             self.start_button.config(state=tk.NORMAL)
             self.stop_button.config(state=tk.DISABLED)
             self.unlock_button.config(state=tk.DISABLED)
@@ -511,9 +515,11 @@ class AstroDwarfSchedulerApp(tk.Tk):
                 result = start_STA_connection(not self.bluetooth_connected)
             if result:
                 self.log("Connected to the Dwarf")
-            while result and self.scheduler_running:
-                check_and_execute_commands()
-                time.sleep(10)  # Sleep for 10 seconds between checks
+            if result and self.scheduler_running:
+                start_metrics_server()
+                start_control_server(astro_dwarf_scheduler)
+                # Wake up on ToDo changes or when the next session is due
+                run_scheduler_loop(is_running=lambda: self.scheduler_running)
         except KeyboardInterrupt:
             self.log("Operation interrupted by the user.")
         finally:
@@ -561,7 +567,7 @@ class AstroDwarfSchedulerApp(tk.Tk):
         try:
 
             dwarf_id = "2"
-            data_config = dwarf_python_api.get_config_data.get_config_data()
+            data_config = config_snapshot.get_config_data()
             if data_config["dwarf_id"]:
                 dwarf_id = data_config['dwarf_id']
             dwarf_id_int = config_to_dwarf_id_int(dwarf_id)
@@ -0,0 +1,281 @@
+"""Benchmark of the scheduler scan, the results analysis and the UI data loaders.
+
+Synthetic Astro_Sessions trees are generated in a temporary directory for each size,
+the report gives the time, peak memory and filesystem calls of each scenario:
+
+    python benchmarks/bench_sessions.py --sizes 10,1000,100000 --output bench_report.json
+    python benchmarks/bench_sessions.py --baseline bench_report.json
+
+With --baseline, the scenarios slower than the baseline by more than --tolerance are listed
+and the exit code is 1.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+# part of the sessions in each folder, the others are in Done
+TODO_RATIO = 0.2
+ERROR_RATIO = 0.1
+SESSIONS_PER_NIGHT = 50
+
+# Filesystem events counted by the audit hook
+AUDIT_EVENTS = ("open", "os.listdir", "os.scandir", "os.rename", "os.remove", "shutil.move", "shutil.copyfile")
+
+audit_counts = {}
+audit_enabled = [False]
+
+def audit_hook(event, args):
+    if audit_enabled[0] and event in AUDIT_EVENTS:
+        audit_counts[event] = audit_counts.get(event, 0) + 1
+
+# read and write syscalls of the process, Linux only
+def read_io_counters():
+    try:
+        with open("/proc/self/io", "r") as file:
+            values = dict(line.split(":") for line in file if ":" in line)
+        return {"read": int(values["syscr"]), "write": int(values["syscw"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+def make_session(index, state, start):
+    date = start + timedelta(minutes=30 * index)
+    command = {
+        "id_command": {
+            "uuid": f"bench-{index:06d}",
+            "description": f"Benchmark session {index}",
+            "date": date.strftime("%Y-%m-%d"),
+            "time": date.strftime("%H:%M:%S"),
+            "process": "wait" if state == "todo" else "ended",
+            "max_retries": 2,
+        },
+        "calibration": {"do_action": index % 10 == 0, "wait_before": 10, "wait_after": 10},
+        "goto_solar": {"do_action": False, "target": "", "wait_after": 10},
+        "goto_manual": {"do_action": True, "target": f"Target {index}", "ra_coord": 10.5, "dec_coord": 41.2, "wait_after": 10},
+        "setup_camera": {"do_action": True, "exposure": "15", "gain": "80", "binning": "0", "IRCut": "1", "count": "100", "wait_after": 10},
+        "setup_wide_camera": {"do_action": False, "exposure": "10", "gain": "90", "count": "10", "wait_after": 10},
+    }
+    if state != "todo":
+        id_command = command["id_command"]
+        id_command["result"] = state == "done"
+        id_command["message"] = "Action completed successfully." if state == "done" else "Error during execution: Action failed at step: Perform Goto DSO target"
+        id_command["nb_try"] = 1
+        id_command["dwarf"] = "D3"
+        id_command["starting_date"] = date.strftime("%Y-%m-%d %H:%M:%S")
+        id_command["processed_date"] = (date + timedelta(minutes=28)).strftime("%Y-%m-%d %H:%M:%S")
+    return {"command": command}
+
+# Generate a sessions directory with size sessions in ToDo, Done and Error, and the templates of the Overview tab
+def generate_tree(sessions_dir, size):
+    import astro_dwarf_scheduler
+    dirs = astro_dwarf_scheduler.get_sessions_dirs(sessions_dir)
+    for key, path in dirs.items():
+        os.makedirs(path, exist_ok=True)
+
+    todo_count = int(size * TODO_RATIO)
+    error_count = int(size * ERROR_RATIO)
+    # the waiting sessions are far in the future so that the scan never executes them
+    future = datetime.now() + timedelta(days=365)
+    past = datetime.now() - timedelta(days=size // SESSIONS_PER_NIGHT + 1)
+    for index in range(size):
+        if index < todo_count:
+            state, folder, start = "todo", dirs["TODO_DIR"], future
+        elif index < todo_count + error_count:
+            state, folder, start = "error", dirs["ERROR_DIR"], past
+        else:
+            state, folder, start = "done", dirs["DONE_DIR"], past
+        with open(os.path.join(folder, f"session_{index:06d}.json"), "w") as file:
+            json.dump(make_session(index, state, start), file)
+
+    # templates listed by the Overview tab
+    for index in range(max(1, size // 10)):
+        with open(os.path.join(sessions_dir, f"template_{index:06d}.json"), "w") as file:
+            json.dump(make_session(index, "todo", future), file)
+    return dirs
+
+def set_sessions_dirs(dirs):
+    import astro_dwarf_scheduler
+    astro_dwarf_scheduler.LIST_ASTRO_DIR = dirs
+    astro_dwarf_scheduler.default_context.dirs = dirs
+    astro_dwarf_scheduler.LIST_ASTRO_DIR_DEFAULT["SESSIONS_DIR"] = dirs["SESSIONS_DIR"]
+
+# Run a scenario and measure its time, CPU time, peak Python memory and filesystem calls
+def measure(name, size, function):
+    audit_counts.clear()
+    io_before = read_io_counters()
+    tracemalloc.start()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    audit_enabled[0] = True
+    try:
+        details = function()
+        error = None
+    except Exception as e:
+        details = None
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        audit_enabled[0] = False
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    io_after = read_io_counters()
+
+    result = {
+        "scenario": name,
+        "sessions": size,
+        "seconds": round(seconds, 6),
+        "cpu_seconds": round(cpu_seconds, 6),
+        "peak_memory_kb": round(peak / 1024, 1),
+        "fs_calls": dict(sorted(audit_counts.items())),
+        "syscalls": {key: io_after[key] - io_before[key] for key in io_after} if io_before and io_after else None,
+    }
+    if details is not None:
+        result["details"] = details
+    if error is not None:
+        result["error"] = error
+    print(f"{name:28} {size:>7} sessions {seconds * 1000:10.1f} ms {peak / 1024:10.1f} KB"
+          f"{'  ' + error if error else ''}")
+    return result
+
+class ListboxRecorder:
+    """Listbox of the Overview tab, only counts the inserted items."""
+    def __init__(self):
+        self.count = 0
+
+    def delete(self, *args):
+        self.count = 0
+
+    def insert(self, *args):
+        self.count += 1
+
+def run_size(size, work_dir):
+    import astro_dwarf_scheduler
+
+    sessions_dir = os.path.join(work_dir, f"sessions_{size}")
+    print(f"Generating {size} sessions in {sessions_dir}")
+    dirs = generate_tree(sessions_dir, size)
+    set_sessions_dirs(dirs)
+    results = []
+
+    # scheduler: first scan parses every ToDo file, a rescan hits the cache, a cycle without change does nothing
+    def scheduler_check(changes=None):
+        astro_dwarf_scheduler.check_and_execute_commands(changes=changes)
+        return {"queued": len(astro_dwarf_scheduler.default_context.session_queue)}
+
+    astro_dwarf_scheduler.default_context.session_queue.clear()
+    results.append(measure("scheduler_first_scan", size, scheduler_check))
+    results.append(measure("scheduler_rescan", size, scheduler_check))
+    results.append(measure("scheduler_cycle", size, lambda: scheduler_check(set())))
+
+    try:
+        from tabs import result_session, overview_session
+    except ImportError as e:
+        print(f"UI loaders skipped: {e}")
+        return results
+
+    # results analysis of all the Done and Error sessions, it writes the Results CSVs
+    results.append(measure("analyze_files", size, lambda: result_session.analyze_files()))
+    results.append(measure("analyze_files_no_change", size, lambda: result_session.analyze_files()))
+
+    def load_all_results():
+        rows = 0
+        files = result_session.get_observation_files()
+        for filename in files:
+            ok_data, error_data = result_session.load_csv_data(filename)
+            rows += len(ok_data) + len(error_data)
+        return {"files": len(files), "rows": rows}
+    results.append(measure("load_csv_data", size, load_all_results))
+
+    def populate_overview():
+        listbox = ListboxRecorder()
+        overview_session.populate_json_list(listbox)
+        return {"items": listbox.count}
+    results.append(measure("overview_list", size, populate_overview))
+    return results
+
+# Scenarios slower than the baseline by more than tolerance (fraction)
+def compare_reports(report, baseline, tolerance):
+    previous = {(result["scenario"], result["sessions"]): result for result in baseline.get("results", [])}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get((result["scenario"], result["sessions"]))
+        if not old or "error" in result or not old.get("seconds"):
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append({"scenario": result["scenario"], "sessions": result["sessions"],
+                                "seconds": result["seconds"], "baseline_seconds": old["seconds"], "ratio": round(ratio, 2)})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the sessions scan, results analysis and UI loaders")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES), help="numbers of sessions, e.g. 10,1000,100000")
+    parser.add_argument("--output", default="bench_report.json", help="JSON report")
+    parser.add_argument("--baseline", help="previous JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown allowed against the baseline (fraction)")
+    parser.add_argument("--store", choices=["files", "sqlite"], default="files", help="session_store of the scheduler")
+    parser.add_argument("--keep", action="store_true", help="keep the generated directories")
+    parser.add_argument("--verbose", action="store_true", help="show the logs of the scheduler")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+
+    work_dir = tempfile.mkdtemp(prefix="bench_sessions_")
+    current_dir = os.getcwd()
+    # the scheduler reads config.ini in the current directory
+    os.chdir(work_dir)
+    with open("config.ini", "w") as file:
+        file.write(f"[SCHEDULER]\nsession_store = {args.store}\nevent_log = false\n")
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    sys.addaudithook(audit_hook)
+
+    results = []
+    try:
+        for size in sizes:
+            results.extend(run_size(size, work_dir))
+    finally:
+        os.chdir(current_dir)
+        if args.keep:
+            print(f"Generated directories kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "store": args.store,
+        "sizes": sizes,
+        "results": results,
+    }
+    if baseline is not None:
+        report["regressions"] = compare_reports(report, baseline, args.tolerance)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Report written in {output}")
+
+    if report.get("regressions"):
+        for regression in report["regressions"]:
+            print(f"Regression: {regression['scenario']} ({regression['sessions']} sessions) "
+                  f"{regression['seconds']:.4f}s instead of {regression['baseline_seconds']:.4f}s")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
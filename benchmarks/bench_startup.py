@@ -0,0 +1,137 @@
+"""Startup benchmark of the headless scheduler, based on python -X importtime.
+
+The scheduler module is imported in a new interpreter several times, the report gives
+the median import time, the slowest modules and the optional modules that were loaded:
+
+    python benchmarks/bench_startup.py --runs 10 --budget 500 --output bench_startup.json
+
+The exit code is 1 if the median import time is over --budget (ms) or if one of the
+modules imported lazily (bluetooth, HTTP client, asyncio, numpy) is loaded at startup.
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULE = "astro_dwarf_scheduler"
+DEFAULT_RUNS = 5
+# Import time budget (ms) of the scheduler module
+DEFAULT_BUDGET_MS = 500
+
+# Modules only needed by the bluetooth connection, the dwarf type check, the UI driver, the metrics endpoint or the visibility check
+LAZY_MODULES = ("dwarf_ble_connect", "bleak", "requests", "urllib3", "http_client", "asyncio", "http.server", "visibility", "numpy")
+
+CHILD_CODE = """
+import sys, json, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {lazy!r} if name in sys.modules]}}))
+"""
+
+# Parse the lines of -X importtime: self and cumulative time (us) and nesting of each module
+def parse_importtime(stderr):
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            modules.append({"module": name.strip(), "depth": (len(name) - len(name.lstrip())) // 2,
+                            "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+        except ValueError:
+            # header line
+            continue
+    return modules
+
+def run_once(module):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(path for path in (BASE_DIR, env.get("PYTHONPATH")) if path)
+    # no bytecode written: the runs must not depend on the previous ones
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    start = datetime.now()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD_CODE.format(module=module, lazy=LAZY_MODULES)],
+                             cwd=BASE_DIR, env=env, capture_output=True, text=True)
+    wall_seconds = (datetime.now() - start).total_seconds()
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else f"exit code {process.returncode}")
+    child = json.loads(process.stdout.strip().splitlines()[-1])
+    return {"seconds": child["seconds"], "wall_seconds": wall_seconds, "loaded": child["loaded"],
+            "modules": parse_importtime(process.stderr)}
+
+def get_module_imports(modules, module):
+    """Modules imported by module (it is the line after its imports)."""
+    for index, entry in enumerate(modules):
+        if entry["module"] == module and entry["depth"] == 0:
+            start = index
+            while start > 0 and modules[start - 1]["depth"] > 0:
+                start -= 1
+            return modules[start:index + 1]
+    return []
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark of the headless scheduler")
+    parser.add_argument("--module", default=DEFAULT_MODULE, help="module to import")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="number of interpreters started")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET_MS, help="import time budget (ms)")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest modules in the report")
+    parser.add_argument("--output", default="bench_startup.json", help="JSON report")
+    args = parser.parse_args()
+
+    runs = []
+    for index in range(max(1, args.runs)):
+        try:
+            runs.append(run_once(args.module))
+        except (RuntimeError, ValueError) as e:
+            print(f"Import of {args.module} failed: {e}")
+            sys.exit(2)
+        print(f"run {index + 1}: import {runs[-1]['seconds'] * 1000:8.1f} ms, process {runs[-1]['wall_seconds'] * 1000:8.1f} ms")
+
+    import_ms = statistics.median(run["seconds"] for run in runs) * 1000
+    wall_ms = statistics.median(run["wall_seconds"] for run in runs) * 1000
+    # the slowest modules of the last run, by their own import time
+    imports = get_module_imports(runs[-1]["modules"], args.module)
+    slowest = sorted(imports, key=lambda entry: entry["self_us"], reverse=True)[:args.top]
+    loaded = sorted(set(name for run in runs for name in run["loaded"]))
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "module": args.module,
+        "runs": len(runs),
+        "import_ms": round(import_ms, 1),
+        "process_ms": round(wall_ms, 1),
+        "budget_ms": args.budget,
+        "modules_imported": len(imports),
+        "slowest_modules": [{"module": entry["module"], "self_ms": round(entry["self_us"] / 1000, 2),
+                             "cumulative_ms": round(entry["cumulative_us"] / 1000, 2)} for entry in slowest],
+        "lazy_modules_loaded": loaded,
+    }
+    output = os.path.abspath(args.output)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(f"{args.module}: import {import_ms:.1f} ms (budget {args.budget:.0f} ms), process {wall_ms:.1f} ms, {len(imports)} modules")
+    for entry in report["slowest_modules"]:
+        print(f"  {entry['module']:40} {entry['self_ms']:8.2f} ms {entry['cumulative_ms']:8.2f} ms")
+    print(f"Report written in {output}")
+
+    failed = False
+    if import_ms > args.budget:
+        print(f"Over budget: {import_ms:.1f} ms instead of {args.budget:.0f} ms")
+        failed = True
+    if loaded:
+        print(f"Modules loaded at startup instead of on first use: {', '.join(loaded)}")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
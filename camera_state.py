@@ -0,0 +1,69 @@
+import time
+import threading
+
+import scheduler_config
+
+class CameraState:
+    """Last known camera settings of a dwarf, with the values given to perform_update_camera_setting.
+
+    A value read from the dwarf is confirmed, a written value is pending until it is read back.
+    The confirmed values are trusted for camera_state_max_age minutes ([SCHEDULER] of config.ini),
+    the dwarf can be changed by another application in the meantime.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.settings = {}  # setting -> (value, confirmed)
+        self.confirmed_time = None
+
+    def is_valid(self):
+        max_age = scheduler_config.get_float_option("camera_state_max_age", 10) * 60
+        with self.lock:
+            return self.confirmed_time is not None and time.monotonic() - self.confirmed_time <= max_age
+
+    def matches(self, setting, value):
+        """Return True if the setting is confirmed with this value on the dwarf."""
+        if not self.is_valid():
+            return False
+        with self.lock:
+            return self.settings.get(setting) == (str(value), True)
+
+    def set_written(self, setting, value):
+        with self.lock:
+            self.settings[setting] = (str(value), False)
+
+    def forget(self, setting):
+        with self.lock:
+            self.settings.pop(setting, None)
+
+    def has_pending(self):
+        with self.lock:
+            return any(not confirmed for _, confirmed in self.settings.values())
+
+    def get_pending(self):
+        """Return the written settings not read back yet."""
+        with self.lock:
+            return {setting: value for setting, (value, confirmed) in self.settings.items() if not confirmed}
+
+    def set_read(self, values):
+        """Update the state with the settings read from the dwarf."""
+        with self.lock:
+            for setting, value in values.items():
+                self.settings[setting] = (str(value), True)
+            # a setting written but not read back stays unknown
+            self.settings = {setting: entry for setting, entry in self.settings.items() if entry[1]}
+            self.confirmed_time = time.monotonic()
+
+    def invalidate(self):
+        with self.lock:
+            self.settings = {}
+            self.confirmed_time = None
+
+camera_states = {}  # dwarf (ip) -> CameraState
+camera_states_lock = threading.Lock()
+
+def get_camera_state(device):
+    with camera_states_lock:
+        state = camera_states.get(device)
+        if state is None:
+            state = camera_states[device] = CameraState()
+    return state
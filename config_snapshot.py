@@ -0,0 +1,119 @@
+import os
+import threading
+
+import dwarf_python_api.get_config_data
+
+import dwarf_python_api.lib.my_logger as log
+
+# Config file of dwarf_python_api used before any set_config_data
+DEFAULT_CONFIG_FILE = 'config.py'
+
+class ConfigSnapshots:
+    """Parsed config files of dwarf_python_api, one snapshot per configuration.
+
+    A snapshot is valid while (mtime_ns, size) of its file are unchanged, the writes made
+    through update_config_values invalidate it at once. The lock serializes the reads and
+    writes of the config files of the process.
+    A thread can read the config file of its device instead of the active one (use_file).
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.active_file = DEFAULT_CONFIG_FILE
+        self.local = threading.local()
+        self.snapshots = {}  # config file -> (identity, data)
+        self.hits = 0
+        self.misses = 0
+
+    def activate(self, config_file, config_file_tmp, lock_file, print_log=False):
+        with self.lock:
+            dwarf_python_api.get_config_data.set_config_data(
+                config_file=config_file,
+                config_file_tmp=config_file_tmp,
+                lock_file=lock_file,
+                print_log=print_log
+            )
+            self.active_file = config_file
+
+    def use_file(self, config_file):
+        """Config file read by get() in the calling thread, None for the active one."""
+        self.local.config_file = config_file
+
+    def get(self, config_file=None):
+        """Return a copy of the config data of config_file, the config file of the thread or the active one by default."""
+        config_file = config_file or getattr(self.local, "config_file", None)
+        with self.lock:
+            filename = config_file or self.active_file
+            identity = get_file_identity(filename)
+            snapshot = self.snapshots.get(filename)
+            if identity is not None and snapshot is not None and snapshot[0] == identity:
+                self.hits += 1
+                return dict(snapshot[1])
+            self.misses += 1
+
+            if config_file:
+                data = dwarf_python_api.get_config_data.get_config_data(config_file)
+            else:
+                data = dwarf_python_api.get_config_data.get_config_data()
+            # a missing file is not cached, it is read again on the next call
+            if identity is not None:
+                self.snapshots[filename] = (identity, dict(data))
+            return data
+
+    def update(self, values, print_log=False):
+        """Write the changed values of the active configuration in one locked batch."""
+        with self.lock:
+            try:
+                current = self.get()
+            except Exception as e:
+                log.debug(f"config not read before the update - {e}")
+                current = {}
+            changes = {key: value for key, value in values.items() if str(current.get(key)) != str(value)}
+            try:
+                for key, value in changes.items():
+                    dwarf_python_api.get_config_data.update_config_data(key, value, print_log)
+            finally:
+                if changes:
+                    self.invalidate(self.active_file)
+            return changes
+
+    def invalidate(self, config_file=None):
+        with self.lock:
+            if config_file is None:
+                self.snapshots.clear()
+            else:
+                self.snapshots.pop(config_file, None)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.snapshots), "hits": self.hits, "misses": self.misses}
+
+def get_file_identity(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+config_snapshots = ConfigSnapshots()
+
+# Make a config file the active one of dwarf_python_api
+def set_config_data(config_file, config_file_tmp, lock_file, print_log=False):
+    config_snapshots.activate(config_file, config_file_tmp, lock_file, print_log)
+
+# Config file of the device of the calling thread read by get_config_data, None for the active one
+def use_config_file(config_file):
+    config_snapshots.use_file(config_file)
+
+# Config data of the active configuration (or of config_file, or of the thread), parsed again only when the file changed
+def get_config_data(config_file=None):
+    return config_snapshots.get(config_file)
+
+def update_config_data(key, value, print_log=False):
+    return config_snapshots.update({key: value}, print_log)
+
+# Write several values of the active configuration at once, the unchanged ones are not written
+def update_config_values(values, print_log=False):
+    return config_snapshots.update(values, print_log)
+
+def invalidate_config_data(config_file=None):
+    config_snapshots.invalidate(config_file)
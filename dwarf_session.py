@@ -1,9 +1,16 @@
 import json
+import functools
 
 import configparser
 import time
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 from datetime import datetime
+from fractions import Fraction
 
 from dwarf_python_api.lib.dwarf_utils import perform_GoLive
 from dwarf_python_api.lib.dwarf_utils import perform_calibration
@@ -29,8 +36,8 @@ from dwarf_python_api.lib.data_utils import get_gain_name_by_index
 from dwarf_python_api.lib.data_wide_utils import get_wide_exposure_name_by_index
 from dwarf_python_api.lib.data_wide_utils import get_wide_gain_name_by_index
 
-# import data for config.py
-import dwarf_python_api.get_config_data
+# import data for config.py, the parsed config is cached by config_snapshot
+import config_snapshot
 
 # The config value for dwarf_id is offset by -1 (stored as one less than the actual ID).
 # the value return by get_config_data must be used with these functions
@@ -38,6 +45,13 @@ from dwarf_python_api.get_config_data import config_to_dwarf_id_str, config_to_d
 
 import dwarf_python_api.lib.my_logger as log
 
+import scheduler_config
+
+from camera_state import get_camera_state
+from session_policy import SESSION_POLICY, SessionFatalError, SessionCancelledError, SessionDeadlineError, get_session_policies
+from scheduler_metrics import metrics
+from session_events import emit_event
+
 def select_solar_target (target):
    
     target_id = None
@@ -100,6 +114,11 @@ STEP_DESCRIPTIONS = {
     "step_15": "Wait End of Astro wide photo Session",
 }
 
+# Actions yielded by the steps of a session, timeout (s) is None for a call without deadline,
+# a wait without step is counted in the step of the previous call
+SessionCall = namedtuple("SessionCall", ["step", "function", "args", "timeout"], defaults=[None])
+SessionWait = namedtuple("SessionWait", ["seconds", "step"], defaults=[None])
+
 def try_attemps (function, function_succeed_message, max_attempts = 3):
     # Try to perform the action up to 3 times by default
     max_attempts
@@ -123,9 +142,306 @@ def try_attemps (function, function_succeed_message, max_attempts = 3):
 
     return continue_action
 
-def start_dwarf_session(program, type_dwarf = 2):
+# Call a function of the dwarf with the retry policy of its step:
+# a False result or a transient error is retried after a backoff wait until the attempts or the deadline are exhausted,
+# a fatal error stops the session at once, as a call without answer at the deadline (it is still running)
+def run_step(policies, step, function, *args):
+    policy = policies.get(step)
+    description = STEP_DESCRIPTIONS.get(step, step)
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        timeout = None
+        if policy.deadline is not None:
+            timeout = max(policy.deadline - (time.monotonic() - start), 0.1)
+
+        error = None
+        try:
+            result = yield SessionCall(step, function, args, timeout)
+            if result is not False:
+                return result
+        except Exception as e:
+            if policy.is_fatal(e):
+                log.error(f"Fatal error at step: {description} - {e}")
+                raise SessionFatalError(f"{description}: {e}") from e
+            error = e
+            result = False
+
+        if attempt >= policy.attempts:
+            if attempt > 1:
+                log.notice(f"Action failed after {attempt} attempts.")
+            if error is not None:
+                raise error
+            return result
+
+        delay = policy.get_delay(attempt)
+        if policy.deadline is not None and time.monotonic() - start + delay >= policy.deadline:
+            log.notice(f"Deadline of {policy.deadline}s reached at step: {description}")
+            if error is not None:
+                raise error
+            return result
+
+        log.notice(f"Attempt {attempt} failed{f' ({error})' if error else ''}. Retrying in {delay:.1f}s...")
+        metrics.inc("dwarf_step_retries_total", step=step)
+        emit_event("retry", step=step, attempt=attempt, delay=round(delay, 1), error=str(error) if error else None)
+        yield SessionWait(delay, step)
+
+# Last session started on each dwarf (by ip) since the start of the program
+device_sessions = {}
+
+# Setup steps of a session a following session on the same target can skip,
+# go live (step_1a) closes the imaging session of the previous capture and is always sent
+SETUP_STEPS = ["step_1b", "step_1c", "step_1d", "step_7", "step_8", "step_9"]
+
+# Camera settings steps with the capture step using them: they run again on resume while the capture is not done,
+# the camera settings are unknown after an error or a restart (a setting the dwarf already has is not sent again)
+CAMERA_STEPS = {"step_10": "step_12", "step_13": "step_15"}
+
+# Last session ended successfully on each dwarf (by ip): key, description, target, setup steps done and end time
+device_setups = {}
+
+# Get the target of a session command, None if it has no goto
+def get_session_target(command):
+    goto_manual = command.get('goto_manual', {})
+    if goto_manual.get('do_action'):
+        try:
+            return ("manual", round(float(goto_manual.get('ra_coord')), 4), round(float(goto_manual.get('dec_coord')), 4))
+        except (TypeError, ValueError):
+            return ("manual", str(goto_manual.get('ra_coord')), str(goto_manual.get('dec_coord')))
+    goto_solar = command.get('goto_solar', {})
+    if goto_solar.get('do_action') and goto_solar.get('target'):
+        return ("solar", goto_solar['target'].lower())
+    return None
+
+def get_session_key(id_command):
+    return f"{id_command.get('uuid', '')}-{id_command.get('date', '')} {id_command.get('time', '')}"
+
+class SessionCheckpoint:
+    """Completed steps of a session, saved in id_command.checkpoint.
+
+    A retry or a restart after a crash skips the completed steps if the dwarf state is
+    still valid: same dwarf, checkpoint younger than resume_max_age minutes and no other
+    session started on the dwarf since.
+    on_save() is called to persist the session after each completed step.
+    """
+    def __init__(self, command, dwarf_id, dwarf_ip, on_save=None):
+        self.id_command = command.setdefault('id_command', {})
+        self.on_save = on_save
+        self.session_key = get_session_key(self.id_command)
+        self.dwarf = "D" + config_to_dwarf_id_str(dwarf_id)
+        self.dwarf_ip = dwarf_ip
+
+        policy = get_session_policies(command).get(SESSION_POLICY)
+        self.steps = self.load_steps(policy)
+        if self.steps:
+            log.notice(f"Resuming the session, steps already done: {', '.join(self.steps)}")
+        else:
+            self.steps = self.get_coalesced_steps(command)
+        device_sessions[dwarf_ip] = self.session_key
+        self.save()
+
+    def load_steps(self, policy):
+        checkpoint = self.id_command.get('checkpoint')
+        if not isinstance(checkpoint, dict) or not checkpoint.get('steps'):
+            return []
+        if not policy.resume:
+            log.notice("Checkpoint ignored: the session restarts from the beginning (resume policy)")
+            return []
+        if checkpoint.get('dwarf') != self.dwarf or checkpoint.get('ip') != self.dwarf_ip:
+            log.notice("Checkpoint ignored: it has been done on another dwarf")
+            return []
+        if device_sessions.get(self.dwarf_ip, self.session_key) != self.session_key:
+            log.notice("Checkpoint ignored: another session has run on the dwarf since")
+            return []
+        try:
+            updated = datetime.strptime(checkpoint.get('updated', ''), "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return []
+        if (datetime.now() - updated).total_seconds() > policy.resume_max_age * 60:
+            log.notice(f"Checkpoint ignored: older than {policy.resume_max_age:g} minutes")
+            return []
+        steps = list(checkpoint['steps'])
+        camera_steps = [step for step, capture in CAMERA_STEPS.items() if step in steps and capture not in steps]
+        if camera_steps:
+            log.notice(f"Camera settings sent again: {', '.join(camera_steps)}")
+        return [step for step in steps if step not in camera_steps]
+
+    def get_coalesced_steps(self, command):
+        """Return the setup steps done by the previous session if this session follows it on the same target."""
+        if not scheduler_config.get_bool_option("coalesce_sessions", True):
+            return []
+        setup = device_setups.get(self.dwarf_ip)
+        target = get_session_target(command)
+        if setup is None or target is None or setup["target"] != target:
+            return []
+        # no other session on the dwarf since and not too long ago
+        if device_sessions.get(self.dwarf_ip) != setup["session"]:
+            return []
+        max_gap = scheduler_config.get_float_option("coalesce_max_gap", 10)
+        if (datetime.now() - setup["ended"]).total_seconds() > max_gap * 60:
+            return []
+        steps = [step for step in setup["steps"] if step in SETUP_STEPS]
+        if steps:
+            log.notice(f"Session coalesced with the previous session ({setup['description']}) on the same target")
+            log.notice(f"    the dwarf stays on target, setup steps skipped: {', '.join(steps)}")
+            self.id_command['coalesced_with'] = setup["session"]
+        return steps
+
+    def ended(self, command):
+        """Record the setup of the dwarf at the end of a successful session."""
+        device_setups[self.dwarf_ip] = {
+            "session": self.session_key,
+            "description": self.id_command.get('description', ''),
+            "target": get_session_target(command),
+            "steps": [step for step in self.steps if step in SETUP_STEPS],
+            "ended": datetime.now(),
+        }
+
+    def save(self):
+        self.id_command['checkpoint'] = {
+            "session": self.session_key,
+            "dwarf": self.dwarf,
+            "ip": self.dwarf_ip,
+            "steps": list(self.steps),
+            "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if self.on_save:
+            try:
+                self.on_save()
+            except Exception as e:
+                log.error(f"error saving the checkpoint of the session - {e}")
+
+    def skip(self, step):
+        """Return True if the step has been completed by a previous attempt."""
+        if step in self.steps:
+            log.notice(f"Already done, skipped: {STEP_DESCRIPTIONS.get(step, step)}")
+            return True
+        return False
+
+    def complete(self, step):
+        if step not in self.steps:
+            self.steps.append(step)
+            self.save()
+
+# Time saved (s) by the readiness polling on the fixed waits, per step since the start of the program
+wait_savings = {}
+
+# Wait until predicate() returns True, at most timeout seconds: the fixed wait of timeout seconds is replaced by
+# a polling of the dwarf every interval seconds (readiness_polling option), return True if the state is reached
+# saved is the dict of the session where the time saved per step is added
+def wait_until(step, predicate, timeout, interval = 0.5, saved = None):
+    if not scheduler_config.get_bool_option("readiness_polling", True):
+        yield SessionWait(timeout, step)
+        try:
+            ready = yield SessionCall(step, predicate, ())
+        except Exception as e:
+            log.debug(f"readiness check failed: {e}")
+            ready = False
+        return bool(ready)
+
+    # readiness_interval overrides the interval of the caller if it is set
+    interval = scheduler_config.get_float_option("readiness_interval", interval)
+    start = time.monotonic()
+    while True:
+        try:
+            ready = yield SessionCall(step, predicate, ())
+        except Exception as e:
+            log.debug(f"readiness check failed: {e}")
+            ready = False
+        elapsed = time.monotonic() - start
+        if ready:
+            gain = max(timeout - elapsed, 0)
+            log.debug(f"Ready after {elapsed:.1f}s instead of {timeout}s: {STEP_DESCRIPTIONS.get(step, step)}")
+            count, total = wait_savings.get(step, (0, 0.0))
+            wait_savings[step] = (count + 1, total + gain)
+            if saved is not None:
+                saved[step] = saved.get(step, 0.0) + gain
+            return True
+        if elapsed >= timeout:
+            log.notice(f"Not ready after {timeout}s, continuing: {STEP_DESCRIPTIONS.get(step, step)}")
+            return False
+        yield SessionWait(min(interval, timeout - elapsed), step)
+
+# The dwarf answers again after a command
+def device_ready():
+    return bool(perform_get_all_camera_setting())
+
+# Settle wait after a command whose end the dwarf API does not report (stop goto, start of the capture):
+# the settle time (option, seconds) is always waited, then the dwarf must answer. It is not a readiness state,
+# so the wait is not shortened and no time saved is recorded
+def wait_settled(step, option, default):
+    seconds = scheduler_config.get_float_option(option, default)
+    yield SessionWait(seconds, step)
+    try:
+        ready = yield SessionCall(step, device_ready, ())
+    except Exception as e:
+        log.debug(f"readiness check failed: {e}")
+        ready = False
+    if not ready:
+        log.notice(f"No answer of the dwarf after {seconds}s, continuing: {STEP_DESCRIPTIONS.get(step, step)}")
+    return bool(ready)
+
+# Duration (s) of the exposures of a capture, 0 if the count or the exposure is not set in the session
+def get_capture_seconds(count, exposure):
     try:
-        data_config = dwarf_python_api.get_config_data.get_config_data()
+        return max(int(count or 0), 0) * float(Fraction(str(exposure)))
+    except (TypeError, ValueError, ZeroDivisionError):
+        return 0.0
+
+# Wait of the end of a capture started capture_seconds ago at most:
+# the exposures are waited without calling the dwarf, the dwarf call waiting the end of the capture is made
+# capture_end_margin seconds before it, so the device lock is not held during the capture and the other devices run
+def wait_capture_end(policies, step, wait_function, capture_seconds):
+    margin = scheduler_config.get_float_option("capture_end_margin", 30)
+    if capture_seconds > margin:
+        log.notice(f"Capture of {capture_seconds:.0f}s, end awaited from the dwarf in {capture_seconds - margin:.0f}s")
+        yield SessionWait(capture_seconds - margin, step)
+    return (yield from run_step(policies, step, wait_function))
+
+# The written camera settings are read back with their values, the settings read are logged at debug level
+def camera_settings_applied(camera, read_function, expected):
+    read_function(camera, verbose=False)
+    return all(camera.matches(setting, value) for setting, value in expected.items())
+
+# Update a camera setting, not sent if the dwarf is known to have this value already
+def update_camera_setting(policies, step, camera, setting, value, *args):
+    if camera.matches(setting, value):
+        log.notice(f"    {setting} is already {value}, not sent")
+        return True
+    result = yield from run_step(policies, step, perform_update_camera_setting, setting, value, *args)
+    if result is False:
+        camera.forget(setting)
+    else:
+        camera.set_written(setting, value)
+    return result
+
+# Read the camera settings of the dwarf if they are not known
+def seed_camera_state(policies, step, camera, read_function):
+    if not camera.is_valid():
+        yield from run_step(policies, step, read_function, camera)
+
+# Check the written settings until they are read back, nothing to check if no setting has been sent
+def check_camera_state(step, camera, read_function, saved = None):
+    if not camera.has_pending():
+        log.notice("    Camera settings confirmed, no check needed")
+        return
+    expected = camera.get_pending()
+    applied = functools.partial(camera_settings_applied, camera, read_function, expected)
+    if (yield from wait_until(step, applied, 5, 1, saved)):
+        log.notice(f"    Camera settings confirmed by the dwarf: {expected}")
+    else:
+        log.warning(f"    Camera settings not confirmed by the dwarf: {expected}")
+
+# Steps of a session: generator yielding the calls to the dwarf and the waits,
+# the result of a call is sent back to the generator by the runner
+# on_checkpoint() is called to save the session when a step is completed
+def session_steps(program, on_checkpoint = None):
+    policies = get_session_policies(program)
+    camera = None
+    saved = {}  # time saved per step by the readiness polling
+    try:
+        data_config = config_snapshot.get_config_data()
         dwarf_id = "2"
         if data_config["dwarf_id"]:
             dwarf_id = data_config['dwarf_id']
@@ -134,6 +450,9 @@ def start_dwarf_session(program, type_dwarf = 2):
         if data_config["ip"]:
             dwarf_ip = data_config['ip']
 
+        # known camera settings of the dwarf
+        camera = get_camera_state(dwarf_ip)
+
         dump_json = json.dumps(program, indent=4)
 
         log.notice("######################")
@@ -222,91 +541,103 @@ def start_dwarf_session(program, type_dwarf = 2):
         log.notice("######################")
         #init Frame : TIME
         # Try to perform the action up to 3 times
-        continue_action = try_attemps (perform_time, "Init succeeded.")
+        continue_action = yield from run_step(policies, "step_0", perform_time)
+        if continue_action:
+            log.notice("Init succeeded.")
             
         verify_action(continue_action, "step_0")
 
+        # Completed steps of the previous attempts, each block of steps is skipped if already done
+        checkpoint = SessionCheckpoint(program, dwarf_id, dwarf_ip, on_checkpoint)
+
         # Checking update actions
-        continue_action = perform_GoLive()
-        verify_action(continue_action, "step_1a")
+        if not checkpoint.skip("step_1a"):
+            continue_action = yield from run_step(policies, "step_1a", perform_GoLive)
+            verify_action(continue_action, "step_1a")
+            checkpoint.complete("step_1a")
 
-        if auto_focus:
+        if auto_focus and not checkpoint.skip("step_1c"):
             wait_before = program.get('auto_focus', {}).get('wait_before', 0)
-            time.sleep(wait_before)
+            yield SessionWait(wait_before, "step_1c")
             log.notice("Processing automatic autofocus")
-            continue_action = perform_start_autofocus(False)
+            continue_action = yield from run_step(policies, "step_1c", perform_start_autofocus, False)
             verify_action(continue_action, "step_1c")
             wait_after = program.get('auto_focus', {}).get('wait_after', 0)
-            time.sleep(wait_after)
+            yield SessionWait(wait_after, "step_1c")
+            checkpoint.complete("step_1c")
 
-        if infinite_focus:
+        if infinite_focus and not checkpoint.skip("step_1d"):
             wait_before = program.get('infinite_focus', {}).get('wait_before', 0)
-            time.sleep(wait_before)
+            yield SessionWait(wait_before, "step_1d")
             log.notice("Processing infinite autofocus")
-            continue_action = perform_start_autofocus(True)
+            continue_action = yield from run_step(policies, "step_1d", perform_start_autofocus, True)
             verify_action(continue_action, "step_1d")
             wait_after = program.get('infinite_focus', {}).get('wait_after', 0)
-            time.sleep(wait_after)
+            yield SessionWait(wait_after, "step_1d")
+            checkpoint.complete("step_1d")
 
         # Execution of specific actions
-        if eq_solving:
-            continue_action = perform_stop_goto()
+        if eq_solving and not checkpoint.skip("step_1b"):
+            continue_action = yield from run_step(policies, "step_6", perform_stop_goto)
             verify_action(continue_action, "step_6")
-            time.sleep(5)
+            yield from wait_settled("step_6", "goto_settle_time", 5)
 
             wait_before = program.get('eq_solving', {}).get('wait_before', 0)
-            time.sleep(wait_before)
+            yield SessionWait(wait_before, "step_1b")
             log.notice("Processing EQ Solving")
-            continue_action = start_polar_align()
+            continue_action = yield from run_step(policies, "step_1b", start_polar_align)
             verify_action(continue_action, "step_1b")
             wait_after = program.get('eq_solving', {}).get('wait_after', 0)
-            time.sleep(wait_after)
+            yield SessionWait(wait_after, "step_1b")
+            checkpoint.complete("step_1b")
 
-        if calibration:
+        if calibration and not checkpoint.skip("step_7"):
             log.notice("Processing Calibration")
+            yield from seed_camera_state(policies, "step_2", camera, print_camera_data)
             log.notice("    Set Exposure to 1s")
-            continue_action = perform_update_camera_setting("exposure", "1", config_to_dwarf_id_str(dwarf_id))
+            continue_action = yield from update_camera_setting(policies, "step_2", camera, "exposure", "1", config_to_dwarf_id_str(dwarf_id))
             verify_action(continue_action, "step_2")
 
             log.notice("    Set Gain to 80")
-            continue_action = perform_update_camera_setting("gain", "80", config_to_dwarf_id_str(dwarf_id))
+            continue_action = yield from update_camera_setting(policies, "step_3", camera, "gain", "80", config_to_dwarf_id_str(dwarf_id))
             verify_action(continue_action, "step_3")
 
             if config_to_dwarf_id_str(dwarf_id) == "3":
                 log.notice("    Set IR to Astro Filter")
             else:
                 log.notice("    Set IR to IR_PASS")
-            continue_action = perform_update_camera_setting("IR", "1")
+            continue_action = yield from update_camera_setting(policies, "step_4", camera, "IR", "1")
             verify_action(continue_action, "step_4")
 
             log.notice("    Set Binning to 4k")
-            continue_action = perform_update_camera_setting("binning", "0")
+            continue_action = yield from update_camera_setting(policies, "step_5", camera, "binning", "0")
             verify_action(continue_action, "step_5")
 
             # check value
-            time.sleep(5)
-            print_camera_data()
+            yield from check_camera_state("step_5", camera, print_camera_data, saved)
 
-            continue_action = perform_stop_goto()
+            continue_action = yield from run_step(policies, "step_6", perform_stop_goto)
             verify_action(continue_action, "step_6")
-            time.sleep(5)
+            yield from wait_settled("step_6", "goto_settle_time", 5)
 
             log.notice("Starting Calibration")
             wait_before = program.get('calibration', {}).get('wait_before', 0)
-            time.sleep(wait_before)
-            continue_action = perform_calibration()
+            yield SessionWait(wait_before, "step_7")
+            continue_action = yield from run_step(policies, "step_7", perform_calibration)
             verify_action(continue_action, "step_7")
             wait_after = program.get('calibration', {}).get('wait_after', 0)
-            time.sleep(wait_after)
+            yield SessionWait(wait_after, "step_7")
+            checkpoint.complete("step_7")
 
-        if goto_solar:
+        if goto_solar and not checkpoint.skip("step_8"):
             log.notice(f"Processing Goto Solar System : {target_name}")
-            continue_action = select_solar_target(target_name)
+            continue_action = yield from run_step(policies, "step_8", select_solar_target, target_name)
             wait_after = program.get('goto_solar', {}).get('wait_after', 0)
-            time.sleep(wait_after)
+            yield SessionWait(wait_after, "step_8")
             verify_action(continue_action, "step_8")
+            checkpoint.complete("step_8")
 
-        if goto_manual:
+        if goto_manual and not checkpoint.skip("step_9"):
             log.notice(f"Processing Goto : {target_name}")
             try:
                 decimal_RA = float(manual_RA)
@@ -318,76 +649,302 @@ def start_dwarf_session(program, type_dwarf = 2):
             except ValueError:
                 decimal_Dec = parse_dec_to_float(manual_declination)
 
-            continue_action = perform_goto(decimal_RA, decimal_Dec, target_name)
+            continue_action = yield from run_step(policies, "step_9", perform_goto, decimal_RA, decimal_Dec, target_name)
             wait_after = program.get('goto_manual', {}).get('wait_after', 0)
-            time.sleep(wait_after)
+            yield SessionWait(wait_after, "step_9")
             verify_action(continue_action, "step_9")
+            checkpoint.complete("step_9")
 
-        if take_photo:
+        if take_photo and not checkpoint.skip("step_10"):
             log.notice(f"Processing Astro Photo Session : {count_val} images")
+            yield from seed_camera_state(policies, "step_10", camera, print_camera_data)
+            continue_action = True
             if exp_val:
-                continue_action = perform_update_camera_setting("exposure", exp_val, config_to_dwarf_id_str(dwarf_id))
+                continue_action = yield from update_camera_setting(policies, "step_10", camera, "exposure", exp_val, config_to_dwarf_id_str(dwarf_id))
             if gain_val:
-                continue_action = perform_update_camera_setting("gain", gain_val, config_to_dwarf_id_str(dwarf_id))
+                continue_action = yield from update_camera_setting(policies, "step_10", camera, "gain", gain_val, config_to_dwarf_id_str(dwarf_id))
             if IR_val:
-                continue_action = perform_update_camera_setting("IR", IR_val)
+                continue_action = yield from update_camera_setting(policies, "step_10", camera, "IR", IR_val)
             if binning_val:
-                continue_action = perform_update_camera_setting("binning", binning_val)
+                continue_action = yield from update_camera_setting(policies, "step_10", camera, "binning", binning_val)
             if count_val:
-                continue_action = perform_update_camera_setting("count", count_val)
+                continue_action = yield from update_camera_setting(policies, "step_10", camera, "count", count_val)
 
             # check value
-            time.sleep(5)
-            print_camera_data()
+            yield from check_camera_state("step_10", camera, print_camera_data, saved)
 
             wait_after = program.get('setup_camera', {}).get('wait_after', 0)
-            time.sleep(wait_after)
+            yield SessionWait(wait_after, "step_10")
             verify_action(continue_action, "step_10")
+            checkpoint.complete("step_10")
 
-            time.sleep(2)
-            continue_action = perform_takeAstroPhoto()
+        # an interrupted capture is started again
+        if take_photo and not checkpoint.skip("step_12"):
+            yield from wait_settled("step_11", "capture_settle_time", 2)
+            continue_action = yield from run_step(policies, "step_11", perform_takeAstroPhoto)
             verify_action(continue_action, "step_11")
 
-            time.sleep(2)
+            yield from wait_settled("step_12", "capture_settle_time", 2)
             # try multiple time due to timeout errors during waiting end of session
-            continue_action = try_attemps (perform_waitEndAstroPhoto, "", 5)
+            continue_action = yield from wait_capture_end(policies, "step_12", perform_waitEndAstroPhoto, get_capture_seconds(count_val, exp_val))
             verify_action(continue_action, "step_12")
+            checkpoint.complete("step_12")
 
-        if take_widephoto:
+        if take_widephoto and not checkpoint.skip("step_13"):
             log.notice(f"Processing Astro Wide Photo Session : {count_val} images")
+            yield from seed_camera_state(policies, "step_13", camera, print_wide_camera_data)
+            continue_action = True
             if wide_exp_val:
-                continue_action = perform_update_camera_setting("wide_exposure", wide_exp_val, config_to_dwarf_id_str(dwarf_id))
+                continue_action = yield from update_camera_setting(policies, "step_13", camera, "wide_exposure", wide_exp_val, config_to_dwarf_id_str(dwarf_id))
             if wide_gain_val:
-                continue_action = perform_update_camera_setting("wide_gain", wide_gain_val, config_to_dwarf_id_str(dwarf_id))
+                continue_action = yield from update_camera_setting(policies, "step_13", camera, "wide_gain", wide_gain_val, config_to_dwarf_id_str(dwarf_id))
             if count_val:
-                continue_action = perform_update_camera_setting("count", count_val)
+                continue_action = yield from update_camera_setting(policies, "step_13", camera, "count", count_val)
 
             # check value
-            time.sleep(5)
-            print_wide_camera_data()
+            yield from check_camera_state("step_13", camera, print_wide_camera_data, saved)
 
             wait_after = program.get('setup_wide_camera', {}).get('wait_after', 0)
-            time.sleep(wait_after)
+            yield SessionWait(wait_after, "step_13")
             verify_action(continue_action, "step_13")
+            checkpoint.complete("step_13")
 
-            time.sleep(2)
-            continue_action = perform_takeAstroWidePhoto()
+        if take_widephoto and not checkpoint.skip("step_15"):
+            yield from wait_settled("step_14", "capture_settle_time", 2)
+            continue_action = yield from run_step(policies, "step_14", perform_takeAstroWidePhoto)
             verify_action(continue_action, "step_14")
 
-            time.sleep(2)
+            yield from wait_settled("step_15", "capture_settle_time", 2)
             # try multiple time due to timeout errors during waiting end of session
-            continue_action = try_attemps (perform_waitEndAstroWidePhoto, "", 5)
+            continue_action = yield from wait_capture_end(policies, "step_15", perform_waitEndAstroWidePhoto, get_capture_seconds(count_val, wide_exp_val))
             verify_action(continue_action, "step_15")
+            checkpoint.complete("step_15")
+
+        checkpoint.ended(program)
 
     except Exception as e:
         log.error(f"Error during session : {e}")
+        if camera is not None:
+            # the settings of the dwarf are unknown after an error
+            camera.invalidate()
+            device_setups.pop(dwarf_ip, None)
         raise  # Re-raises the caught exception to propagate it to the caller
 
     finally:
+        if saved:
+            total = sum(saved.values())
+            program.setdefault('id_command', {})['wait_saved'] = round(total, 1)
+            log.notice(f"Readiness polling saved {total:.1f}s on the fixed waits")
         log.success("######################")
         log.success(f"  End of Session")
         log.success("######################")
 
+# Time (monotonic clock) spent in each step of a session: calls to the dwarf with their retries, and waits
+def add_step_timing(timings, step, elapsed, is_call, failed):
+    timing = timings.setdefault(step, {"time": 0.0, "wait": 0.0, "calls": 0, "failed": 0})
+    timing["time"] += elapsed
+    if is_call:
+        timing["calls"] += 1
+        metrics.observe("dwarf_step_duration_seconds", elapsed, step=step)
+        if failed:
+            timing["failed"] += 1
+    else:
+        timing["wait"] += elapsed
+
+# Run the steps of a session and record their timings in the timings entry of its id_command,
+# the timings of the retries of the session are added to the previous ones.
+# The step_started and step_finished events are written when the session changes of step
+def timed_session_steps(program, on_checkpoint = None):
+    steps = session_steps(program, on_checkpoint)
+    id_command = program.setdefault('id_command', {})
+    previous = id_command.get('timings') or {}
+    timings = {step: dict(timing) for step, timing in previous.items() if isinstance(timing, dict)}
+    previous_total = previous.get("total", 0.0)
+    session_start = time.monotonic()
+    current_step = None
+    step_start = session_start
+    status = "failed"
+    result = None
+    error = None
+    try:
+        while True:
+            try:
+                action = steps.throw(error) if error is not None else steps.send(result)
+            except StopIteration:
+                status = "ok"
+                return
+            is_call = isinstance(action, SessionCall)
+            step = action.step if is_call or action.step else current_step or "step_0"
+            start = time.monotonic()
+            if step != current_step:
+                if current_step is not None:
+                    emit_event("step_finished", step=current_step, status="ok", duration=round(start - step_start, 3))
+                emit_event("step_started", step=step, description=STEP_DESCRIPTIONS.get(step, step))
+                current_step = step
+                step_start = start
+            result = None
+            error = None
+            try:
+                result = yield action
+            except GeneratorExit:
+                status = "cancelled"
+                raise
+            except Exception as e:
+                error = e
+            add_step_timing(timings, current_step, time.monotonic() - start, is_call, error is not None)
+    finally:
+        steps.close()
+        end = time.monotonic()
+        if current_step is not None:
+            emit_event("step_finished", step=current_step, status=status, duration=round(end - step_start, 3))
+        total = previous_total + end - session_start
+        for timing in timings.values():
+            timing["time"] = round(timing["time"], 1)
+            timing["wait"] = round(timing["wait"], 1)
+        timings["total"] = round(total, 1)
+        id_command['timings'] = timings
+
+# Run the steps of a session in the calling thread
+# on_progress(step, description) is called when the session reaches a new step,
+# the session stops before its next call or wait once cancel_event is set,
+# call_wrapper(function, *args) runs each call to the dwarf, e.g. with the config of the device activated
+def start_dwarf_session(program, type_dwarf = 2, on_checkpoint = None, on_progress = None, cancel_event = None, call_wrapper = None):
+    steps = timed_session_steps(program, on_checkpoint)
+    current_step = None
+    result = None
+    error = None
+    try:
+        while True:
+            try:
+                action = steps.throw(error) if error is not None else steps.send(result)
+            except StopIteration:
+                return
+            result = None
+            error = None
+            if cancel_event is not None and cancel_event.is_set():
+                log.warning(f"Session cancelled at step: {STEP_DESCRIPTIONS.get(current_step, current_step)}")
+                raise SessionCancelledError(f"Session cancelled at step: {STEP_DESCRIPTIONS.get(current_step, current_step)}")
+            if isinstance(action, SessionWait):
+                if action.seconds and action.seconds > 0:
+                    if wait_cancellable(action.seconds, cancel_event):
+                        # cancelled during the wait
+                        log.warning(f"Session cancelled at step: {STEP_DESCRIPTIONS.get(action.step, action.step)}")
+                        raise SessionCancelledError(f"Session cancelled at step: {STEP_DESCRIPTIONS.get(action.step, action.step)}")
+                continue
+
+            if action.step != current_step:
+                current_step = action.step
+                if on_progress:
+                    on_progress(current_step, STEP_DESCRIPTIONS.get(current_step, current_step))
+            try:
+                result = run_call(action, call_wrapper)
+            except Exception as e:
+                error = e
+    finally:
+        # runs the end of session logs of the steps if they are interrupted
+        steps.close()
+
+# Wait seconds, stopped early when cancel_event is set
+# return True if the wait has been cancelled
+def wait_cancellable(seconds, cancel_event = None):
+    if cancel_event is None:
+        time.sleep(seconds)
+        return False
+    return cancel_event.wait(seconds)
+
+# Function running the call of a session step, through call_wrapper(function, *args) if any
+def get_call_function(action, call_wrapper = None):
+    if call_wrapper is None:
+        return functools.partial(action.function, *action.args)
+    return functools.partial(call_wrapper, action.function, *action.args)
+
+# Run a call of a session step, within its timeout if any
+def run_call(action, call_wrapper = None):
+    function = get_call_function(action, call_wrapper)
+    if action.timeout is None:
+        return function()
+    # the thread of the call is named after the session thread, for the log of its device
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=threading.current_thread().name)
+    future = executor.submit(function)
+    try:
+        return future.result(timeout=action.timeout)
+    except FutureTimeoutError:
+        # the call keeps running in its thread until the dwarf answers, a retry would wait behind it
+        raise SessionDeadlineError(f"no answer after {action.timeout:.1f}s at step: {STEP_DESCRIPTIONS.get(action.step, action.step)}")
+    finally:
+        executor.shutdown(wait=False)
+
+# Run the steps of a session in an event loop: the blocking calls to the dwarf run in the executor
+# and the waits are awaited, so the session can be cancelled between two calls.
+# on_progress(step, description) is called when the session reaches a new step
+# Cancelling the task does not stop the call to the dwarf being executed (e.g. perform_waitEndAstroPhoto):
+# it keeps running in its executor thread until the dwarf answers, the capture itself is not stopped
+async def start_dwarf_session_async(program, type_dwarf = 2, executor = None, on_progress = None, on_checkpoint = None, call_wrapper = None):
+    # imported here, the headless scheduler only uses the blocking driver
+    import asyncio
+    loop = asyncio.get_running_loop()
+    steps = timed_session_steps(program, on_checkpoint)
+    current_step = None
+    result = None
+    error = None
+    try:
+        while True:
+            try:
+                action = steps.throw(error) if error is not None else steps.send(result)
+            except StopIteration:
+                return
+            result = None
+            error = None
+            if isinstance(action, SessionWait):
+                if action.seconds and action.seconds > 0:
+                    await asyncio.sleep(action.seconds)
+                continue
+
+            if action.step != current_step:
+                current_step = action.step
+                if on_progress:
+                    on_progress(current_step, STEP_DESCRIPTIONS.get(current_step, current_step))
+            try:
+                # a cancelled call keeps running in the executor until the dwarf answers
+                call = loop.run_in_executor(executor, get_call_function(action, call_wrapper))
+                if action.timeout is None:
+                    result = await call
+                else:
+                    result = await asyncio.wait_for(call, action.timeout)
+            except asyncio.TimeoutError:
+                error = SessionDeadlineError(f"no answer after {action.timeout:.1f}s at step: {STEP_DESCRIPTIONS.get(current_step, current_step)}")
+            except asyncio.CancelledError:
+                log.warning(f"Session cancelled at step: {STEP_DESCRIPTIONS.get(current_step, current_step)}")
+                raise
+            except Exception as e:
+                error = e
+    finally:
+        # runs the end of session logs of the steps if they are interrupted
+        steps.close()
+
+# Run a session with the async runner from a blocking caller (session_runner = async), in its own event loop
+# the session task is cancelled once cancel_event is set, the call to the dwarf being executed is not waited for
+def run_dwarf_session_async(program, type_dwarf = 2, on_checkpoint = None, on_progress = None, cancel_event = None, call_wrapper = None):
+    import asyncio
+
+    async def run_session():
+        task = asyncio.ensure_future(start_dwarf_session_async(program, type_dwarf, executor, on_progress, on_checkpoint, call_wrapper))
+        while not task.done():
+            if cancel_event is not None and cancel_event.is_set():
+                task.cancel()
+                break
+            await asyncio.wait({task}, timeout=0.5)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            raise SessionCancelledError("Session cancelled") from None
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=threading.current_thread().name)
+    try:
+        return asyncio.run(run_session())
+    finally:
+        executor.shutdown(wait=False)
+
 def verify_action (result, action_step, wait = False):
     log.notice(f"verify_action : {result}")
     if result is False and wait is True:
@@ -404,7 +961,9 @@ def verify_action (result, action_step, wait = False):
 def stop_action():
   return
   
-def print_camera_data():
+# Print the camera settings of the dwarf (debug level if not verbose), and update camera_state with them if given
+def print_camera_data(camera_state = None, verbose = True):
+    notice = log.notice if verbose else log.debug
     camera_exposure = False
     camera_gain = False
     camera_binning = False
@@ -416,10 +975,10 @@ def print_camera_data():
     result_feature = perform_get_all_feature_camera_setting()
 
     # get dwarf type id
-    data_config = dwarf_python_api.get_config_data.get_config_data()
+    data_config = config_snapshot.get_config_data()
     dwarf_id = data_config['dwarf_id'] 
-    log.notice("----------------------")
-    log.notice(f"Connected to Dwarf {config_to_dwarf_id_int(dwarf_id)}")
+    notice("----------------------")
+    notice(f"Connected to Dwarf {config_to_dwarf_id_int(dwarf_id)}")
 
     # ALL PARAMS
     if (result):
@@ -434,9 +993,9 @@ def print_camera_data():
            index_value = matching_entry["index"]
 
            camera_exposure = str(get_exposure_name_by_index(index_value,config_to_dwarf_id_str(dwarf_id)))
-           log.notice(f"the exposure is: {camera_exposure}")
+           notice(f"the exposure is: {camera_exposure}")
         else:
-           log.notice("the exposure has not been found")
+           notice("the exposure has not been found")
 
         # get Gain
         target_id = 1
@@ -450,9 +1009,9 @@ def print_camera_data():
 
 
            camera_gain = str(get_gain_name_by_index(index_value,config_to_dwarf_id_str(dwarf_id)))
-           log.notice(f"the gain is: {camera_gain}")
+           notice(f"the gain is: {camera_gain}")
         else:
-           log.notice("the gain has not been found")
+           notice("the gain has not been found")
 
         # get IR
         target_id = 8
@@ -465,21 +1024,21 @@ def print_camera_data():
             camera_IR = str(matching_entry["index"])
 
             if camera_IR == "0" and config_to_dwarf_id_str(dwarf_id) == "2":
-                log.notice("the IR value is: IRCut")
+                notice("the IR value is: IRCut")
             if camera_IR == "1" and config_to_dwarf_id_str(dwarf_id) == "2":
-                log.notice("the IR value is: IRPass")
+                notice("the IR value is: IRPass")
             if camera_IR == "0" and config_to_dwarf_id_str(dwarf_id) == "3":
-                log.notice("the IR value is: VIS FILTER")
+                notice("the IR value is: VIS FILTER")
             if camera_IR == "1" and config_to_dwarf_id_str(dwarf_id) == "3":
-                log.notice("the IR value is: ASTRO FILTER")
+                notice("the IR value is: ASTRO FILTER")
             if camera_IR == "2" and config_to_dwarf_id_str(dwarf_id) == "3":
-                log.notice("the IR value is: DUAL BAND")
+                notice("the IR value is: DUAL BAND")
         else:
-           log.notice("the IRfilter has not been found")
+           notice("the IRfilter has not been found")
     else:
-       log.notice("the exposure has not been found")
-       log.notice("the gain has not been found")
-       log.notice("the IRfilter has not been found")
+       notice("the exposure has not been found")
+       notice("the gain has not been found")
+       notice("the IRfilter has not been found")
 
     # ALL FEATURE PARAMS
     if result_feature : 
@@ -493,11 +1052,11 @@ def print_camera_data():
             # Extract specific fields for the matching entry
             camera_binning = str(matching_entry["index"])
             if (camera_binning == "0"):
-                log.notice("the Binning value is 4k")
+                notice("the Binning value is 4k")
             else:
-                log.notice("the Binning value is 2k")
+                notice("the Binning value is 2k")
         else:
-           log.notice("the Binning value has not been found")
+           notice("the Binning value has not been found")
 
         # get camera_format
         target_id = 2
@@ -509,11 +1068,11 @@ def print_camera_data():
             # Extract specific fields for the matching entry
             camera_format = str(matching_entry["index"])
             if (camera_format == "0"):
-                log.notice("the image format value is: FITS")
+                notice("the image format value is: FITS")
             else:
-                log.notice("the image format value is: TIFF")
+                notice("the image format value is: TIFF")
         else:
-           log.notice("the image format value has not been found")
+           notice("the image format value has not been found")
 
         # get camera_count
         target_id = 1
@@ -525,17 +1084,23 @@ def print_camera_data():
             # Extract specific fields for the matching entry
             camera_count = str(round(matching_entry["continue_value"]))
 
-            log.notice(f"the number of images for the session is: {camera_count}")
+            notice(f"the number of images for the session is: {camera_count}")
         else:
-           log.notice("the number of images for the session has not been found")
+           notice("the number of images for the session has not been found")
     else:
-       log.notice("the Binning value has not been found")
-       log.notice("the image format value has not been found")
-       log.notice("the number of images for the session has not been found")
+       notice("the Binning value has not been found")
+       notice("the image format value has not been found")
+       notice("the number of images for the session has not been found")
+
+    notice("----------------------")
 
-    log.notice("----------------------")
+    if camera_state is not None:
+        values = {"exposure": camera_exposure, "gain": camera_gain, "IR": camera_IR, "binning": camera_binning, "count": camera_count}
+        camera_state.set_read({setting: value for setting, value in values.items() if value is not False})
 
-def print_wide_camera_data():
+# Print the wide camera settings of the dwarf (debug level if not verbose), and update camera_state with them if given
+def print_wide_camera_data(camera_state = None, verbose = True):
+    notice = log.notice if verbose else log.debug
     camera_wide_exposure = False
     camera_wide_gain = False
     camera_count = False
@@ -544,10 +1109,10 @@ def print_wide_camera_data():
     result_feature = perform_get_all_feature_camera_setting()
 
     # get dwarf type id
-    data_config = dwarf_python_api.get_config_data.get_config_data()
+    data_config = config_snapshot.get_config_data()
     dwarf_id = data_config['dwarf_id'] 
-    log.notice("----------------------")
-    log.notice(f"Connected to Dwarf {config_to_dwarf_id_int(dwarf_id)}")
+    notice("----------------------")
+    notice(f"Connected to Dwarf {config_to_dwarf_id_int(dwarf_id)}")
 
     # ALL PARAMS
     if (result):
@@ -562,9 +1127,9 @@ def print_wide_camera_data():
            index_value = matching_entry["index"]
 
            camera_wide_exposure = str(get_wide_exposure_name_by_index(index_value,config_to_dwarf_id_str(dwarf_id)))
-           log.notice(f"the exposure is: {camera_wide_exposure}")
+           notice(f"the exposure is: {camera_wide_exposure}")
         else:
-           log.notice("the exposure has not been found")
+           notice("the exposure has not been found")
 
         # get Gain
         target_id = 1
@@ -578,13 +1143,13 @@ def print_wide_camera_data():
 
 
            camera_wide_gain = str(get_wide_gain_name_by_index(index_value,config_to_dwarf_id_str(dwarf_id)))
-           log.notice(f"the gain is: {camera_wide_gain}")
+           notice(f"the gain is: {camera_wide_gain}")
         else:
-           log.notice("the gain has not been found")
+           notice("the gain has not been found")
 
     else:
-       log.notice("the exposure has not been found")
-       log.notice("the gain has not been found")
+       notice("the exposure has not been found")
+       notice("the gain has not been found")
 
     # ALL FEATURE PARAMS
     if result_feature : 
@@ -598,10 +1163,14 @@ def print_wide_camera_data():
             # Extract specific fields for the matching entry
             camera_count = str(round(matching_entry["continue_value"]))
 
-            log.notice(f"the number of images for the session is: {camera_count}")
+            notice(f"the number of images for the session is: {camera_count}")
         else:
-           log.notice("the number of images for the session has not been found")
+           notice("the number of images for the session has not been found")
     else:
-       log.notice("the number of images for the session has not been found")
+       notice("the number of images for the session has not been found")
+
+    notice("----------------------")
 
-    log.notice("----------------------")
+    if camera_state is not None:
+        values = {"wide_exposure": camera_wide_exposure, "wide_gain": camera_wide_gain, "count": camera_count}
+        camera_state.set_read({setting: value for setting, value in values.items() if value is not False})
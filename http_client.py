@@ -0,0 +1,72 @@
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import scheduler_config
+
+# Default timeouts (s) of the HTTP calls, http_connect_timeout and http_read_timeout of the [SCHEDULER] section
+CONNECT_TIMEOUT = 3.0
+READ_TIMEOUT = 10.0
+POOL_SIZE = 4
+
+class HttpClient:
+    """Shared requests session: keep-alive connections, timeouts and a short cache of the JSON GET responses."""
+    def __init__(self, pool_size=POOL_SIZE):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.cache = {}  # url -> (expiry, status_code, data)
+
+    def get_timeout(self):
+        connect_timeout = scheduler_config.get_float_option("http_connect_timeout", CONNECT_TIMEOUT)
+        read_timeout = scheduler_config.get_float_option("http_read_timeout", READ_TIMEOUT)
+        return (connect_timeout, read_timeout)
+
+    def get_json(self, url, ttl=0, timeout=None):
+        """Return (status_code, data) of a GET, data is None if the response is not JSON.
+
+        A 200 response is kept ttl seconds, raise requests.RequestException on connection errors and timeouts.
+        """
+        now = time.monotonic()
+        if ttl > 0:
+            with self.lock:
+                entry = self.cache.get(url)
+                if entry is not None and entry[0] > now:
+                    return entry[1], entry[2]
+
+        response = self.session.get(url, timeout=timeout or self.get_timeout())
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+
+        if ttl > 0 and response.status_code == 200:
+            with self.lock:
+                self.cache[url] = (time.monotonic() + ttl, response.status_code, data)
+        return response.status_code, data
+
+    def invalidate(self, url=None):
+        with self.lock:
+            if url is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(url, None)
+
+    def close(self):
+        self.invalidate()
+        self.session.close()
+
+http_clients = {}
+http_clients_lock = threading.Lock()
+
+# Get the shared client of a kind of server ("dwarf", "stellarium")
+def get_http_client(name):
+    with http_clients_lock:
+        client = http_clients.get(name)
+        if client is None:
+            client = http_clients[name] = HttpClient()
+        return client
@@ -0,0 +1,84 @@
+import numpy as np
+
+# Orders of the panes of a mosaic
+ORDER_CSV = "csv"  # order of the CSV file, sorted by its first column
+ORDER_SHORTEST = "shortest"  # shortest slew path
+ORDER_WEST_FIRST = "west_first"  # shortest slew path starting with the westernmost pane, setting first
+
+# Angular distances (degrees) between all the panes, ra in hours and dec in degrees
+def get_distance_matrix(ra_hours, dec_deg):
+    ra = np.radians(np.asarray(ra_hours, dtype=float) * 15)
+    dec = np.radians(np.asarray(dec_deg, dtype=float))
+    delta_ra = ra[:, None] - ra[None, :]
+    delta_dec = dec[:, None] - dec[None, :]
+    # haversine formula, accurate for the small distances between panes
+    h = np.sin(delta_dec / 2) ** 2 + np.cos(dec[:, None]) * np.cos(dec[None, :]) * np.sin(delta_ra / 2) ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(h, 0, 1))))
+
+def get_path_length(order, distances):
+    order = np.asarray(order)
+    return float(distances[order[:-1], order[1:]].sum())
+
+def get_nearest_neighbour_path(distances, start):
+    count = len(distances)
+    visited = np.zeros(count, dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(count - 1):
+        candidates = np.where(visited, np.inf, distances[order[-1]])
+        nearest = int(np.argmin(candidates))
+        order.append(nearest)
+        visited[nearest] = True
+    return order
+
+# Improve an open path by reversing segments while it gets shorter, the first pane stays first
+def improve_path_2opt(order, distances):
+    order = np.asarray(order)
+    count = len(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, count - 1):
+            # reversing order[i:j+1] replaces the edges (i-1, i) and (j, j+1)
+            j = np.arange(i + 1, count)
+            before = distances[order[i - 1], order[i]]
+            after_j = np.append(distances[order[j[:-1]], order[j[:-1] + 1]], 0.0)
+            new_first = distances[order[i - 1], order[j]]
+            new_last = np.append(distances[order[i], order[j[:-1] + 1]], 0.0)
+            gains = before + after_j - new_first - new_last
+            best = int(np.argmax(gains))
+            if gains[best] > 1e-9:
+                k = j[best]
+                order[i:k + 1] = order[i:k + 1][::-1]
+                improved = True
+    return order.tolist()
+
+# Index of the westernmost pane: the lowest RA around the mean RA of the mosaic
+def get_west_pane(ra_hours):
+    ra = np.radians(np.asarray(ra_hours, dtype=float) * 15)
+    mean_ra = np.arctan2(np.sin(ra).mean(), np.cos(ra).mean())
+    offsets = np.angle(np.exp(1j * (ra - mean_ra)))
+    return int(np.argmin(offsets))
+
+def order_panes(ra_hours, dec_deg, order=ORDER_SHORTEST):
+    """Return (order, slew of the CSV order, slew of the new order), slews in degrees."""
+    count = len(ra_hours)
+    identity = list(range(count))
+    if count < 3 or order == ORDER_CSV:
+        distances = get_distance_matrix(ra_hours, dec_deg) if count else np.zeros((0, 0))
+        length = get_path_length(identity, distances) if count else 0.0
+        return identity, length, length
+
+    distances = get_distance_matrix(ra_hours, dec_deg)
+    if order == ORDER_WEST_FIRST:
+        starts = [get_west_pane(ra_hours)]
+    else:
+        starts = identity
+
+    best_order, best_length = None, np.inf
+    for start in starts:
+        path = improve_path_2opt(get_nearest_neighbour_path(distances, start), distances)
+        length = get_path_length(path, distances)
+        if length < best_length:
+            best_order, best_length = path, length
+    return best_order, get_path_length(identity, distances), best_length
@@ -0,0 +1,54 @@
+import os
+import configparser
+
+CONFIG_INI_FILE = 'config.ini'
+SCHEDULER_SECTION = 'SCHEDULER'
+CONFIG_SECTION = 'CONFIG'
+
+# config.ini parsed content, reloaded when the file is modified
+config_cache = {"mtime": None, "config": None}
+
+def load_config_ini():
+    try:
+        mtime = os.stat(CONFIG_INI_FILE).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    if config_cache["config"] is None or config_cache["mtime"] != mtime:
+        config = configparser.ConfigParser()
+        config.read(CONFIG_INI_FILE)
+        config_cache["config"] = config
+        config_cache["mtime"] = mtime
+    return config_cache["config"]
+
+# Get an option of the scheduler section of config.ini, default if missing or empty
+def get_option(key, default="", section=SCHEDULER_SECTION):
+    value = load_config_ini().get(section, key, fallback="").strip()
+    return value if value else default
+
+def get_bool_option(key, default=False, section=SCHEDULER_SECTION):
+    value = get_option(key, "", section)
+    if not value:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+def get_int_option(key, default=0, section=SCHEDULER_SECTION):
+    try:
+        return int(get_option(key, default, section))
+    except ValueError:
+        return default
+
+def get_float_option(key, default=0.0, section=SCHEDULER_SECTION):
+    try:
+        return float(get_option(key, default, section))
+    except ValueError:
+        return default
+
+# Site of the sessions in the [CONFIG] section: (latitude, longitude, timezone name), None if longitude or latitude is not set
+def get_site():
+    try:
+        latitude = float(get_option("latitude", "", CONFIG_SECTION).replace(",", "."))
+        longitude = float(get_option("longitude", "", CONFIG_SECTION).replace(",", "."))
+    except ValueError:
+        return None
+    return latitude, longitude, get_option("timezone", "", CONFIG_SECTION)
@@ -0,0 +1,139 @@
+import bisect
+import threading
+
+import scheduler_config
+
+import dwarf_python_api.lib.my_logger as log
+
+# Upper bounds (s) of the buckets of the histograms
+STEP_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+CYCLE_BUCKETS = (0.001, 0.01, 0.1, 1, 10, 60, 300, 900, 3600, 7200)
+
+class Metrics:
+    """Metrics of the scheduler in the Prometheus text format.
+
+    The values are updated by the scheduler when they change, a scrape only formats them.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}  # name -> [type, help, buckets, {labels: value}]
+
+    def define(self, name, metric_type, help_text, buckets=None):
+        self.metrics[name] = [metric_type, help_text, buckets, {}]
+
+    def get_values(self, name):
+        return self.metrics[name][3]
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.get_values(name)
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.get_values(name)[key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.metrics[name][2]
+        with self.lock:
+            values = self.get_values(name)
+            histogram = values.get(key)
+            if histogram is None:
+                # count per bucket (the last one is +Inf), sum, count
+                histogram = values[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (metric_type, help_text, buckets, values) in self.metrics.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for key, value in sorted(values.items()):
+                    if metric_type != "histogram":
+                        lines.append(f"{name}{format_labels(key)} {format_value(value)}")
+                        continue
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(key)} {format_value(total)}")
+                    lines.append(f"{name}_count{format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(key):
+    if not key:
+        return ""
+    labels = ",".join(f'{label}="{escape_label(value)}"' for label, value in key)
+    return "{" + labels + "}"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+metrics = Metrics()
+metrics.define("dwarf_sessions", "gauge", "Number of sessions per device and state (todo, current, done, error)")
+metrics.define("dwarf_scheduler_next_due_timestamp_seconds", "gauge", "Execution time of the next waiting session (unix time), 0 if none")
+metrics.define("dwarf_scheduler_cycle_seconds", "histogram", "Duration of a check of the ToDo queue, including the session executed", CYCLE_BUCKETS)
+metrics.define("dwarf_step_duration_seconds", "histogram", "Duration of the calls to the dwarf per session step", STEP_BUCKETS)
+metrics.define("dwarf_step_retries_total", "counter", "Retries of the session steps")
+metrics.define("dwarf_session_retries_total", "counter", "Retries of whole sessions")
+metrics.define("dwarf_connections_total", "counter", "Connections to the dwarf per method (wifi, bluetooth) and result")
+
+# Server of the endpoint, http.server is only imported when the metrics are enabled
+def create_metrics_server(host, port):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # no access log in the scheduler log
+            pass
+
+    return ThreadingHTTPServer((host, port), MetricsHandler)
+
+metrics_server = None
+
+# Start the metrics endpoint if metrics_port is set in the [SCHEDULER] section of config.ini
+def start_metrics_server():
+    global metrics_server
+    port = scheduler_config.get_int_option("metrics_port", 0)
+    if port <= 0 or metrics_server is not None:
+        return metrics_server
+    host = scheduler_config.get_option("metrics_host", "127.0.0.1")
+    try:
+        metrics_server = create_metrics_server(host, port)
+    except OSError as e:
+        log.error(f"can't start the metrics endpoint on {host}:{port} - {e}")
+        return None
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever, name="metrics", daemon=True).start()
+    log.notice(f"Metrics available on http://{host}:{port}/metrics")
+    return metrics_server
+
+def stop_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+        metrics_server = None
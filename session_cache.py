@@ -0,0 +1,68 @@
+import os
+import threading
+
+class SessionCache:
+    """Parsed session files, reloaded only when the file identity changes.
+
+    An entry is keyed by its path and is valid while (mtime_ns, size, inode)
+    of the file are unchanged.
+    """
+    def __init__(self):
+        self.entries = {}  # path -> (identity, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, filepath, loader):
+        """Return loader(filepath), computed again only if the file changed on disk."""
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            self.evict(filepath)
+            return loader(filepath)
+        identity = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+        with self.lock:
+            entry = self.entries.get(filepath)
+            if entry is not None and entry[0] == identity:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = loader(filepath)
+        with self.lock:
+            self.entries[filepath] = (identity, value)
+        return value
+
+    def peek(self, filepath):
+        """Return the cached value of the file without checking the file, None if not cached."""
+        with self.lock:
+            entry = self.entries.get(filepath)
+        return entry[1] if entry is not None else None
+
+    def evict(self, filepath):
+        with self.lock:
+            if self.entries.pop(filepath, None) is not None:
+                self.evictions += 1
+
+    def prune(self, directory, filepaths):
+        """Evict the entries of the directory whose file is not in filepaths anymore."""
+        directory = os.path.join(directory, "")
+        with self.lock:
+            for path in [p for p in self.entries if p.startswith(directory) and p not in filepaths]:
+                del self.entries[path]
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,391 @@
+import os
+import copy
+import hmac
+import json
+import threading
+import ipaddress
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs, unquote
+
+import scheduler_config
+from session_events import emit_event
+
+import dwarf_python_api.lib.my_logger as log
+
+# Fields of a queued session that can be changed through the API
+UPDATABLE_FIELDS = ("date", "time", "priority", "deadline")
+MAX_BODY_SIZE = 1024 * 1024
+
+class ControlError(Exception):
+    """Error of a control request, returned with its HTTP status."""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class SchedulerControl:
+    """Operations of the control API on the running scheduler loops.
+
+    The answers are built from the queues and the current sessions kept in memory by
+    the scheduler, the sessions are only read from disk when they are enqueued or changed.
+    scheduler is the astro_dwarf_scheduler module running the loops.
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def get_contexts(self):
+        contexts = list(self.scheduler.running_contexts)
+        return contexts if contexts else [self.scheduler.default_context]
+
+    def get_context(self, device=None):
+        contexts = self.get_contexts()
+        if device:
+            for context in contexts:
+                if self.scheduler.get_device_label(context) == device:
+                    return context
+            raise ControlError(404, f"unknown device {device}")
+        if len(contexts) > 1:
+            raise ControlError(400, "several devices are running, the device parameter is required")
+        return contexts[0]
+
+    @contextmanager
+    def use_context(self, context):
+        """Run scheduler functions of the request thread on the queue of context."""
+        scheduler_local = self.scheduler.scheduler_local
+        previous = getattr(scheduler_local, "context", None)
+        scheduler_local.context = context
+        try:
+            with context.lock:
+                yield
+        finally:
+            if previous is None:
+                del scheduler_local.context
+            else:
+                scheduler_local.context = previous
+
+    def get_todo_path(self, context, filename):
+        if not filename.endswith('.json') or os.path.basename(filename) != filename or filename.startswith('.'):
+            raise ControlError(400, f"invalid session filename {filename}")
+        return os.path.join(context.list_astro_dir["TODO_DIR"], filename)
+
+    def wake(self, context):
+        # the loop computes again its next due time
+        if context.watcher is not None:
+            context.watcher.wake()
+
+    def get_dwarf_label(self):
+        try:
+            dwarf_id = self.scheduler.config_snapshot.get_config_data().get("dwarf_id")
+            return "D" + self.scheduler.config_to_dwarf_id_str(dwarf_id) if dwarf_id else None
+        except Exception:
+            return None
+
+    def list_devices(self):
+        devices = []
+        for context in self.get_contexts():
+            current = context.current
+            devices.append({
+                "device": self.scheduler.get_device_label(context),
+                "queued": len(context.session_queue),
+                "current": current["filename"] if current else None,
+            })
+        return {"devices": devices}
+
+    def describe_current(self, current, estimator, dwarf_label):
+        now = datetime.now()
+        estimated_end = current["started"] + timedelta(seconds=estimator.estimate(current["program"]["command"], dwarf_label))
+        return {
+            "filename": current["filename"],
+            "uuid": current["uuid"],
+            "description": current["description"],
+            "started": current["started"].isoformat(timespec="seconds"),
+            "elapsed": round((now - current["started"]).total_seconds(), 1),
+            "step": current["step"],
+            "step_description": current["step_description"],
+            "step_started": current["step_started"].isoformat(timespec="seconds") if current["step_started"] else None,
+            "step_elapsed": round((now - current["step_started"]).total_seconds(), 1) if current["step_started"] else None,
+            "estimated_end": max(estimated_end, now).isoformat(timespec="seconds"),
+            "cancelling": current["cancel"].is_set(),
+        }
+
+    def get_current(self, device=None):
+        from session_estimator import get_fitted_estimator
+        context = self.get_context(device)
+        current = context.current
+        if current is None:
+            return {"device": self.scheduler.get_device_label(context), "current": None}
+        return {"device": self.scheduler.get_device_label(context),
+                "current": self.describe_current(current, get_fitted_estimator(), self.get_dwarf_label())}
+
+    def list_sessions(self, device=None):
+        """Queued sessions in execution order with their estimated start and end."""
+        # numpy is only imported when the estimates are needed
+        from session_estimator import get_fitted_estimator
+        context = self.get_context(device)
+        estimator = get_fitted_estimator()
+        dwarf_label = self.get_dwarf_label()
+        todo_dir = context.list_astro_dir["TODO_DIR"]
+        # the sessions run one after the other in the order of the queue policy, not before their execution time
+        available = datetime.now()
+        current = context.current
+        if current is not None:
+            available = datetime.fromisoformat(self.describe_current(current, estimator, dwarf_label)["estimated_end"])
+
+        commands = {}
+        def get_duration(filename):
+            cached = self.scheduler.session_cache.peek(os.path.join(todo_dir, filename))
+            program = cached[0] if cached else None
+            commands[filename] = program.get('command', {}) if isinstance(program, dict) else {}
+            return estimator.estimate(commands[filename], dwarf_label)
+
+        session_queue = context.session_queue
+        with context.lock:
+            plan = session_queue.forecast(available, get_duration)
+            entries = {filename: session_queue.get_entry(filename) for filename, _, _ in plan}
+
+        sessions = []
+        for filename, start, end in plan:
+            due, _, priority, deadline = entries[filename]
+            id_command = commands[filename].get('id_command', {})
+            sessions.append({
+                "filename": filename,
+                "uuid": id_command.get('uuid'),
+                "description": id_command.get('description'),
+                "due": due.isoformat(timespec="seconds"),
+                "priority": priority,
+                "deadline": deadline.isoformat(timespec="seconds") if deadline else None,
+                "eta": start.isoformat(timespec="seconds"),
+                "estimated_duration": round((end - start).total_seconds()),
+                "estimated_end": end.isoformat(timespec="seconds"),
+                "late": deadline is not None and start >= deadline,
+            })
+        return {"device": self.scheduler.get_device_label(context), "policy": session_queue.policy, "sessions": sessions}
+
+    def validate_session(self, program):
+        """Return the error of a session to enqueue, None if it can be executed."""
+        if not isinstance(program, dict) or not isinstance(program.get('command'), dict):
+            return "the session must be an object with a command"
+        command = program['command'].get('id_command')
+        if not isinstance(command, dict):
+            return "mandatory id_command not found in the command"
+        if command.get('process', 'wait') != 'wait':
+            return "the process of a new session must be 'wait'"
+        try:
+            int(command.get('max_retries', 3))
+        except (TypeError, ValueError):
+            return "max_retries must be an integer"
+        try:
+            command_datetime = self.scheduler.get_time_to_execute(datetime.now(), command)
+        except (TypeError, ValueError) as e:
+            return f"invalid date or time - {e}"
+        try:
+            self.scheduler.get_queue_fields(command, command_datetime)
+        except ValueError as e:
+            return f"invalid priority or deadline - {e}"
+        return None
+
+    def write_session(self, context, filename, program):
+        """Write a session in ToDo and queue it at once."""
+        filepath = self.get_todo_path(context, filename)
+        self.scheduler.atomic_write_json(filepath, program)
+        self.scheduler.update_queued_file(filename)
+        if filename not in context.session_queue:
+            raise ControlError(400, f"the session {filename} has not been queued")
+        return context.session_queue.due_time(filename)
+
+    def enqueue_session(self, program, filename=None, device=None):
+        context = self.get_context(device)
+        error = self.validate_session(program)
+        if error:
+            raise ControlError(400, error)
+        id_command = program['command']['id_command']
+        id_command['process'] = 'wait'
+        if not filename:
+            filename = f"{id_command.get('uuid') or datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.json"
+        filepath = self.get_todo_path(context, filename)
+
+        with self.use_context(context):
+            current = context.current
+            if filename in context.session_queue or os.path.exists(filepath) or (current and current["filename"] == filename):
+                raise ControlError(409, f"the session {filename} already exists")
+            due = self.write_session(context, filename, program)
+        self.wake(context)
+        log.notice(f"Session {filename} queued by the control API")
+        return {"filename": filename, "due": due.isoformat(timespec="seconds")}
+
+    def update_session(self, filename, values, device=None):
+        context = self.get_context(device)
+        if not isinstance(values, dict) or not values:
+            raise ControlError(400, f"expected an object with some of {', '.join(UPDATABLE_FIELDS)}")
+        unknown = [key for key in values if key not in UPDATABLE_FIELDS]
+        if unknown:
+            raise ControlError(400, f"fields that can't be changed: {', '.join(unknown)}")
+        filepath = self.get_todo_path(context, filename)
+
+        with self.use_context(context):
+            if filename not in context.session_queue:
+                raise ControlError(404, f"the session {filename} is not queued")
+            cached = self.scheduler.session_cache.peek(filepath)
+            program = copy.deepcopy(cached[0]) if cached else self.scheduler.load_json(filepath)
+            if not program:
+                raise ControlError(404, f"the session {filename} can't be read")
+            program['command']['id_command'].update(values)
+            error = self.validate_session(program)
+            if error:
+                raise ControlError(400, error)
+            due = self.write_session(context, filename, program)
+        self.wake(context)
+        log.notice(f"Session {filename} updated by the control API: {values}")
+        return {"filename": filename, "due": due.isoformat(timespec="seconds")}
+
+    def cancel_session(self, filename, device=None):
+        """Move a queued session to Error."""
+        context = self.get_context(device)
+        filepath = self.get_todo_path(context, filename)
+        scheduler = self.scheduler
+        with self.use_context(context):
+            if not context.session_queue.remove(filename):
+                raise ControlError(404, f"the session {filename} is not queued")
+            context.deferred.pop(filename, None)
+            context.targets.pop(filename, None)
+            cached = scheduler.session_cache.peek(filepath)
+            program = copy.deepcopy(cached[0]) if cached else scheduler.load_json(filepath)
+            scheduler.session_cache.evict(filepath)
+            if program:
+                program = scheduler.update_process_status(program, 'ended', False, "Cancelled by the control API.")
+            scheduler.transition_file(filepath, os.path.join(context.list_astro_dir["ERROR_DIR"], filename), program or None)
+            scheduler.record_session_state(filename, "error", program or None)
+            scheduler.count_session_transition(None, "error")
+            scheduler.metrics.set("dwarf_sessions", len(context.session_queue), device=scheduler.get_device_label(context), state="todo")
+            uuid = program['command']['id_command'].get('uuid') if program else None
+        emit_event("session_cancelled", uuid=uuid, device=scheduler.get_device_label(context), file=filename)
+        self.wake(context)
+        log.notice(f"Session {filename} cancelled by the control API")
+        return {"filename": filename, "cancelled": True}
+
+    def cancel_current(self, device=None):
+        """Stop the running session before its next step, it is moved to Error."""
+        context = self.get_context(device)
+        current = context.current
+        if current is None:
+            raise ControlError(404, "no session is running")
+        current["cancel"].set()
+        log.notice(f"Cancellation of the session {current['filename']} requested by the control API")
+        return {"filename": current["filename"], "cancelling": True}
+
+    def handle(self, method, path, query, body):
+        """Return the answer of a request, raise ControlError."""
+        parts = [unquote(part) for part in path.strip("/").split("/") if part]
+        device = query.get("device", [None])[0]
+        if parts == ["devices"] and method == "GET":
+            return self.list_devices()
+        if parts == ["current"]:
+            if method == "GET":
+                return self.get_current(device)
+            if method == "DELETE":
+                return self.cancel_current(device)
+        if parts == ["sessions"]:
+            if method == "GET":
+                return self.list_sessions(device)
+            if method == "POST":
+                return self.enqueue_session(body, query.get("filename", [None])[0], device)
+        if len(parts) == 2 and parts[0] == "sessions":
+            if method == "PATCH":
+                return self.update_session(parts[1], body, device)
+            if method == "DELETE":
+                return self.cancel_session(parts[1], device)
+        raise ControlError(404, f"unknown request {method} {path}")
+
+# Check the headers of a control request against cross-site requests from a browser:
+# a body must be sent as application/json (a web page can only send text/plain or form data without a CORS preflight,
+# which is not answered) and the token of control_token, if set, must be given in the X-Control-Token header
+def check_request_headers(method, headers, token):
+    if token and not hmac.compare_digest(headers.get("X-Control-Token") or "", token):
+        raise ControlError(401, "missing or invalid X-Control-Token header")
+    if method in ("POST", "PATCH") or int(headers.get("Content-Length") or 0):
+        content_type = (headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            raise ControlError(415, "the request body must be sent as application/json")
+
+# Server of the control API, http.server is only imported when the API is enabled
+def create_control_server(host, port, control, token=None):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class ControlHandler(BaseHTTPRequestHandler):
+        def handle_request(self, method):
+            url = urlparse(self.path)
+            try:
+                check_request_headers(method, self.headers, token)
+                body = None
+                length = int(self.headers.get("Content-Length") or 0)
+                if length > MAX_BODY_SIZE:
+                    raise ControlError(413, "request too large")
+                if length:
+                    try:
+                        body = json.loads(self.rfile.read(length))
+                    except ValueError as e:
+                        raise ControlError(400, f"invalid JSON - {e}")
+                status, answer = 200, control.handle(method, url.path, parse_qs(url.query), body)
+            except ControlError as e:
+                status, answer = e.status, {"error": str(e)}
+            except Exception as e:
+                log.error(f"control API error on {method} {url.path} - {e}")
+                status, answer = 500, {"error": str(e)}
+            data = json.dumps(answer, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.handle_request("GET")
+
+        def do_POST(self):
+            self.handle_request("POST")
+
+        def do_PATCH(self):
+            self.handle_request("PATCH")
+
+        def do_DELETE(self):
+            self.handle_request("DELETE")
+
+        def log_message(self, format, *args):
+            # no access log in the scheduler log
+            pass
+
+    return ThreadingHTTPServer((host, port), ControlHandler)
+
+control_server = None
+
+# Start the control API if control_port is set in the [SCHEDULER] section of config.ini
+# scheduler is the astro_dwarf_scheduler module running the loops
+def start_control_server(scheduler):
+    global control_server
+    port = scheduler_config.get_int_option("control_port", 0)
+    if port <= 0 or control_server is not None:
+        return control_server
+    host = scheduler_config.get_option("control_host", "127.0.0.1")
+    token = scheduler_config.get_option("control_token", "")
+    try:
+        if not token and not ipaddress.ip_address(host).is_loopback:
+            log.warning(f"The control API on {host} is reachable from the network, set control_token to protect it")
+    except ValueError:
+        pass
+    try:
+        control_server = create_control_server(host, port, SchedulerControl(scheduler), token)
+    except OSError as e:
+        log.error(f"can't start the control API on {host}:{port} - {e}")
+        return None
+    control_server.daemon_threads = True
+    threading.Thread(target=control_server.serve_forever, name="control", daemon=True).start()
+    log.notice(f"Control API available on http://{host}:{port}/")
+    return control_server
+
+def stop_control_server():
+    global control_server
+    if control_server is not None:
+        control_server.shutdown()
+        control_server.server_close()
+        control_server = None
@@ -0,0 +1,186 @@
+import os
+import json
+import glob
+import threading
+from datetime import datetime
+from fractions import Fraction
+
+import numpy as np
+
+from session_store import get_session_store
+
+SESSIONS_DIRS_PATTERNS = [
+    "Astro_Sessions",
+    os.path.join("Devices_Sessions", "*", "Astro_Sessions"),
+]
+
+# Overheads (s) of the steps of a session, used while there is no history for a device:
+# session init, eq solving, autofocus, infinite focus, calibration, goto, camera setup, per frame
+STEPS = ["session", "eq_solving", "auto_focus", "infinite_focus", "calibration", "goto", "camera", "frame"]
+DEFAULT_OVERHEADS = np.array([0.0, 60.0, 10.0, 5.0, 70.0, 30.0, 15.0, 1.0])
+
+# Weight of the default overheads in the fit, keeps the steps seldom used near their default value
+RIDGE = 1.0
+MAX_SESSION_DURATION = 24 * 3600
+
+DEVICES = ("D2", "D3")
+
+def get_exposure_seconds(exposure):
+    try:
+        return float(Fraction(str(exposure)))
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+def get_wait(command, action, key):
+    try:
+        return int(command.get(action, {}).get(key, 0) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+# Get the feature vector of a session command and its fixed time (waits and exposures)
+def get_session_features(command):
+    features = np.zeros(len(STEPS))
+    features[0] = 1
+    fixed = 0.0
+
+    for index, action in enumerate(("eq_solving", "auto_focus", "infinite_focus", "calibration"), start=1):
+        if command.get(action, {}).get('do_action'):
+            features[index] = 1
+            fixed += get_wait(command, action, 'wait_before') + get_wait(command, action, 'wait_after')
+
+    for action in ("goto_solar", "goto_manual"):
+        if command.get(action, {}).get('do_action'):
+            features[5] = 1
+            fixed += get_wait(command, action, 'wait_after')
+            break
+
+    for action in ("setup_camera", "setup_wide_camera"):
+        camera = command.get(action, {})
+        if camera.get('do_action'):
+            try:
+                count = int(camera.get('count') or 0)
+            except (TypeError, ValueError):
+                count = 0
+            # a session with both cameras runs both captures
+            features[6] += 1
+            features[7] += count
+            fixed += get_wait(command, action, 'wait_after') + get_exposure_seconds(camera.get('exposure')) * count
+
+    return features, fixed
+
+# Get the measured duration (s) of an ended session, None if it can't be used for the fit
+def get_session_duration(command):
+    id_command = command.get('id_command', {})
+    # failed sessions stop at the failing step and retried ones run several times
+    if id_command.get('result') is not True or int(id_command.get('nb_try', 1) or 1) > 1:
+        return None
+    try:
+        start = datetime.strptime(id_command['starting_date'], "%Y-%m-%d %H:%M:%S")
+        end = datetime.strptime(id_command['processed_date'], "%Y-%m-%d %H:%M:%S")
+    except (KeyError, TypeError, ValueError):
+        return None
+    duration = (end - start).total_seconds()
+    if duration <= 0 or duration > MAX_SESSION_DURATION:
+        return None
+    return duration
+
+class SessionEstimator:
+    """Overheads of the steps of a session per device, fitted on the ended sessions.
+
+    The duration of a session is its waits and exposures plus the overheads of
+    its steps, the overheads are fitted by regularized least squares toward the
+    default values.
+    """
+    def __init__(self):
+        self.overheads = {}  # device -> overheads of STEPS
+        self.nb_sessions = {}
+
+    def fit(self, commands):
+        samples = {}
+        for command in commands:
+            duration = get_session_duration(command)
+            if duration is None:
+                continue
+            device = command.get('id_command', {}).get('dwarf') or DEVICES[0]
+            features, fixed = get_session_features(command)
+            samples.setdefault(device, []).append((features, duration - fixed))
+
+        self.overheads = {}
+        self.nb_sessions = {}
+        for device, device_samples in samples.items():
+            X = np.array([features for features, _ in device_samples])
+            y = np.array([measured for _, measured in device_samples])
+            # solve (X'X + ridge I) delta = X'(y - X b0)
+            residual = y - X @ DEFAULT_OVERHEADS
+            delta = np.linalg.solve(X.T @ X + RIDGE * np.eye(len(STEPS)), X.T @ residual)
+            self.overheads[device] = np.maximum(DEFAULT_OVERHEADS + delta, 0)
+            self.nb_sessions[device] = len(device_samples)
+        return self
+
+    def get_overheads(self, device=None):
+        return self.overheads.get(device or DEVICES[0], DEFAULT_OVERHEADS)
+
+    def estimate(self, command, device=None):
+        """Return the estimated duration (s) of a session command."""
+        features, fixed = get_session_features(command)
+        return float(fixed + features @ self.get_overheads(device))
+
+    def describe(self, device=None):
+        overheads = self.get_overheads(device)
+        return {step: round(float(value), 1) for step, value in zip(STEPS, overheads)}
+
+# Read the ended sessions of a sessions directory, from the session store if enabled
+def read_ended_sessions(sessions_dir):
+    store = get_session_store(sessions_dir)
+    if store is not None:
+        for row in store.list_sessions(["done"]):
+            yield json.loads(row["data"]).get('command', {})
+        return
+
+    done_dir = os.path.join(sessions_dir, "Done")
+    if not os.path.isdir(done_dir):
+        return
+    for filename in os.listdir(done_dir):
+        if filename.endswith('.json'):
+            try:
+                with open(os.path.join(done_dir, filename), 'r') as file:
+                    yield json.load(file).get('command', {})
+            except (OSError, ValueError):
+                continue
+
+def get_sessions_dirs():
+    sessions_dirs = []
+    for pattern in SESSIONS_DIRS_PATTERNS:
+        sessions_dirs.extend(sorted(glob.glob(pattern)))
+    return sessions_dirs
+
+# Fitted estimator, fitted again when a Done folder changes
+estimator_cache = {"signature": None, "estimator": None}
+estimator_lock = threading.Lock()
+
+def get_estimator():
+    sessions_dirs = get_sessions_dirs()
+    signature = []
+    for sessions_dir in sessions_dirs:
+        try:
+            signature.append((sessions_dir, os.stat(os.path.join(sessions_dir, "Done")).st_mtime_ns))
+        except OSError:
+            signature.append((sessions_dir, None))
+    signature = tuple(signature)
+
+    with estimator_lock:
+        if estimator_cache["estimator"] is None or estimator_cache["signature"] != signature:
+            commands = [command for sessions_dir in sessions_dirs for command in read_ended_sessions(sessions_dir)]
+            estimator_cache["estimator"] = SessionEstimator().fit(commands)
+            estimator_cache["signature"] = signature
+        return estimator_cache["estimator"]
+
+# Last fitted estimator, without checking the Done folders
+def get_fitted_estimator():
+    with estimator_lock:
+        estimator = estimator_cache["estimator"]
+    return estimator if estimator is not None else get_estimator()
+
+# Estimated duration (s) of a session command on a device (D2 or D3)
+def estimate_session_duration(command, device=None):
+    return get_estimator().estimate(command, device)
@@ -0,0 +1,93 @@
+import json
+import queue
+import atexit
+import logging
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+import scheduler_config
+
+import dwarf_python_api.lib.my_logger as log
+
+# Events of the sessions, one JSON object per line:
+# session_queued, session_picked, session_skipped, session_flagged, session_deferred, session_started,
+# step_started, step_finished, retry, session_ended, session_cancelled
+DEFAULT_EVENT_LOG = "astro_session_events.jsonl"
+
+events_logger = logging.getLogger("astro_dwarf_session.events")
+events_logger.propagate = False
+events_logger.setLevel(logging.INFO)
+
+event_writer = {"listener": None, "file": None}
+event_writer_lock = threading.Lock()
+event_local = threading.local()  # fields of the session running in the thread
+
+class EventFormatter(logging.Formatter):
+    def format(self, record):
+        return record.getMessage()
+
+# Start the writer thread of the event log, set by event_log in the [SCHEDULER] section of config.ini
+# return False if the event log is disabled
+def start_event_log():
+    filename = scheduler_config.get_option("event_log", DEFAULT_EVENT_LOG)
+    if filename.lower() in ("false", "none", "off"):
+        return False
+    with event_writer_lock:
+        if event_writer["listener"] is not None:
+            return True
+        max_size = scheduler_config.get_float_option("event_log_max_size", 10)
+        backups = scheduler_config.get_int_option("event_log_backups", 5)
+        try:
+            file_handler = RotatingFileHandler(filename, maxBytes=int(max_size * 1024 * 1024), backupCount=backups, encoding="utf-8")
+        except OSError as e:
+            log.error(f"can't open the event log {filename} - {e}")
+            return False
+        file_handler.setFormatter(EventFormatter())
+        # the sessions only put the events in the queue, the listener thread writes them
+        event_queue = queue.SimpleQueue()
+        events_logger.addHandler(QueueHandler(event_queue))
+        listener = QueueListener(event_queue, file_handler)
+        listener.start()
+        event_writer["listener"] = listener
+        event_writer["file"] = filename
+    return True
+
+def stop_event_log():
+    with event_writer_lock:
+        listener = event_writer["listener"]
+        if listener is None:
+            return
+        listener.stop()
+        for handler in list(events_logger.handlers):
+            events_logger.removeHandler(handler)
+        for handler in listener.handlers:
+            handler.close()
+        event_writer["listener"] = None
+
+atexit.register(stop_event_log)
+
+# Fields added to the events of the session run by the thread (uuid, device)
+@contextmanager
+def event_context(**fields):
+    previous = getattr(event_local, "fields", {})
+    event_local.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        event_local.fields = previous
+
+# Write an event, never raises: the event log must not stop a session
+def emit_event(event, **fields):
+    try:
+        if event_writer["listener"] is None and not start_event_log():
+            return
+        now = datetime.now().astimezone()
+        record = {"time": now.isoformat(timespec="milliseconds"), "timestamp": round(now.timestamp(), 3), "event": event}
+        record.update(getattr(event_local, "fields", {}))
+        record.update({key: value for key, value in fields.items() if value is not None})
+        events_logger.info(json.dumps(record, default=str))
+    except Exception as e:
+        log.debug(f"event {event} not logged - {e}")
@@ -0,0 +1,241 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+import dwarf_python_api.lib.my_logger as log
+
+JOURNAL_FILENAME = "transitions.journal"
+TMP_SUFFIX = ".tmp"
+
+# Policies for the sessions found in the Current folder at startup
+RECOVERY_REQUEUE = "requeue"
+RECOVERY_FAIL = "fail"
+
+journal_lock = threading.Lock()
+
+# fsync a directory so a rename in it is durable (not possible on Windows)
+def fsync_directory(dir_path):
+    if os.name != "posix":
+        return
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def get_tmp_path(filepath):
+    dir_path, filename = os.path.split(filepath)
+    return os.path.join(dir_path, f".{filename}{TMP_SUFFIX}")
+
+# Write a JSON file atomically: temporary file, fsync, then os.replace
+def atomic_write_json(filepath, data):
+    tmp_path = get_tmp_path(filepath)
+    try:
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    fsync_directory(os.path.dirname(filepath) or ".")
+
+# Checksum of the content of a session file, as written by the transitions
+def get_text_checksum(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def get_file_checksum(filepath):
+    try:
+        with open(filepath, 'r') as file:
+            return get_text_checksum(file.read())
+    except (OSError, UnicodeDecodeError):
+        return None
+
+class SessionJournal:
+    """Append-only journal of the session transitions of a sessions directory.
+
+    A transition is recorded as "begin" with the checksum of the new content before
+    the files are touched and as "commit" when the session file is in its new folder,
+    a "begin" without "commit" is completed or rolled back by recover().
+    """
+    def __init__(self, sessions_dir):
+        self.sessions_dir = sessions_dir
+        self.path = os.path.join(sessions_dir, JOURNAL_FILENAME)
+        self.next_id = 1
+        self.read_pending()
+
+    def append(self, entry):
+        with journal_lock:
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(entry) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    def read_pending(self):
+        """Return the begin entries without commit."""
+        pending = {}
+        try:
+            with open(self.path, 'r') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # last line partially written during a crash
+                    if entry.get("op") == "begin":
+                        pending[entry["id"]] = entry
+                    elif entry.get("op") == "commit":
+                        pending.pop(entry.get("id"), None)
+                    self.next_id = max(self.next_id, int(entry.get("id", 0)) + 1)
+        except FileNotFoundError:
+            pass
+        return list(pending.values())
+
+    def transition(self, source, destination, program=None):
+        """Move a session file to its new folder, with its updated content if program is given."""
+        with journal_lock:
+            transition_id = self.next_id
+            self.next_id += 1
+        if program is None:
+            checksum = get_file_checksum(source)
+        else:
+            checksum = get_text_checksum(json.dumps(program, indent=4))
+        self.append({
+            "op": "begin",
+            "id": transition_id,
+            "source": source,
+            "destination": destination,
+            "checksum": checksum,
+            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        })
+
+        if program is None:
+            os.replace(source, destination)
+        else:
+            atomic_write_json(destination, program)
+            if os.path.abspath(source) != os.path.abspath(destination):
+                os.remove(source)
+        fsync_directory(os.path.dirname(source) or ".")
+
+        self.append({"op": "commit", "id": transition_id})
+
+    def recover(self):
+        """Complete or roll back the interrupted transitions, then compact the journal."""
+        for entry in self.read_pending():
+            source = entry["source"]
+            destination = entry["destination"]
+            checksum = entry.get("checksum")
+            if os.path.exists(destination) and checksum and get_file_checksum(destination) != checksum:
+                # another file with the same name, the new content has not been written
+                if os.path.exists(source):
+                    log.warning(f"Recovery: {destination} is not the journaled session, transition of {os.path.basename(source)} rolled back")
+                else:
+                    log.error(f"Recovery: {destination} is not the journaled session and {source} is missing")
+            elif os.path.exists(destination):
+                # the new file has been written: complete the transition
+                if os.path.exists(source) and os.path.abspath(source) != os.path.abspath(destination):
+                    os.remove(source)
+                log.notice(f"Recovery: transition of {os.path.basename(source)} to {destination} completed")
+            else:
+                # nothing written yet: the session stays where it was
+                log.notice(f"Recovery: transition of {os.path.basename(source)} to {destination} rolled back")
+            tmp_path = get_tmp_path(destination)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        # all transitions are now committed
+        with journal_lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.next_id = 1
+
+journals = {}  # sessions directory -> SessionJournal
+
+def get_journal(sessions_dir):
+    sessions_dir = os.path.abspath(sessions_dir)
+    with journal_lock:
+        journal = journals.get(sessions_dir)
+        if journal is None:
+            journal = journals[sessions_dir] = SessionJournal(sessions_dir)
+    return journal
+
+# Remove the temporary files left by an interrupted atomic write
+def remove_tmp_files(dir_path):
+    try:
+        for filename in os.listdir(dir_path):
+            if filename.startswith(".") and filename.endswith(TMP_SUFFIX):
+                os.remove(os.path.join(dir_path, filename))
+    except FileNotFoundError:
+        pass
+
+# Reconcile the Current folder at startup
+# a session is requeued at most max_attempts times (recovery_count of its id_command), then moved to Error:
+# a session that crashes the scheduler is not run again on every restart
+# return the list of (filename, state, program) of the sessions moved out of Current
+def recover_sessions(list_astro_dir, policy=RECOVERY_REQUEUE, max_age=None, max_attempts=None):
+    journal = get_journal(list_astro_dir["SESSIONS_DIR"])
+    journal.recover()
+    for dir_key in ("TODO_DIR", "CURRENT_DIR", "DONE_DIR", "ERROR_DIR"):
+        remove_tmp_files(list_astro_dir[dir_key])
+
+    recovered = []
+    try:
+        filenames = [f for f in os.listdir(list_astro_dir["CURRENT_DIR"]) if f.endswith('.json')]
+    except FileNotFoundError:
+        return recovered
+
+    current_datetime = datetime.now()
+    for filename in filenames:
+        source = os.path.join(list_astro_dir["CURRENT_DIR"], filename)
+        try:
+            with open(source, 'r') as file:
+                program = json.load(file)
+            command = program['command']['id_command']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.error(f"Recovery: the file {filename} can't be read, moved to Error - {e}")
+            journal.transition(source, os.path.join(list_astro_dir["ERROR_DIR"], filename))
+            recovered.append((filename, "error", None))
+            continue
+
+        requeue = policy == RECOVERY_REQUEUE
+        message = "Error during execution: session interrupted by a stop of the scheduler"
+        if requeue and max_age is not None and command.get('starting_date'):
+            try:
+                started = datetime.strptime(command['starting_date'], "%Y-%m-%d %H:%M:%S")
+                requeue = current_datetime - started <= timedelta(minutes=max_age)
+            except ValueError:
+                pass
+        try:
+            recovery_count = int(command.get('recovery_count', 0))
+        except (TypeError, ValueError):
+            recovery_count = 0
+        if requeue and max_attempts is not None and recovery_count >= max_attempts:
+            requeue = False
+            message = f"Error during execution: session interrupted {recovery_count + 1} times by a stop of the scheduler"
+
+        if requeue:
+            log.notice(f"Recovery: interrupted session {filename} is requeued")
+            command['process'] = 'wait'
+            command['message'] = "Requeued after an interruption of the scheduler"
+            command['recovery_count'] = recovery_count + 1
+            journal.transition(source, os.path.join(list_astro_dir["TODO_DIR"], filename), program)
+            recovered.append((filename, "todo", program))
+        else:
+            log.notice(f"Recovery: interrupted session {filename} is moved to Error")
+            command['process'] = 'ended'
+            command['result'] = False
+            command['message'] = message
+            command['processed_date'] = current_datetime.strftime("%Y-%m-%d %H:%M:%S")
+            journal.transition(source, os.path.join(list_astro_dir["ERROR_DIR"], filename), program)
+            recovered.append((filename, "error", program))
+    return recovered
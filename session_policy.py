@@ -0,0 +1,144 @@
+import random
+
+import scheduler_config
+
+POLICY_SECTION = 'POLICY'
+SESSION_POLICY = "session"  # policy of the retries of a whole session
+
+# Default policy of a step, overridden by the [POLICY] section of config.ini and the retry_policy of the session
+DEFAULT_POLICY = {
+    "attempts": 1,
+    "backoff": 2.0,
+    "backoff_factor": 2.0,
+    "max_backoff": 60.0,
+    "jitter": 0.2,
+    "deadline": None,
+    "fatal_errors": [],
+    "transient_errors": [],
+    "resume": True,
+    "resume_max_age": 30.0,
+}
+
+# Default policy of some steps, overridden by the [POLICY step_x] sections and the step_x entries of retry_policy
+STEP_POLICIES = {
+    "step_0": {"attempts": 3},
+    "step_12": {"attempts": 5},
+    "step_15": {"attempts": 5},
+    SESSION_POLICY: {"backoff": 30.0, "max_backoff": 300.0},
+}
+
+class SessionFatalError(RuntimeError):
+    """Permanent error of a session step, the step and the session are not retried."""
+
+class SessionCancelledError(SessionFatalError):
+    """The running session has been cancelled, it is stopped at the next step and not retried."""
+
+class SessionDeadlineError(SessionFatalError, TimeoutError):
+    """No answer of the dwarf before the deadline of a step: the call is still running, the session is not retried behind it."""
+
+def parse_list(value):
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    return list(value or [])
+
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+def parse_deadline(value):
+    if value in (None, "", 0, "0"):
+        return None
+    return float(value)
+
+PARSERS = {
+    "attempts": int,
+    "backoff": float,
+    "backoff_factor": float,
+    "max_backoff": float,
+    "jitter": float,
+    "deadline": parse_deadline,
+    "fatal_errors": parse_list,
+    "transient_errors": parse_list,
+    "resume": parse_bool,
+    "resume_max_age": float,
+}
+
+class StepPolicy:
+    """Retry policy of a step: attempts, exponential backoff with jitter, deadline and error classification."""
+    def __init__(self, step, values):
+        self.step = step
+        self.attempts = max(1, values["attempts"])
+        self.backoff = values["backoff"]
+        self.backoff_factor = values["backoff_factor"]
+        self.max_backoff = values["max_backoff"]
+        self.jitter = values["jitter"]
+        self.deadline = values["deadline"]
+        self.fatal_errors = set(values["fatal_errors"])
+        self.transient_errors = set(values["transient_errors"])
+        # session policy: resume a retry after the completed steps, if the checkpoint is younger than resume_max_age minutes
+        self.resume = values["resume"]
+        self.resume_max_age = values["resume_max_age"]
+
+    def get_delay(self, attempt):
+        """Return the wait (s) after the failed attempt number attempt (1 based)."""
+        delay = min(self.backoff * self.backoff_factor ** (attempt - 1), self.max_backoff)
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0)
+
+    def is_fatal(self, error):
+        """An error is fatal if its class (or a parent class) is listed in fatal_errors and not in transient_errors."""
+        names = [cls.__name__ for cls in type(error).__mro__]
+        for name in names:
+            if name in self.transient_errors:
+                return False
+            if name in self.fatal_errors:
+                return True
+        return isinstance(error, SessionFatalError)
+
+# Apply the values of a policy layer, ignoring the invalid ones
+def update_policy(values, layer):
+    for key, parser in PARSERS.items():
+        value = layer.get(key)
+        if value is None or value == "":
+            continue
+        try:
+            values[key] = parser(value)
+        except (TypeError, ValueError):
+            pass
+
+def read_config_layer(section):
+    config = scheduler_config.load_config_ini()
+    if not config.has_section(section):
+        return {}
+    return {key: value.strip() for key, value in config.items(section)}
+
+class SessionPolicies:
+    """Policies of the steps of a session.
+
+    From the lowest to the highest priority: DEFAULT_POLICY, [POLICY] of config.ini,
+    the global values of retry_policy, then for the step STEP_POLICIES,
+    [POLICY step_x] of config.ini and the step_x entry of retry_policy.
+    """
+    def __init__(self, retry_policy=None):
+        self.retry_policy = retry_policy if isinstance(retry_policy, dict) else {}
+        self.policies = {}
+
+    def get(self, step):
+        policy = self.policies.get(step)
+        if policy is None:
+            values = dict(DEFAULT_POLICY)
+            update_policy(values, read_config_layer(POLICY_SECTION))
+            update_policy(values, self.retry_policy)
+            update_policy(values, STEP_POLICIES.get(step, {}))
+            update_policy(values, read_config_layer(f"{POLICY_SECTION} {step}"))
+            step_layer = self.retry_policy.get(step)
+            if isinstance(step_layer, dict):
+                update_policy(values, step_layer)
+            policy = self.policies[step] = StepPolicy(step, values)
+        return policy
+
+# Get the policies of a session command
+def get_session_policies(command):
+    return SessionPolicies(command.get('id_command', {}).get('retry_policy'))
@@ -0,0 +1,141 @@
+import heapq
+import itertools
+from datetime import datetime, timedelta
+
+# Orders of the due sessions
+POLICY_EDF = "edf"            # earliest deadline first, then highest priority
+POLICY_PRIORITY = "priority"  # highest priority first, then earliest deadline
+POLICY_FIFO = "fifo"          # earliest execution time first
+QUEUE_POLICIES = (POLICY_EDF, POLICY_PRIORITY, POLICY_FIFO)
+
+NO_DEADLINE = datetime.max
+
+class SessionQueue:
+    """Pending sessions of the ToDo directory.
+
+    The waiting heap keeps (due, seq, filename) entries ordered by execution time,
+    the sessions whose time is reached are moved to the ready heap ordered by the policy.
+    An updated or removed file leaves a stale entry in the heaps that is dropped
+    when it reaches the head.
+    """
+    def __init__(self, directory=None, policy=POLICY_EDF):
+        self.directory = directory
+        self.policy = policy
+        self.waiting = []
+        self.ready = []
+        self.entries = {}  # filename -> (due, seq, priority, deadline)
+        self.counter = itertools.count()
+
+    def get_ready_key(self, entry):
+        due, _, priority, deadline = entry
+        deadline = deadline or NO_DEADLINE
+        if self.policy == POLICY_FIFO:
+            return (due,)
+        if self.policy == POLICY_PRIORITY:
+            return (-priority, deadline, due)
+        return (deadline, -priority, due)
+
+    def set_policy(self, policy):
+        """Change the order of the due sessions, the ready heap is sorted again."""
+        if policy == self.policy:
+            return
+        self.policy = policy
+        self.ready = [(self.get_ready_key(self.entries[filename]), seq, filename)
+                      for _, seq, filename in self.ready if self.is_valid(filename, seq)]
+        heapq.heapify(self.ready)
+
+    def push(self, filename, due, priority=0, deadline=None):
+        """Add the file to the queue, or update its execution time, priority and deadline."""
+        seq = next(self.counter)
+        self.entries[filename] = (due, seq, priority, deadline)
+        heapq.heappush(self.waiting, (due, seq, filename))
+
+    def remove(self, filename):
+        return self.entries.pop(filename, None) is not None
+
+    def is_valid(self, filename, seq):
+        entry = self.entries.get(filename)
+        return entry is not None and entry[1] == seq
+
+    def promote(self, now):
+        """Move the sessions whose execution time is reached to the ready heap."""
+        while self.waiting:
+            due, seq, filename = self.waiting[0]
+            if not self.is_valid(filename, seq):
+                heapq.heappop(self.waiting)
+                continue
+            if due > now:
+                break
+            heapq.heappop(self.waiting)
+            heapq.heappush(self.ready, (self.get_ready_key(self.entries[filename]), seq, filename))
+
+    def get_ready(self, now):
+        """Return the filenames of the due sessions in the order of the policy."""
+        self.promote(now)
+        ready = [(key, seq, filename) for key, seq, filename in self.ready if self.is_valid(filename, seq)]
+        return [filename for _, _, filename in sorted(ready)]
+
+    def peek_ready(self, now):
+        """Return the next due session to execute, None if no session is due."""
+        self.promote(now)
+        while self.ready:
+            _, seq, filename = self.ready[0]
+            if self.is_valid(filename, seq):
+                return filename
+            heapq.heappop(self.ready)
+        return None
+
+    def peek(self):
+        """Return (filename, due) of the waiting session with the earliest execution time, None if none."""
+        while self.waiting:
+            due, seq, filename = self.waiting[0]
+            if self.is_valid(filename, seq):
+                return filename, due
+            heapq.heappop(self.waiting)
+        return None
+
+    def pop(self, filename):
+        """Remove a session taken for execution, its heap entries become stale."""
+        return self.entries.pop(filename, None)
+
+    def get_entry(self, filename):
+        return self.entries.get(filename)
+
+    def due_time(self, filename):
+        entry = self.entries.get(filename)
+        return entry[0] if entry else None
+
+    def forecast(self, start, get_duration):
+        """Return [(filename, start, end)] of the queued sessions run one after the other from start.
+
+        get_duration(filename) is the expected duration (s) of a session, the order follows the policy.
+        """
+        waiting = sorted((entry[0], entry[1], filename) for filename, entry in self.entries.items())
+        ready = []
+        plan = []
+        now = start
+        index = 0
+        while index < len(waiting) or ready:
+            if not ready and waiting[index][0] > now:
+                now = waiting[index][0]
+            while index < len(waiting) and waiting[index][0] <= now:
+                due, seq, filename = waiting[index]
+                heapq.heappush(ready, (self.get_ready_key(self.entries[filename]), seq, filename))
+                index += 1
+            _, _, filename = heapq.heappop(ready)
+            end = now + timedelta(seconds=get_duration(filename))
+            plan.append((filename, now, end))
+            now = end
+        return plan
+
+    def clear(self, directory=None):
+        self.directory = directory
+        self.waiting = []
+        self.ready = []
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, filename):
+        return filename in self.entries
@@ -0,0 +1,337 @@
+import os
+import csv
+import json
+import math
+import time
+import random
+import shutil
+import threading
+from datetime import datetime
+
+import scheduler_config
+from session_estimator import get_exposure_seconds
+
+import config_snapshot
+import dwarf_python_api.lib.my_logger as log
+
+SIMULATION_SECTION = 'SIMULATION'
+SIMULATION_DIR = os.path.join(os.path.abspath("."), "Simulation_Sessions")
+SIMULATED_IP = "simulator"
+
+# Simulated calls to the dwarf: mean latency (s) and failure rate,
+# overridden by the [SIMULATION] section of config.ini, e.g. perform_goto = 25, 0.03
+SIMULATED_CALLS = {
+    "perform_time": (0.5, 0.01),
+    "perform_timezone": (0.5, 0.0),
+    "perform_disconnect": (0.2, 0.0),
+    "perform_GoLive": (1.0, 0.01),
+    "perform_stop_goto": (1.0, 0.01),
+    "perform_start_autofocus": (20.0, 0.05),
+    "start_polar_align": (90.0, 0.05),
+    "perform_calibration": (60.0, 0.05),
+    "perform_goto": (25.0, 0.03),
+    "perform_goto_stellar": (25.0, 0.03),
+    "perform_update_camera_setting": (0.3, 0.01),
+    "perform_get_all_camera_setting": (0.3, 0.0),
+    "perform_get_all_feature_camera_setting": (0.3, 0.0),
+    "perform_get_all_camera_wide_setting": (0.3, 0.0),
+    "perform_takeAstroPhoto": (1.0, 0.01),
+    "perform_takeAstroWidePhoto": (1.0, 0.01),
+    # after the exposures of the capture
+    "perform_waitEndAstroPhoto": (2.0, 0.01),
+    "perform_waitEndAstroWidePhoto": (2.0, 0.01),
+}
+
+# Spread of the latencies (sigma of a log-normal distribution)
+LATENCY_SIGMA = 0.3
+
+class VirtualClock:
+    """Clock of the simulation: sleeping only moves the time forward."""
+    def __init__(self, start=None):
+        self.lock = threading.Lock()
+        self.start = start or datetime.now()
+        self.elapsed = 0.0
+
+    def sleep(self, seconds):
+        if seconds and seconds > 0:
+            with self.lock:
+                self.elapsed += seconds
+
+    def monotonic(self):
+        with self.lock:
+            return self.elapsed
+
+    def time(self):
+        return self.start.timestamp() + self.monotonic()
+
+    def now(self, tz=None):
+        return datetime.fromtimestamp(self.time(), tz)
+
+# Replacement of the time module in the simulated modules
+class VirtualTime:
+    def __init__(self, clock):
+        self.clock = clock
+        self.sleep = clock.sleep
+        self.monotonic = clock.monotonic
+        self.perf_counter = clock.monotonic
+        self.time = clock.time
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+# Replacement of the cancellable waits of the sessions: the virtual clock moves, the cancel is checked before and after
+def get_virtual_wait(clock):
+    def wait_cancellable(seconds, cancel_event=None):
+        if cancel_event is not None and cancel_event.is_set():
+            return True
+        clock.sleep(seconds)
+        return cancel_event is not None and cancel_event.is_set()
+    return wait_cancellable
+
+# Replacement of the datetime class in the simulated modules
+def get_virtual_datetime(clock):
+    class VirtualDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock.now(tz)
+    return VirtualDatetime
+
+class SimulatedDwarf:
+    """Mock of the dwarf_python_api calls used by the sessions, with random latencies and failures."""
+    def __init__(self, clock, seed=None):
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.settings = {}
+        self.capture_end = 0.0
+        self.calls = {}  # function -> (calls, failures)
+        self.latency_scale = scheduler_config.get_float_option("latency_scale", 1.0, SIMULATION_SECTION)
+        self.failure_scale = scheduler_config.get_float_option("failure_scale", 1.0, SIMULATION_SECTION)
+        self.profiles = {}
+        for name, (latency, failure_rate) in SIMULATED_CALLS.items():
+            value = scheduler_config.get_option(name.lower(), "", SIMULATION_SECTION)
+            if value:
+                try:
+                    latency, failure_rate = (float(item) for item in value.split(","))
+                except ValueError:
+                    log.warning(f"invalid simulation profile for {name}: {value}")
+            self.profiles[name] = (latency * self.latency_scale, min(failure_rate * self.failure_scale, 1.0))
+
+    def call(self, name, result=True, extra=0.0):
+        latency, failure_rate = self.profiles[name]
+        # log-normal latency with the given mean
+        delay = latency * math.exp(self.random.gauss(-LATENCY_SIGMA ** 2 / 2, LATENCY_SIGMA)) if latency > 0 else 0
+        self.clock.sleep(delay + extra)
+        calls, failures = self.calls.get(name, (0, 0))
+        failed = self.random.random() < failure_rate
+        self.calls[name] = (calls + 1, failures + (1 if failed else 0))
+        if failed:
+            if self.random.random() < 0.5:
+                raise TimeoutError(f"simulated timeout of {name}")
+            return False
+        return result
+
+    def get_capture_time(self, prefix=""):
+        try:
+            count = int(float(self.settings.get("count", 0) or 0))
+        except ValueError:
+            count = 0
+        return count * get_exposure_seconds(self.settings.get(f"{prefix}exposure", 0))
+
+    # the exposures run on the dwarf from the start of the capture, the wait of its end lasts the time left
+    def start_capture(self, name, prefix=""):
+        result = self.call(name)
+        if result:
+            self.capture_end = self.clock.monotonic() + self.get_capture_time(prefix)
+        return result
+
+    def get_capture_left(self):
+        return max(self.capture_end - self.clock.monotonic(), 0.0)
+
+    def update_camera_setting(self, setting, value, *args):
+        result = self.call("perform_update_camera_setting")
+        if result:
+            self.settings[setting] = str(value)
+        return result
+
+    def read_camera_data(self, camera_state=None, verbose=True):
+        self.call("perform_get_all_camera_setting")
+        self.call("perform_get_all_feature_camera_setting")
+        if camera_state is not None:
+            camera_state.set_read({setting: value for setting, value in self.settings.items() if not setting.startswith("wide_")})
+
+    def read_wide_camera_data(self, camera_state=None, verbose=True):
+        self.call("perform_get_all_camera_wide_setting")
+        if camera_state is not None:
+            camera_state.set_read({setting: value for setting, value in self.settings.items() if setting.startswith("wide_") or setting == "count"})
+
+    def get_functions(self):
+        """Return the replacements of the functions of dwarf_session."""
+        functions = {name: (lambda name: lambda *args: self.call(name))(name) for name in SIMULATED_CALLS}
+        functions["perform_get_all_camera_setting"] = lambda: self.call("perform_get_all_camera_setting", {"all_params": []})
+        functions["perform_update_camera_setting"] = self.update_camera_setting
+        functions["perform_takeAstroPhoto"] = lambda: self.start_capture("perform_takeAstroPhoto")
+        functions["perform_takeAstroWidePhoto"] = lambda: self.start_capture("perform_takeAstroWidePhoto", "wide_")
+        functions["perform_waitEndAstroPhoto"] = lambda: self.call("perform_waitEndAstroPhoto", extra=self.get_capture_left())
+        functions["perform_waitEndAstroWidePhoto"] = lambda: self.call("perform_waitEndAstroWidePhoto", extra=self.get_capture_left())
+        functions["print_camera_data"] = self.read_camera_data
+        functions["print_wide_camera_data"] = self.read_wide_camera_data
+        return functions
+
+class SimulatedWatcher:
+    """ToDo watcher of the simulation: waiting moves the virtual clock, the simulation ends when the queue is empty."""
+    def __init__(self, simulation):
+        self.simulation = simulation
+
+    def wait(self, timeout):
+        if len(self.simulation.context.session_queue) == 0:
+            self.simulation.finished = True
+        else:
+            self.simulation.clock.sleep(timeout)
+        return set()
+
+    def wake(self):
+        pass
+
+    def close(self):
+        pass
+
+class Simulation:
+    """Run the ToDo sessions of a sessions directory with a simulated dwarf and a virtual clock."""
+    def __init__(self, sessions_dir, dwarf_id=2, seed=None):
+        import astro_dwarf_scheduler
+        self.scheduler = astro_dwarf_scheduler
+        self.sessions_dir = sessions_dir
+        self.dwarf_id = dwarf_id
+        self.clock = VirtualClock()
+        self.dwarf = SimulatedDwarf(self.clock, seed)
+        self.context = astro_dwarf_scheduler.SchedulerContext(None, astro_dwarf_scheduler.get_sessions_dirs(sessions_dir))
+        self.finished = False
+        self.patched = []
+
+    def patch(self, module, name, value):
+        self.patched.append((module, name, getattr(module, name)))
+        setattr(module, name, value)
+
+    def install(self):
+        import dwarf_session
+        import camera_state
+        import session_journal
+        import session_store
+        import session_events
+
+        virtual_time = VirtualTime(self.clock)
+        virtual_datetime = get_virtual_datetime(self.clock)
+        for module in (self.scheduler, dwarf_session, camera_state):
+            self.patch(module, "time", virtual_time)
+        for module in (self.scheduler, dwarf_session, session_journal, session_store, session_events):
+            self.patch(module, "datetime", virtual_datetime)
+        virtual_wait = get_virtual_wait(self.clock)
+        for module in (self.scheduler, dwarf_session):
+            self.patch(module, "wait_cancellable", virtual_wait)
+
+        for name, function in self.dwarf.get_functions().items():
+            if hasattr(dwarf_session, name):
+                self.patch(dwarf_session, name, function)
+            if hasattr(self.scheduler, name):
+                self.patch(self.scheduler, name, function)
+        self.patch(self.scheduler, "create_watcher", lambda directory: SimulatedWatcher(self))
+        # the virtual clock only drives the waits of the blocking runner
+        self.patch(self.scheduler, "get_session_runner", lambda: "thread")
+
+        config_data = {}
+        try:
+            config_data = config_snapshot.get_config_data()
+        except Exception:
+            pass
+        # the config stores the dwarf id minus one
+        config_data = dict(config_data, ip=SIMULATED_IP, dwarf_id=str(self.dwarf_id - 1))
+        self.patch(config_snapshot, "get_config_data", lambda *args, **kwargs: dict(config_data))
+
+    def uninstall(self):
+        while self.patched:
+            module, name, value = self.patched.pop()
+            setattr(module, name, value)
+
+    def run(self):
+        todo_dir = self.context.list_astro_dir["TODO_DIR"]
+        filenames = sorted(filename for filename in os.listdir(todo_dir) if filename.endswith('.json'))
+        log.notice(f"Simulation of {len(filenames)} sessions of {todo_dir}")
+        real_start = time.monotonic()
+        self.install()
+        try:
+            self.scheduler.run_scheduler_loop(False, lambda: not self.finished, self.context)
+        finally:
+            self.uninstall()
+        report = self.get_report(filenames)
+        self.print_report(report, time.monotonic() - real_start)
+        self.write_report(report)
+        return report
+
+    def get_report(self, filenames):
+        report = []
+        astro_dir = self.context.list_astro_dir
+        for filename in filenames:
+            for state, key in (("done", "DONE_DIR"), ("error", "ERROR_DIR"), ("todo", "TODO_DIR"), ("current", "CURRENT_DIR")):
+                filepath = os.path.join(astro_dir[key], filename)
+                if os.path.isfile(filepath):
+                    try:
+                        with open(filepath, 'r') as file:
+                            id_command = json.load(file).get('command', {}).get('id_command', {})
+                    except (OSError, ValueError):
+                        id_command = {}
+                    report.append((filename, state, id_command))
+                    break
+        return report
+
+    def print_report(self, report, real_duration):
+        log.notice("######################")
+        log.notice(f"Simulation ended: {self.clock.elapsed / 3600:.2f}h of night simulated in {real_duration:.1f}s")
+        step_totals = {}
+        for filename, state, id_command in report:
+            timings = id_command.get('timings', {})
+            log.notice(f"  {filename}: {state}, {id_command.get('starting_date', '-')} -> {id_command.get('processed_date', '-')}, "
+                       f"{id_command.get('nb_try', '-')} tries, {timings.get('total', 0)}s")
+            for step, timing in timings.items():
+                if isinstance(timing, dict):
+                    total = step_totals.setdefault(step, {"time": 0.0, "calls": 0, "failed": 0})
+                    for key in total:
+                        total[key] += timing.get(key, 0)
+        log.notice("Time per step:")
+        for step, total in sorted(step_totals.items(), key=lambda item: -item[1]["time"]):
+            log.notice(f"  {step}: {total['time']:.1f}s, {total['calls']} calls, {total['failed']} failed")
+        for name, (calls, failures) in sorted(self.dwarf.calls.items()):
+            log.debug(f"  {name}: {calls} calls, {failures} failures")
+        log.notice("######################")
+
+    def write_report(self, report):
+        results_dir = self.context.list_astro_dir["RESULTS_DIR"]
+        os.makedirs(results_dir, exist_ok=True)
+        csv_path = os.path.join(results_dir, f"simulation_{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}.csv")
+        steps = sorted({step for _, _, id_command in report for step, timing in id_command.get('timings', {}).items() if isinstance(timing, dict)},
+                       key=lambda step: (len(step), step))
+        with open(csv_path, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["file", "state", "uuid", "starting_date", "processed_date", "nb_try", "total_time"] + [f"{step}_time" for step in steps])
+            for filename, state, id_command in report:
+                timings = id_command.get('timings', {})
+                writer.writerow([filename, state, id_command.get('uuid', ''), id_command.get('starting_date', ''), id_command.get('processed_date', ''),
+                                 id_command.get('nb_try', ''), timings.get('total', '')] + [timings.get(step, {}).get('time', '') for step in steps])
+        log.notice(f"Simulation report: {csv_path}")
+
+# Prepare the simulation directory, its ToDo folder is filled with a copy of the ToDo sessions of source_dir if empty
+def prepare_simulation_dir(sessions_dir, source_dir=None):
+    for subdir in ("ToDo", "Current", "Done", "Error", "Results"):
+        os.makedirs(os.path.join(sessions_dir, subdir), exist_ok=True)
+    todo_dir = os.path.join(sessions_dir, "ToDo")
+    if source_dir and not any(filename.endswith('.json') for filename in os.listdir(todo_dir)):
+        source_todo = os.path.join(source_dir, "ToDo")
+        if os.path.isdir(source_todo):
+            for filename in os.listdir(source_todo):
+                if filename.endswith('.json'):
+                    shutil.copy2(os.path.join(source_todo, filename), todo_dir)
+
+def run_simulation(sessions_dir=None, source_dir=None, dwarf_id=2):
+    sessions_dir = sessions_dir or SIMULATION_DIR
+    prepare_simulation_dir(sessions_dir, source_dir)
+    seed = scheduler_config.get_option("seed", "", SIMULATION_SECTION) or None
+    return Simulation(sessions_dir, dwarf_id, seed).run()
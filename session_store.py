@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+import scheduler_config
+
+STORE_FILENAME = "sessions.db"
+
+# Session states and their folder in the sessions directory, "available" sessions are in the sessions directory itself
+STATE_DIRS = {
+    "available": "",
+    "todo": "ToDo",
+    "current": "Current",
+    "done": "Done",
+    "error": "Error",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    filename TEXT PRIMARY KEY,
+    uuid TEXT,
+    state TEXT NOT NULL,
+    due TEXT,
+    device TEXT,
+    target TEXT,
+    description TEXT,
+    result INTEGER,
+    processed_date TEXT,
+    data TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_state ON sessions (state, due);
+CREATE INDEX IF NOT EXISTS idx_sessions_due ON sessions (due);
+CREATE INDEX IF NOT EXISTS idx_sessions_device ON sessions (device);
+CREATE INDEX IF NOT EXISTS idx_sessions_target ON sessions (target);
+CREATE INDEX IF NOT EXISTS idx_sessions_uuid ON sessions (uuid);
+"""
+
+# Get the target of a session program
+def get_program_target(program):
+    command = program.get('command', {})
+    if command.get('goto_manual', {}).get('do_action'):
+        return command['goto_manual'].get('target', "")
+    if command.get('goto_solar', {}).get('do_action'):
+        return command['goto_solar'].get('target', "")
+    return command.get('id_command', {}).get('description', "")
+
+class SessionStore:
+    """SQLite index of the sessions of a sessions directory, one row per session file."""
+    def __init__(self, sessions_dir):
+        self.sessions_dir = sessions_dir
+        self.db_path = os.path.join(sessions_dir, STORE_FILENAME)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+            self.connection.commit()
+
+    def record(self, filename, state, program=None):
+        """Insert or update a session, program None only updates the state."""
+        updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock, self.connection:
+            if program is None:
+                self.connection.execute(
+                    "UPDATE sessions SET state = ?, updated = ? WHERE filename = ?",
+                    (state, updated, filename))
+                return
+
+            command = program.get('command', {}).get('id_command') or {}
+            due = None
+            if command.get('date') and command.get('time'):
+                due = f"{command['date']} {command['time']}"
+            result = command.get('result')
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sessions "
+                "(filename, uuid, state, due, device, target, description, result, processed_date, data, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (filename, command.get('uuid'), state, due, command.get('dwarf'),
+                 get_program_target(program), command.get('description'),
+                 None if result is None else int(bool(result)),
+                 command.get('processed_date'), json.dumps(program), updated))
+
+    def remove(self, filename):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM sessions WHERE filename = ?", (filename,))
+
+    def get(self, filename):
+        """Return (state, program) of a session, None if unknown."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT state, data FROM sessions WHERE filename = ?", (filename,)).fetchone()
+        return (row["state"], json.loads(row["data"])) if row else None
+
+    def list_sessions(self, states=None, device=None, target=None, due_before=None):
+        """Return the rows matching the filters ordered by due time, data holds the session program."""
+        query = "SELECT * FROM sessions"
+        clauses = []
+        params = []
+        if states:
+            clauses.append(f"state IN ({', '.join('?' * len(states))})")
+            params.extend(states)
+        if device:
+            clauses.append("device = ?")
+            params.append(device)
+        if target:
+            clauses.append("target = ?")
+            params.append(target)
+        if due_before:
+            clauses.append("due <= ?")
+            params.append(due_before)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY due, filename"
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(query, params)]
+
+    def count_by_state(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT state, COUNT(*) AS nb FROM sessions GROUP BY state")
+            return {row["state"]: row["nb"] for row in rows}
+
+    def import_directories(self, states=None):
+        """Synchronize the store with the session files of the folder layout, return the number of files."""
+        imported = 0
+        for state, subdir in STATE_DIRS.items():
+            if states and state not in states:
+                continue
+            dir_path = os.path.join(self.sessions_dir, subdir)
+            if not os.path.isdir(dir_path):
+                continue
+
+            filenames = set()
+            for filename in os.listdir(dir_path):
+                if not filename.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(dir_path, filename), 'r') as file:
+                        program = json.load(file)
+                except (OSError, ValueError):
+                    continue
+                self.record(filename, state, program)
+                filenames.add(filename)
+                imported += 1
+
+            # remove the sessions of this state that are not anymore in the folder
+            with self.lock, self.connection:
+                known = [row["filename"] for row in self.connection.execute(
+                    "SELECT filename FROM sessions WHERE state = ?", (state,))]
+                self.connection.executemany(
+                    "DELETE FROM sessions WHERE filename = ?",
+                    [(filename,) for filename in known if filename not in filenames])
+        return imported
+
+    def export_directories(self, states=None):
+        """Write the sessions of the store as JSON files in the folder layout, return the number of files."""
+        exported = 0
+        for row in self.list_sessions(states):
+            dir_path = os.path.join(self.sessions_dir, STATE_DIRS.get(row["state"], ""))
+            os.makedirs(dir_path, exist_ok=True)
+            with open(os.path.join(dir_path, row["filename"]), 'w') as file:
+                json.dump(json.loads(row["data"]), file, indent=4)
+            exported += 1
+        return exported
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+session_stores = {}  # sessions directory -> opened SessionStore
+session_stores_lock = threading.Lock()
+
+# Return the store of a sessions directory, None if the sqlite store is not enabled in config.ini
+def get_session_store(sessions_dir):
+    if scheduler_config.get_option("session_store", "files").lower() != "sqlite":
+        return None
+
+    sessions_dir = os.path.abspath(sessions_dir)
+    with session_stores_lock:
+        store = session_stores.get(sessions_dir)
+        if store is None:
+            os.makedirs(sessions_dir, exist_ok=True)
+            store = SessionStore(sessions_dir)
+            # first opening: synchronize with the folder layout
+            store.import_directories()
+            session_stores[sessions_dir] = store
+    return store
+
+if __name__ == "__main__":
+    # python session_store.py --import|--export [sessions_dir]
+    if len(sys.argv) < 2 or sys.argv[1] not in ("--import", "--export"):
+        print("Usage: python session_store.py --import|--export [sessions_dir]")
+        sys.exit(1)
+
+    store = SessionStore(sys.argv[2] if len(sys.argv) > 2 else "Astro_Sessions")
+    if sys.argv[1] == "--import":
+        print(f"{store.import_directories()} sessions imported in {store.db_path}")
+    else:
+        print(f"{store.export_directories()} sessions exported from {store.db_path}")
+    store.close()
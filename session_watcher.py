@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import threading
+
+import dwarf_python_api.lib.my_logger as log
+
+# inotify flags (see linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# A file is only reported once it has been completely written, moved or deleted
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# struct inotify_event header: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct("iIII")
+
+# Default interval between two scans of the directory for the stat backend (s)
+STAT_POLL_INTERVAL = 2
+
+class InotifyWatcher:
+    """Watch a directory with the Linux inotify interface."""
+    def __init__(self, directory):
+        import ctypes
+        import ctypes.util
+
+        self.directory = directory
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {directory}")
+
+        # self pipe used to interrupt a pending wait
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+
+    def wait(self, timeout):
+        """Block until the directory changes or the timeout (s) expires, return the changed filenames."""
+        changes = set()
+        try:
+            ready, _, _ = select.select([self.fd, self.wake_read], [], [], max(0, timeout))
+        except InterruptedError:
+            return changes
+
+        if self.wake_read in ready:
+            self._drain(self.wake_read)
+        if self.fd in ready:
+            changes = self._read_events()
+        return changes
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        for fd in (self.fd, self.wake_read, self.wake_write):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _read_events(self):
+        changes = set()
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not buffer:
+                break
+
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(buffer):
+                _, mask, _, name_len = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    log.warning(f"The watched directory {self.directory} has been removed or moved")
+                if name:
+                    changes.add(os.fsdecode(name))
+        return changes
+
+    def _drain(self, fd):
+        try:
+            while os.read(fd, 1024):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+class StatWatcher:
+    """Portable watcher comparing successive os.scandir snapshots of a directory."""
+    def __init__(self, directory, poll_interval=STAT_POLL_INTERVAL):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.wake_event = threading.Event()
+        self.snapshot = self._scan()
+
+    def wait(self, timeout):
+        """Block until the directory changes or the timeout (s) expires, return the changed filenames."""
+        deadline = time.monotonic() + max(0, timeout)
+        while True:
+            remaining = deadline - time.monotonic()
+            if self.wake_event.wait(max(0, min(self.poll_interval, remaining))):
+                self.wake_event.clear()
+                return self._diff()
+
+            changes = self._diff()
+            if changes or time.monotonic() >= deadline:
+                return changes
+
+    def wake(self):
+        self.wake_event.set()
+
+    def close(self):
+        self.wake_event.set()
+
+    def _scan(self):
+        snapshot = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except FileNotFoundError:
+            pass
+        return snapshot
+
+    def _diff(self):
+        snapshot = self._scan()
+        changes = {name for name in snapshot.keys() | self.snapshot.keys()
+                   if snapshot.get(name) != self.snapshot.get(name)}
+        self.snapshot = snapshot
+        return changes
+
+def create_watcher(directory):
+    """Return the best watcher available for the directory: inotify on Linux, stat polling elsewhere."""
+    if sys.platform.startswith("linux"):
+        try:
+            watcher = InotifyWatcher(directory)
+            log.debug(f"Watching {directory} with inotify")
+            return watcher
+        except (OSError, AttributeError) as e:
+            log.warning(f"inotify not available ({e}), using directory polling")
+
+    log.debug(f"Watching {directory} with directory polling")
+    return StatWatcher(directory)
@@ -1,18 +1,24 @@
-import json
-from urllib import request
+import requests
+
+from http_client import get_http_client
+
+# Lifetime (s) of a cached answer: repeated clicks on Refresh, short enough to follow the selection in Stellarium
+STELLARIUM_CACHE_TTL = 1.0
 
 class StellariumConnection:
-    def __init__(self, ip='127.0.0.1', port=8095):
+    def __init__(self, ip='127.0.0.1', port=8095, ttl=STELLARIUM_CACHE_TTL):
         self.ip = ip
         self.port = port
+        # the connections to Stellarium are kept alive between two refreshes
+        self.client = get_http_client("stellarium")
+        self.ttl = ttl
 
     def get_data(self):
         url = f"http://{self.ip}:{self.port}/api/objects/info?format=json"
         try:
-            with request.urlopen(url) as response:
-                if response.status == 200:
-                    return json.loads(response.read().decode())
-                else:
-                    raise Exception(f"Failed to retrieve data: {response.status}")
-        except Exception as e:
-            raise Exception(f"Error connecting to Stellarium: {e}")
\ No newline at end of file
+            status_code, data = self.client.get_json(url, ttl=self.ttl)
+        except requests.RequestException as e:
+            raise Exception(f"Error connecting to Stellarium: {e}")
+        if status_code != 200 or data is None:
+            raise Exception(f"Error connecting to Stellarium: Failed to retrieve data: {status_code}")
+        return data
@@ -8,6 +8,10 @@ import re
 from fractions import Fraction
 import csv
 from stellarium_connection import StellariumConnection
+from session_store import get_session_store
+from session_estimator import estimate_session_duration
+from mosaic_order import order_panes, ORDER_SHORTEST
+import scheduler_config
 
 from dwarf_python_api.lib.data_utils import allowed_exposures, allowed_gains
 from dwarf_python_api.lib.data_wide_utils import allowed_wide_exposures, allowed_wide_gains
@@ -385,6 +389,7 @@ def save_to_json(settings_vars, config_vars):
     # Save the data to a JSON file
     with open(filepath, 'w') as outfile:
         json.dump(data, outfile, indent=4)
+    record_available_session(filename, data)
 
     # Calculate the end time and update the date and time fields
     end_date, end_time = calculate_end_time(settings_vars)
@@ -464,42 +469,33 @@ def calculate_end_time(settings_vars):
 
         count = int(settings_vars["count"].get())
 
-        # add wait time init to 
-        wait_time = 0  
-        if settings_vars["eq_solving"].get():
-          # wait time actions
-          wait_time += 60
-          wait_time += int(settings_vars.get("wait_before", 0).get())
-          wait_time += int(settings_vars.get("wait_after", 0).get())
-        if settings_vars["auto_focus"].get():
-          # wait time actions
-          wait_time += 10
-          wait_time += int(settings_vars.get("wait_before", 0).get())
-          wait_time += int(settings_vars.get("wait_after", 0).get())
-        if settings_vars["infinite_focus"].get():
-          # wait time actions
-          wait_time += 5
-          wait_time += int(settings_vars.get("wait_before", 0).get())
-          wait_time += int(settings_vars.get("wait_after", 0).get())
-        if settings_vars["calibration"].get():
-          # wait between actions and time actions
-          wait_time += 10 + 60
-          wait_time += int(settings_vars.get("wait_before", 0).get())
-          wait_time += int(settings_vars.get("wait_after", 0).get())
-        if settings_vars["goto_solar"].get() or settings_vars["goto_manual"].get():
-          wait_time += 30
-          wait_time += int(settings_vars.get("wait_after_target", 0).get())
-
-        # wait time setup camera
-        wait_time += 15
-        wait_time += int(settings_vars.get("wait_after_camera", 0).get())
+        # estimate the duration from the overheads learned on the ended sessions
+        wait_before = int(settings_vars.get("wait_before", 0).get())
+        wait_after = int(settings_vars.get("wait_after", 0).get())
+        command = {
+            "eq_solving": {"do_action": settings_vars["eq_solving"].get(), "wait_before": wait_before, "wait_after": wait_after},
+            "auto_focus": {"do_action": settings_vars["auto_focus"].get(), "wait_before": wait_before, "wait_after": wait_after},
+            "infinite_focus": {"do_action": settings_vars["infinite_focus"].get(), "wait_before": wait_before, "wait_after": wait_after},
+            "calibration": {"do_action": settings_vars["calibration"].get(), "wait_before": wait_before, "wait_after": wait_after},
+            "goto_manual": {
+                "do_action": settings_vars["goto_solar"].get() or settings_vars["goto_manual"].get(),
+                "wait_after": int(settings_vars.get("wait_after_target", 0).get())
+            },
+            "setup_camera": {
+                "do_action": True,
+                "exposure": exposure_seconds,
+                "count": count,
+                "wait_after": int(settings_vars.get("wait_after_camera", 0).get())
+            },
+        }
+        device = "D2" if settings_vars["device_type"].get() == "Dwarf II" else "D3"
 
         # Combine date and time into a single datetime object
         start_datetime_str = f"{start_date_str} {start_time_str}"
         start_datetime = datetime.datetime.strptime(start_datetime_str, '%Y-%m-%d %H:%M:%S')
 
-        # Calculate the total exposure time
-        total_exposure_time = wait_time + (exposure_seconds + 1) * count 
+        # Calculate the total session time
+        total_exposure_time = estimate_session_duration(command, device)
 
         # Calculate end time
         end_datetime = start_datetime + datetime.timedelta(seconds=total_exposure_time)
@@ -533,7 +529,8 @@ def import_csv_and_generate_json(settings_vars, config_vars):
             # Sort the rows by the first column (csv_reader.fieldnames[0])
             sorted_rows = sorted(csv_reader, key=lambda row: row[csv_reader.fieldnames[0]])
 
-            # Process each sorted row
+            # Read the targets of the sorted rows
+            targets = []
             for row in sorted_rows:
                # Determine which format is being used by checking the presence of certain keys
                 if 'Pane' in row and 'RA' in row and 'DEC' in row:
@@ -567,8 +564,19 @@ def import_csv_and_generate_json(settings_vars, config_vars):
                     raise KeyError("Unrecognized CSV format")
 
                 # Convert RA to Hour Decimal and Dec to decimal degrees
-                ra_deg = convert_ra_to_hourdecimal(ra)
-                dec_deg = convert_dec_to_degrees(dec)
+                targets.append((description, target, convert_ra_to_hourdecimal(ra), convert_dec_to_degrees(dec)))
+
+            # Order the panes to shorten the slews between them
+            mosaic_order = scheduler_config.get_option("mosaic_order", ORDER_SHORTEST).lower()
+            order, csv_slew, slew = order_panes([entry[2] for entry in targets], [entry[3] for entry in targets], mosaic_order)
+            slew_summary = None
+            if len(targets) > 1:
+                slew_summary = f"{len(targets)} targets, order {mosaic_order}: total slew {slew:.2f}° (CSV order {csv_slew:.2f}°, saved {csv_slew - slew:.2f}°)"
+                print(slew_summary)
+
+            # Process each target in the slew order
+            for index in order:
+                description, target, ra_deg, dec_deg = targets[index]
 
                 # Set the values in settings_vars
                 settings_vars["description"].set(description)
@@ -608,7 +616,7 @@ def import_csv_and_generate_json(settings_vars, config_vars):
                     current_datetime = datetime.datetime.strptime(f"{end_date} {end_time}", '%Y-%m-%d %H:%M:%S')
 
         # Show preview dialog
-        if show_preview_dialog(json_preview):
+        if show_preview_dialog(json_preview, slew_summary):
             # User confirmed, generate actual JSON files
             for json_data in json_preview:
                 save_json_to_file(json_data)
@@ -720,7 +728,7 @@ def generate_json_preview(settings_vars, config_vars):
     return data
 
 
-def show_preview_dialog(json_preview):
+def show_preview_dialog(json_preview, summary=None):
     # Create a new window for the preview
     preview_window = tk.Toplevel()
     preview_window.title("Preview JSON Data")
@@ -728,6 +736,10 @@ def show_preview_dialog(json_preview):
     # Default value for confirmed attribute
     preview_window.confirmed = False
     
+    # Summary of the import, e.g. the slew saved by the order of the mosaic panes
+    if summary:
+        tk.Label(preview_window, text=summary, anchor='w', justify='left').pack(fill='x', padx=5, pady=5)
+
     # Create a text widget to display the preview
     text_widget = tk.Text(preview_window, wrap='word', height=20, width=50)
     text_widget.pack(expand=True, fill='both')
@@ -777,6 +789,13 @@ def save_json_to_file(json_data):
 
     with open(filepath, 'w') as outfile:
         json.dump(json_data, outfile, indent=4)
+    record_available_session(filename, json_data)
+
+# Add a new session file in the session store, if enabled
+def record_available_session(filename, data):
+    store = get_session_store(SAVE_FOLDER)
+    if store is not None:
+        store.record(filename, "available", data)
 
 # Function to create the session tab
 def create_session_tab(tab_create_session, settings_vars, config_vars):
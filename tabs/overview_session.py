@@ -5,6 +5,7 @@ import tkinter as tk
 from tkinter import messagebox
 
 from astro_dwarf_scheduler import LIST_ASTRO_DIR_DEFAULT
+from session_store import get_session_store
 
 def overview_session_tab(parent_frame):
     """Initializes the session overview tab."""
@@ -26,16 +27,25 @@ def overview_session_tab(parent_frame):
     select_button.pack(pady=20)
     
     # Button to refresh the JSON list
-    refresh_button = tk.Button(parent_frame, text="Refresh JSON List", command=lambda: populate_json_list(json_listbox))
+    refresh_button = tk.Button(parent_frame, text="Refresh JSON List", command=lambda: populate_json_list(json_listbox, True))
     refresh_button.pack(pady=5)
 
     # Populate JSON list
     populate_json_list(json_listbox)
 
-def populate_json_list(json_listbox):
+def populate_json_list(json_listbox, rescan = False):
     """Populates the listbox with JSON files from the Astro_Sessions folder."""
     json_listbox.delete(0, tk.END)
     try:
+        store = get_session_store(LIST_ASTRO_DIR_DEFAULT["SESSIONS_DIR"])
+        if store is not None:
+            # query the session store, the folder is only read again on refresh
+            if rescan:
+                store.import_directories(("available",))
+            for row in store.list_sessions(("available",)):
+                json_listbox.insert(tk.END, row["filename"])
+            return
+
         for filename in os.listdir(LIST_ASTRO_DIR_DEFAULT["SESSIONS_DIR"]):
             if filename.endswith('.json'):
                json_listbox.insert(tk.END, filename)
@@ -142,6 +152,12 @@ def select_session(json_listbox, json_text, select_button):
                 shutil.move(source_path, destination_path)
                 print(f"Moved {selected_file} to ToDo folder.")
 
+                default_store = get_session_store(LIST_ASTRO_DIR_DEFAULT["SESSIONS_DIR"])
+                if default_store is not None:
+                    default_store.remove(selected_file)
+                    with open(destination_path, 'r') as file:
+                        get_session_store(LIST_ASTRO_DIR["SESSIONS_DIR"]).record(selected_file, "todo", json.load(file))
+
             except Exception as e:
                 print(f"Error moving file {selected_file}: {e}")
 
@@ -6,6 +6,9 @@ import os
 import csv
 from datetime import datetime, timedelta
 
+from session_store import get_session_store
+from dwarf_session import STEP_DESCRIPTIONS
+
 # Directories
 TIME_CHANGE_DAY = 18
 
@@ -222,14 +225,17 @@ def get_observation_night(starting_date):
     observation_night = observation_datetime.strftime('%Y-%m-%d')
     return observation_night
 
-# Function to analyze JSON files and generate CSV
-def analyze_files():
+# Get (filename, data) of the ended sessions not yet processed
+def list_ended_sessions(processed_files):
     from astro_dwarf_scheduler import LIST_ASTRO_DIR
 
-    # Directories
-    RESULTS_DIR = LIST_ASTRO_DIR["SESSIONS_DIR"] + '/Results'
-
-    processed_files = load_processed_files()
+    store = get_session_store(LIST_ASTRO_DIR["SESSIONS_DIR"])
+    if store is not None:
+        # query the session store instead of reading the Done and Error folders
+        for row in store.list_sessions(("done", "error")):
+            if row["filename"] not in processed_files:
+                yield row["filename"], json.loads(row["data"])
+        return
 
     # Paths to Done and Error directories
     for status_dir in ['Done', 'Error']:
@@ -248,69 +254,107 @@ def analyze_files():
             file_path = os.path.join(dir_path, filename)
             with open(file_path, 'r') as file:
                 data = json.load(file)
+            yield filename, data
+
+# Function to analyze JSON files and generate CSV
+def analyze_files():
+    from astro_dwarf_scheduler import LIST_ASTRO_DIR
+
+    # Directories
+    RESULTS_DIR = LIST_ASTRO_DIR["SESSIONS_DIR"] + '/Results'
+
+    processed_files = load_processed_files()
 
-            # Attempt to get starting_date from the JSON data
-            starting_date = data["command"]["id_command"].get("starting_date")
-
-            # If starting_date is not found, extract it from the filename
-            if not starting_date:
-                # Extract date and time from filename, e.g., "2024-10-20-17-29-45-Mosaic Pane 4.json"
-                date_parts = filename.split('-')[:3]  # Get the first three parts for year, month, day
-                time_parts = filename.split('-')[3:6]  # Get the next three parts for hours, minutes, seconds
-                starting_date = '-'.join(date_parts) + ' ' + ':'.join(time_parts)  # Combine with time part
-                # Strip any whitespace from starting_date
-                starting_date = starting_date.strip()
-
-                try:
-                    # Convert to a datetime object to ensure the format is correct
-                    datetime.strptime(starting_date, '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    print(f"Invalid date format in filename: {filename}")
-                    continue  # Skip this file if the date format is invalid
-
-            typeDwarf = data["command"]["id_command"].get("dwarf")
-            if not typeDwarf:
-                typeDwarf = "-"
-
-            observation_night = get_observation_night(starting_date)
-    
-            # Prepare the CSV data based on JSON content
-            csv_data = {
-                'id': data["command"]["id_command"]["uuid"],
-                'description': data["command"]["id_command"]["description"],
-                'dwarf': typeDwarf,
-                'starting_date': starting_date,
-                'processed_date': data["command"]["id_command"]["processed_date"],
-                'result': data["command"]["id_command"]["result"],
-                'message': data["command"]["id_command"]["message"],
-                'calibration': data["command"].get("calibration", {}).get("do_action", False),
-                'goto_solar': data["command"].get("goto_solar", {}).get("do_action", False),
-                'goto_manual': data["command"].get("goto_manual", {}).get("do_action", False),
-                'target': data["command"].get("goto_manual", {}).get("target", ""),
-                'ra_coord': data["command"].get("goto_manual", {}).get("ra_coord", ""),
-                'dec_coord': data["command"].get("goto_manual", {}).get("dec_coord", ""),
-                'Tele Astro': data["command"].get("setup_camera", {}).get("do_action", False),
-                'Wide Angle': data["command"].get("setup_wide_camera", {}).get("do_action", False),
-                'exposure': data["command"].get("setup_camera", {}).get("exposure", ""),
-                'gain': data["command"].get("setup_camera", {}).get("gain", ""),
-                'IR': data["command"].get("setup_camera", {}).get("IRCut", ""),
-                'count': data["command"].get("setup_camera", {}).get("count", ""),
-            }
-
-            # Write to CSV file
-            csv_filename = f'results_session_night_{observation_night}.csv'
-            csv_filepath = os.path.join(RESULTS_DIR, csv_filename)
-            write_to_csv(csv_filepath, csv_data)
-
-            save_processed_file(filename)
+    for filename, data in list_ended_sessions(processed_files):
+        # Attempt to get starting_date from the JSON data
+        starting_date = data["command"]["id_command"].get("starting_date")
+
+        # If starting_date is not found, extract it from the filename
+        if not starting_date:
+            # Extract date and time from filename, e.g., "2024-10-20-17-29-45-Mosaic Pane 4.json"
+            date_parts = filename.split('-')[:3]  # Get the first three parts for year, month, day
+            time_parts = filename.split('-')[3:6]  # Get the next three parts for hours, minutes, seconds
+            starting_date = '-'.join(date_parts) + ' ' + ':'.join(time_parts)  # Combine with time part
+            # Strip any whitespace from starting_date
+            starting_date = starting_date.strip()
+
+            try:
+                # Convert to a datetime object to ensure the format is correct
+                datetime.strptime(starting_date, '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                print(f"Invalid date format in filename: {filename}")
+                continue  # Skip this file if the date format is invalid
+
+        typeDwarf = data["command"]["id_command"].get("dwarf")
+        if not typeDwarf:
+            typeDwarf = "-"
+
+        observation_night = get_observation_night(starting_date)
+
+        # Prepare the CSV data based on JSON content
+        csv_data = {
+            'id': data["command"]["id_command"]["uuid"],
+            'description': data["command"]["id_command"]["description"],
+            'dwarf': typeDwarf,
+            'starting_date': starting_date,
+            'processed_date': data["command"]["id_command"]["processed_date"],
+            'result': data["command"]["id_command"]["result"],
+            'message': data["command"]["id_command"]["message"],
+            'calibration': data["command"].get("calibration", {}).get("do_action", False),
+            'goto_solar': data["command"].get("goto_solar", {}).get("do_action", False),
+            'goto_manual': data["command"].get("goto_manual", {}).get("do_action", False),
+            'target': data["command"].get("goto_manual", {}).get("target", ""),
+            'ra_coord': data["command"].get("goto_manual", {}).get("ra_coord", ""),
+            'dec_coord': data["command"].get("goto_manual", {}).get("dec_coord", ""),
+            'Tele Astro': data["command"].get("setup_camera", {}).get("do_action", False),
+            'Wide Angle': data["command"].get("setup_wide_camera", {}).get("do_action", False),
+            'exposure': data["command"].get("setup_camera", {}).get("exposure", ""),
+            'gain': data["command"].get("setup_camera", {}).get("gain", ""),
+            'IR': data["command"].get("setup_camera", {}).get("IRCut", ""),
+            'count': data["command"].get("setup_camera", {}).get("count", ""),
+        }
+
+        # Time (s) spent in each step of the session
+        timings = data["command"]["id_command"].get("timings", {})
+        csv_data['total_time'] = timings.get("total", "")
+        for step in STEP_DESCRIPTIONS:
+            csv_data[f'{step}_time'] = timings.get(step, {}).get("time", "")
+
+        # Write to CSV file
+        csv_filename = f'results_session_night_{observation_night}.csv'
+        csv_filepath = os.path.join(RESULTS_DIR, csv_filename)
+        write_to_csv(csv_filepath, csv_data)
+
+        save_processed_file(filename)
 
 # Helper function to write data to CSV
 def write_to_csv(csv_path, csv_data):
-    headers = csv_data.keys()
-    file_exists = os.path.exists(csv_path)
+    headers = list(csv_data.keys())
+    write_header = not os.path.exists(csv_path)
+
+    # keep the columns of an existing file, new columns (e.g. the step timings) are added to it
+    if not write_header:
+        with open(csv_path, 'r', newline='') as csvfile:
+            reader = csv.DictReader(csvfile)
+            existing_headers = reader.fieldnames
+            rows = list(reader)
+        if not existing_headers:
+            # empty file
+            write_header = True
+        else:
+            missing = [header for header in headers if header not in existing_headers]
+            headers = existing_headers + missing
+            if missing:
+                # rewrite the file with the extended header, the previous rows keep empty values
+                temp_path = csv_path + ".tmp"
+                with open(temp_path, 'w', newline='') as csvfile:
+                    writer = csv.DictWriter(csvfile, fieldnames=headers)
+                    writer.writeheader()
+                    writer.writerows(rows)
+                os.replace(temp_path, csv_path)
 
     with open(csv_path, 'a', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=headers)
-        if not file_exists:
+        writer = csv.DictWriter(csvfile, fieldnames=headers, extrasaction='ignore')
+        if write_header:
             writer.writeheader()
         writer.writerow(csv_data)
@@ -80,7 +80,9 @@ def load_config():
     return config['CONFIG']
 
 def save_config(config_data):
+    # keep the other sections of the file
     config = configparser.ConfigParser()
+    config.read(CONFIG_INI_FILE)
     config['CONFIG'] = config_data
     with open(CONFIG_INI_FILE, 'w') as configfile:
         config.write(configfile)
@@ -0,0 +1,270 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import scheduler_config
+
+from dwarf_python_api.lib.dwarf_utils import parse_ra_to_float
+from dwarf_python_api.lib.dwarf_utils import parse_dec_to_float
+
+import dwarf_python_api.lib.my_logger as log
+
+# What the scheduler does with a due session whose target is not visible, visibility_policy of the [SCHEDULER] section
+VISIBILITY_OFF = "off"      # no check
+VISIBILITY_FLAG = "flag"    # log it and run the session
+VISIBILITY_SKIP = "skip"    # move the session to Error
+VISIBILITY_DEFER = "defer"  # move the session to the next visibility window of the night, to Error if none
+VISIBILITY_POLICIES = (VISIBILITY_OFF, VISIBILITY_FLAG, VISIBILITY_SKIP, VISIBILITY_DEFER)
+
+# A night goes from noon to noon (local time), sampled every SAMPLE_MINUTES
+SAMPLE_MINUTES = 5
+NIGHT_SAMPLES = 24 * 60 // SAMPLE_MINUTES + 1
+DEFAULT_MIN_ALTITUDE = 10.0
+DEFAULT_SUN_ALTITUDE = -12.0
+MAX_CACHED_NIGHTS = 4
+
+def get_timezone(name):
+    """ZoneInfo of the timezone of the site, None to use the local time of the computer."""
+    if not name:
+        return None
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(name)
+    except Exception as e:
+        log.warning(f"Unknown timezone {name}, the local time of the computer is used - {e}")
+        return None
+
+# The scheduler times (datetime.now() and the session dates) are naive datetimes in the local time of the computer,
+# the timezone of the site only sets the noon to noon boundaries of the nights
+def to_timestamp(when):
+    return when.timestamp()
+
+def from_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp)
+
+# Noon before when in the timezone of the site, as a timestamp
+def get_night_start(when, tz):
+    site_time = datetime.fromtimestamp(to_timestamp(when), tz).replace(tzinfo=None)
+    start = datetime.combine(site_time.date(), datetime.min.time()) + timedelta(hours=12)
+    if site_time < start:
+        start -= timedelta(days=1)
+    return start.replace(tzinfo=tz).timestamp() if tz is not None else start.timestamp()
+
+# Horizon mask file: one "azimuth altitude" pair (degrees) per line, the minimum altitude is interpolated between them
+def read_horizon_mask(filename):
+    points = []
+    with open(filename, 'r') as file:
+        for line in file:
+            line = line.split('#')[0].replace(',', ' ').split()
+            if len(line) >= 2:
+                points.append((float(line[0]) % 360, float(line[1])))
+    if not points:
+        raise ValueError("no azimuth altitude values")
+    points.sort()
+    return np.array([point[0] for point in points]), np.array([point[1] for point in points])
+
+def get_julian_dates(timestamps):
+    return np.asarray(timestamps) / 86400.0 + 2440587.5
+
+# Local sidereal time (degrees) of the julian dates at a longitude (degrees, east positive)
+def get_sidereal_degrees(julian_dates, longitude):
+    days = julian_dates - 2451545.0
+    centuries = days / 36525.0
+    gmst = 280.46061837 + 360.98564736629 * days + 0.000387933 * centuries ** 2 - centuries ** 3 / 38710000.0
+    return np.mod(gmst + longitude, 360.0)
+
+# Altitude and azimuth (degrees, azimuth from north to east) of RA/Dec (degrees) at the sidereal times,
+# the arrays are broadcast: targets as a column and times as a row give one curve per target
+def get_alt_az(ra_deg, dec_deg, sidereal_deg, latitude):
+    hour_angle = np.radians(sidereal_deg - ra_deg)
+    dec = np.radians(dec_deg)
+    lat = np.radians(latitude)
+    sin_alt = np.sin(dec) * np.sin(lat) + np.cos(dec) * np.cos(lat) * np.cos(hour_angle)
+    altitude = np.degrees(np.arcsin(np.clip(sin_alt, -1.0, 1.0)))
+    azimuth = np.degrees(np.arctan2(-np.cos(dec) * np.sin(hour_angle),
+                                    np.sin(dec) * np.cos(lat) - np.cos(dec) * np.sin(lat) * np.cos(hour_angle)))
+    return altitude, np.mod(azimuth, 360.0)
+
+# RA/Dec (degrees) of the sun, low precision (0.01 degree)
+def get_sun_ra_dec(julian_dates):
+    days = julian_dates - 2451545.0
+    mean_longitude = np.mod(280.460 + 0.9856474 * days, 360.0)
+    anomaly = np.radians(np.mod(357.528 + 0.9856003 * days, 360.0))
+    ecliptic_longitude = np.radians(mean_longitude + 1.915 * np.sin(anomaly) + 0.020 * np.sin(2 * anomaly))
+    obliquity = np.radians(23.439 - 0.0000004 * days)
+    ra = np.degrees(np.arctan2(np.cos(obliquity) * np.sin(ecliptic_longitude), np.cos(ecliptic_longitude)))
+    dec = np.degrees(np.arcsin(np.sin(obliquity) * np.sin(ecliptic_longitude)))
+    return np.mod(ra, 360.0), dec
+
+# Target (RA hours, Dec degrees) of the goto_manual action of a session file, None if there is none
+def get_target_coordinates(program):
+    goto_manual = program.get('command', {}).get('goto_manual', {}) if isinstance(program, dict) else {}
+    if not goto_manual.get('do_action'):
+        return None
+    ra, dec = goto_manual.get('ra_coord'), goto_manual.get('dec_coord')
+    if ra in (None, "") or dec in (None, ""):
+        return None
+    try:
+        try:
+            ra = float(ra)
+        except ValueError:
+            ra = parse_ra_to_float(ra)
+        try:
+            dec = float(dec)
+        except ValueError:
+            dec = parse_dec_to_float(dec)
+        return round(float(ra), 4), round(float(dec), 4)
+    except (TypeError, ValueError):
+        return None
+
+class VisibilityNight:
+    """Sampled sky of one night of a site: sidereal times, darkness and the altitude curves of the targets."""
+    def __init__(self, start_timestamp, site, min_altitude, sun_altitude, mask):
+        self.latitude, self.longitude = site[0], site[1]
+        self.min_altitude = min_altitude
+        self.mask = mask
+        self.start_timestamp = start_timestamp
+        self.timestamps = self.start_timestamp + np.arange(NIGHT_SAMPLES) * SAMPLE_MINUTES * 60.0
+        julian_dates = get_julian_dates(self.timestamps)
+        self.sidereal = get_sidereal_degrees(julian_dates, self.longitude)
+        sun_ra, sun_dec = get_sun_ra_dec(julian_dates)
+        sun_altitude_curve, _ = get_alt_az(sun_ra, sun_dec, self.sidereal, self.latitude)
+        self.dark = sun_altitude_curve <= sun_altitude if sun_altitude is not None else np.ones(NIGHT_SAMPLES, dtype=bool)
+        self.targets = {}  # (ra hours, dec) -> (altitudes, azimuths, minimum altitudes)
+
+    def get_minimum_altitudes(self, azimuths):
+        if self.mask is None:
+            return np.full(azimuths.shape, self.min_altitude)
+        mask_azimuths, mask_altitudes = self.mask
+        return np.maximum(self.min_altitude, np.interp(azimuths, mask_azimuths, mask_altitudes, period=360.0))
+
+    def add_targets(self, targets):
+        """Compute the curves of the new targets in one pass."""
+        targets = [target for target in dict.fromkeys(targets) if target not in self.targets]
+        if not targets:
+            return
+        coordinates = np.array(targets, dtype=float)
+        ra_deg = coordinates[:, 0:1] * 15.0
+        dec_deg = coordinates[:, 1:2]
+        altitudes, azimuths = get_alt_az(ra_deg, dec_deg, self.sidereal[np.newaxis, :], self.latitude)
+        minimums = self.get_minimum_altitudes(azimuths)
+        for index, target in enumerate(targets):
+            self.targets[target] = (altitudes[index], azimuths[index], minimums[index])
+
+    def get_index(self, when):
+        index = int((to_timestamp(when) - self.start_timestamp) // (SAMPLE_MINUTES * 60))
+        return min(max(index, 0), NIGHT_SAMPLES - 1)
+
+    def get_time(self, index):
+        return from_timestamp(float(self.timestamps[index]))
+
+    def is_up(self, target):
+        altitudes, _, minimums = self.targets[target]
+        return altitudes >= minimums
+
+class VisibilityEngine:
+    """Visibility of the targets of the sessions, the nights are computed once per site, mask and limits."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nights = {}  # key -> VisibilityNight
+        self.masks = {}  # filename -> (mtime, mask)
+
+    def get_mask(self):
+        filename = scheduler_config.get_option("horizon_mask", "")
+        if not filename:
+            return None, None
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+            cached = self.masks.get(filename)
+            if cached is None or cached[0] != mtime:
+                self.masks[filename] = cached = (mtime, read_horizon_mask(filename))
+            return (filename, mtime), cached[1]
+        except (OSError, ValueError) as e:
+            log.warning(f"The horizon mask {filename} is not used - {e}")
+            return None, None
+
+    def get_night(self, when):
+        """Return the sampled night of when, None if the site is not set."""
+        site = scheduler_config.get_site()
+        if site is None:
+            return None
+        min_altitude = scheduler_config.get_float_option("min_altitude", DEFAULT_MIN_ALTITUDE)
+        sun_option = scheduler_config.get_option("max_sun_altitude", str(DEFAULT_SUN_ALTITUDE))
+        try:
+            sun_altitude = float(sun_option) if sun_option.lower() not in ("none", "false", "off") else None
+        except ValueError:
+            sun_altitude = DEFAULT_SUN_ALTITUDE
+        start = get_night_start(when, get_timezone(site[2]))
+
+        with self.lock:
+            mask_key, mask = self.get_mask()
+            key = (start, site, mask_key, min_altitude, sun_altitude)
+            night = self.nights.get(key)
+            if night is None:
+                night = VisibilityNight(start, site, min_altitude, sun_altitude, mask)
+                self.nights[key] = night
+                # keep the last nights only
+                for old_key in sorted(self.nights, key=lambda item: item[0])[:-MAX_CACHED_NIGHTS]:
+                    del self.nights[old_key]
+            return night
+
+    def prepare(self, targets, when):
+        """Compute at once the curves of all the targets for the night of when."""
+        night = self.get_night(when)
+        if night is not None:
+            with self.lock:
+                night.add_targets(targets)
+        return night
+
+    def check(self, target, when, others=()):
+        """Return the altitude, azimuth and minimum altitude of the target at when, None if the site is not set.
+
+        When the target is not computed yet for the night, the others targets are computed in the same pass.
+        """
+        night = self.get_night(when)
+        if night is None:
+            return None
+        with self.lock:
+            if target not in night.targets:
+                night.add_targets([target] + [other for other in others if other is not None])
+        index = night.get_index(when)
+        altitudes, azimuths, minimums = night.targets[target]
+        return {
+            "visible": bool(altitudes[index] >= minimums[index]),
+            "altitude": round(float(altitudes[index]), 1),
+            "azimuth": round(float(azimuths[index]), 1),
+            "min_altitude": round(float(minimums[index]), 1),
+            "dark": bool(night.dark[index]),
+        }
+
+    def next_window(self, target, when, until=None):
+        """Return the first time after when the target is visible in a dark sky, before until and the end of the night."""
+        night = self.prepare([target], when)
+        if night is None:
+            return None
+        index = night.get_index(when) + 1
+        usable = night.is_up(target) & night.dark
+        candidates = np.flatnonzero(usable[index:])
+        if candidates.size == 0:
+            return None
+        start = night.get_time(index + int(candidates[0]))
+        if until is not None and start >= until:
+            return None
+        return start
+
+    def get_windows(self, target, when):
+        """Return the [(start, end)] intervals of the night of when where the target is visible in a dark sky."""
+        night = self.prepare([target], when)
+        if night is None:
+            return []
+        usable = np.concatenate(([False], night.is_up(target) & night.dark, [False]))
+        edges = np.flatnonzero(np.diff(usable.astype(np.int8)))
+        return [(night.get_time(start), night.get_time(end - 1)) for start, end in zip(edges[0::2], edges[1::2])]
+
+visibility_engine = VisibilityEngine()
+
+def get_visibility_policy():
+    policy = scheduler_config.get_option("visibility_policy", VISIBILITY_FLAG).lower()
+    return policy if policy in VISIBILITY_POLICIES else VISIBILITY_FLAG